@@ -0,0 +1,23 @@
+"""Benchmarks
+
+    $ poetry run benchmark --help
+
+Each benchmark is a subcommand. Results are compared to the JSON baselines in
+baselines/, see baselines.py.
+"""
+
+import argparse
+
+from . import delivery, poll_cycle, render
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="benchmark", description=__doc__.splitlines()[0]
+    )
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    poll_cycle.add_parser(subparsers)
+    render.add_parser(subparsers)
+    delivery.add_parser(subparsers)
+    args = parser.parse_args()
+    raise SystemExit(args.run(args))
@@ -0,0 +1,81 @@
+"""JSON baselines of benchmark results
+
+A baseline is stored in baselines/<name>.json next to this module and committed,
+so a change that moves a number shows up in the diff of the baseline and in the
+comparison printed by the benchmark.
+
+Counts (database operations, bytes, messages) are deterministic and must match the
+baseline exactly. Timings, throughput and memory depend on the machine, they are
+only a regression when they get worse by more than the tolerance.
+"""
+
+import json
+from pathlib import Path
+from typing import Dict
+
+BASELINES_DIR = Path(__file__).parent / "baselines"
+
+# Suffixes of the measurements that vary between runs
+VARIABLE_SUFFIXES = ("seconds", "rss_bytes", "per_second", "per_entry")
+
+
+def flatten(results: dict, prefix: str = "") -> Dict[str, float]:
+    """Flattens nested results into dotted keys, e.g. 1000.cold.wall_seconds"""
+    flat = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{path}."))
+        elif isinstance(value, (int, float)):
+            flat[path] = value
+    return flat
+
+
+def load_baseline(name: str) -> dict | None:
+    path = BASELINES_DIR / f"{name}.json"
+    if not path.exists():
+        return None
+    return json.loads(path.read_text())
+
+
+def save_baseline(name: str, report: dict) -> Path:
+    BASELINES_DIR.mkdir(exist_ok=True)
+    path = BASELINES_DIR / f"{name}.json"
+    path.write_text(json.dumps(report, indent=2, sort_keys=True) + "\n")
+    return path
+
+
+def regressed(key: str, baseline: float, current: float, tolerance: float) -> bool:
+    if key.endswith("per_second"):
+        return current < baseline * (1 - tolerance)
+    if key.endswith(VARIABLE_SUFFIXES):
+        return current > baseline * (1 + tolerance)
+    return current != baseline
+
+
+def compare(baseline: dict, results: dict, tolerance: float = 0.25) -> bool:
+    """Prints the measurements that changed and returns whether any regressed
+
+    Args:
+        baseline (dict): Results of the baseline
+        results (dict): Results of this run
+        tolerance (float, optional): See VARIABLE_SUFFIXES. Defaults to 0.25.
+    """
+    before = flatten(baseline)
+    after = flatten(results)
+    regressions = False
+    for key in sorted(before.keys() | after.keys()):
+        old, new = before.get(key), after.get(key)
+        if old == new:
+            continue
+        if old is None or new is None:
+            print(f"  {key}: {old} -> {new}")
+            continue
+        change = f"{(new - old) / old:+.1%}" if old else "new"
+        mark = ""
+        if regressed(key, old, new, tolerance):
+            regressions = True
+            mark = " REGRESSION"
+        print(f"  {key}: {old} -> {new} ({change}){mark}")
+    print("Regressions found" if regressions else "No regressions")
+    return regressions
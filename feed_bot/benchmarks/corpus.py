@@ -0,0 +1,188 @@
+"""A synthetic corpus of feeds and subreddits
+
+The feeds are served by an aiohttp server in a process of its own, so generating
+them takes neither time nor memory from the process being measured. Feed n is
+served at /feeds/n.xml with an ETag and answers 304 Not Modified to a request that
+already has the current version. POST /publish adds one entry to every feed and GET
+/stats returns the requests and bytes served.
+
+SyntheticReddit stands in for the asyncpraw client the same way, and publish adds
+one submission to every subreddit.
+"""
+
+import asyncio
+import multiprocessing
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from types import SimpleNamespace
+from typing import AsyncIterator, Dict, List
+from xml.sax.saxutils import escape
+from aiohttp import web
+
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def entry_item(feed: int, number: int) -> str:
+    """Entry number of feed, entries are published an hour apart"""
+    published = format_datetime(EPOCH + timedelta(hours=number))
+    link = f"https://example.com/feed{feed}/entry{number}"
+    description = escape(
+        f'<p>Entry {number} of feed {feed}. <a href="{link}">Read more</a></p>'
+        f'<p><img src="https://example.com/images/{feed}-{number}.jpg" /></p>'
+        + "<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>" * 4
+    )
+    return (
+        f"<item><title>Entry {number} of feed {feed}</title><link>{link}</link>"
+        f'<guid isPermaLink="true">{link}</guid><pubDate>{published}</pubDate>'
+        f"<author>author{feed}@example.com (Author {feed})</author>"
+        f"<description>{description}</description></item>"
+    )
+
+
+def feed_document(
+    feed: int, entries: int, generation: int = 0, self_url: str = ""
+) -> bytes:
+    """An rss 2.0 document listing the newest entries of feed, newest first
+
+    self_url is its atom:link rel="self", the url the poller stores entries under.
+    """
+    newest = entries + generation - 1
+    items = "".join(
+        entry_item(feed, number) for number in range(newest, newest - entries, -1)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom"><channel>'
+        f'<atom:link href="{escape(self_url)}" rel="self" type="application/rss+xml" />'
+        f"<title>Feed {feed}</title><link>https://example.com/feed{feed}</link>"
+        f"<description>Synthetic feed {feed}</description>"
+        f"<image><url>https://example.com/images/{feed}.png</url>"
+        f"<title>Feed {feed}</title><link>https://example.com/feed{feed}</link></image>"
+        f"{items}</channel></rss>"
+    ).encode()
+
+
+class FeedCorpus:
+    """Serves feeds 0 to feeds - 1, see feed_document"""
+
+    def __init__(self, feeds: int, entries: int):
+        self.feeds = feeds
+        self.entries = entries
+        self.generation = 0
+        self.documents: Dict[int, bytes] = {}
+        self.stats = {"requests": 0, "not_modified": 0, "bytes": 0}
+
+    def etag(self, feed: int) -> str:
+        return f'"{feed}-{self.generation}"'
+
+    async def feed(self, request: web.Request) -> web.Response:
+        feed = int(request.match_info["feed"])
+        if feed >= self.feeds:
+            raise web.HTTPNotFound()
+        self.stats["requests"] += 1
+        etag = self.etag(feed)
+        if request.headers.get("If-None-Match") == etag:
+            self.stats["not_modified"] += 1
+            return web.Response(status=304, headers={"ETag": etag})
+        if feed not in self.documents:
+            self.documents[feed] = feed_document(
+                feed, self.entries, self.generation, str(request.url)
+            )
+        body = self.documents[feed]
+        self.stats["bytes"] += len(body)
+        return web.Response(
+            body=body,
+            headers={"ETag": etag, "Content-Type": "application/rss+xml"},
+        )
+
+    async def publish(self, request: web.Request) -> web.Response:
+        self.generation += 1
+        self.documents = {}
+        return web.json_response({"generation": self.generation})
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/feeds/{feed}.xml", self.feed)
+        app.router.add_post("/publish", self.publish)
+        app.router.add_get("/stats", self.get_stats)
+        return app
+
+
+def serve_corpus(feeds: int, entries: int, connection) -> None:
+    """Runs a FeedCorpus server until the process is terminated, sends its port"""
+
+    async def serve():
+        runner = web.AppRunner(FeedCorpus(feeds, entries).app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0, backlog=1024).start()
+        connection.send(runner.addresses[0][1])
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def start_corpus(feeds: int, entries: int):
+    """Starts serve_corpus in a child process
+
+    Returns:
+        Tuple[multiprocessing.Process, str]: The process, terminate it when done,
+        and the server's base url
+    """
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(
+        target=serve_corpus, args=(feeds, entries, sender), daemon=True
+    )
+    process.start()
+    port = receiver.recv()
+    return process, f"http://127.0.0.1:{port}"
+
+
+class SyntheticSubreddit:
+    def __init__(self, reddit: "SyntheticReddit", names: List[str]):
+        self.reddit = reddit
+        self.names = names
+
+    async def new(self, limit: int = 100, params: dict | None = None) -> AsyncIterator:
+        """Submissions of every subreddit newest first, stops at params["before"]"""
+        self.reddit.requests += 1
+        newest = self.reddit.submissions + self.reddit.generation - 1
+        before = (params or {}).get("before")
+        returned = 0
+        for number in range(newest, newest - self.reddit.submissions, -1):
+            for name in self.names:
+                fullname = f"t3_{name}_{number}"
+                if fullname == before or returned >= limit:
+                    return
+                returned += 1
+                yield SimpleNamespace(
+                    subreddit_name_prefixed=f"r/{name}",
+                    fullname=fullname,
+                    created_utc=(EPOCH + timedelta(hours=number)).timestamp(),
+                    title=f"Post {number} of r/{name}",
+                    selftext="Lorem ipsum dolor sit amet, consectetur adipiscing elit. "
+                    * 8,
+                    permalink=f"/r/{name}/comments/{number}/post_{number}/",
+                    thumbnail="self",
+                )
+
+
+class SyntheticReddit:
+    """Stands in for asyncpraw.Reddit, every subreddit has submissions submissions"""
+
+    def __init__(self, submissions: int):
+        self.submissions = submissions
+        self.generation = 0
+        self.requests = 0
+
+    async def subreddit(self, query: str) -> SyntheticSubreddit:
+        return SyntheticSubreddit(self, query.lower().split("+"))
+
+    def publish(self) -> None:
+        self.generation += 1
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,511 @@
+"""Delivery load simulator
+
+    $ poetry run benchmark delivery --scales 10000,100000
+
+Simulates delivering one poll's updates to tens of thousands of channels. The real
+fan-out drives the real delivery path: FeedPoller.deliver_entries and
+FeedBot.post_call_for_support, then the DeliveryQueue, then FeedBot.channel_send,
+then discord.py's HTTPClient with its rate limit buckets. Only the Discord API is a
+stand-in. DiscordAPI answers discord.py's requests the way Discord does:
+
+- Messages to a channel share a bucket of ROUTE_LIMIT requests per ROUTE_WINDOW
+  seconds. A request over it gets a 429 with the seconds left in the bucket.
+- Requests over GLOBAL_LIMIT per second get a global 429.
+- A message with more than 10 embeds or more than 6000 characters of embed text
+  gets a 400.
+- Every request takes a log-normally distributed latency around --latency seconds.
+
+The simulation runs on an event loop with a virtual clock (VirtualClockLoop). Time
+jumps to the next timer instead of passing, so an hour of rate limited delivery takes
+as long as the code needs to run. Every scale runs in a process of its own.
+
+Channels subscribe to --feeds-per-channel random feeds out of --channels-per-feed
+channels per feed on average. In the rss phase every feed has --entries new entries.
+Makespan is the time from the start of the fan-out to the last message sent. A
+channel's lag is the time until its last message was sent. The results are compared
+to the JSON baseline in baselines/, see baselines.py.
+"""
+
+import os
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import resource
+import platform
+import selectors
+import contextlib
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from http import HTTPStatus
+from typing import Dict, List
+from multidict import CIMultiDict, CIMultiDictProxy
+import discord
+
+from ..bot import FeedBot
+from ..migrations import migrate
+from ..utils.delivery import DELIVERY_GLOBAL_RATE, DELIVERY_WORKERS, DeliveryQueue
+from ..utils.rss import RSSFeed
+from ..utils.streaming import MONGO_BATCH_SIZE
+from .baselines import compare, load_baseline, save_baseline
+from .memory_db import MemoryClient
+
+SIMULATION_DATABASE = "feed_bot_simulation"
+PHASES = ("rss", "call_for_support")
+
+# Discord's limits, see https://discord.com/developers/docs/topics/rate-limits
+ROUTE_LIMIT = 5
+ROUTE_WINDOW = 5.0
+GLOBAL_LIMIT = 50
+MAX_EMBEDS = 10
+MAX_EMBED_CHARACTERS = 6000
+# Requests answered with a 401, 403 or 429 in 10 minutes before Cloudflare bans the IP
+INVALID_REQUEST_LIMIT = 10000
+
+BUCKET_HASH = "80c17d2f203122d936070c88c8d10f33"
+BOT_USER = {"id": "1", "username": "Feed Bot", "discriminator": "0000", "bot": True}
+
+
+class VirtualClock(selectors.DefaultSelector):
+    """A selector that advances a clock to the next timer instead of waiting for it
+
+    Only waits for real when nothing is scheduled, e.g. for a thread to finish.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.now = 0.0
+
+    def select(self, timeout: float | None = None):
+        ready = super().select(0)
+        if ready or timeout == 0:
+            return ready
+        if timeout is None:
+            return super().select(None)
+        self.now += timeout
+        return ready
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """An event loop on a VirtualClock, for code that only waits on timers"""
+
+    def __init__(self):
+        self.clock = VirtualClock()
+        super().__init__(self.clock)
+
+    def time(self) -> float:
+        return self.clock.now
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """The nearest rank percentile of values, 0.0 when there are none"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+def embed_characters(embed: dict) -> int:
+    """Characters of an embed that count towards Discord's 6000 per message"""
+    return (
+        len(embed.get("title", ""))
+        + len(embed.get("description", ""))
+        + len(embed.get("author", {}).get("name", ""))
+        + len(embed.get("footer", {}).get("text", ""))
+        + sum(
+            len(field.get("name", "")) + len(field.get("value", ""))
+            for field in embed.get("fields", [])
+        )
+    )
+
+
+class APIResponse:
+    """The parts of aiohttp.ClientResponse that discord.py reads"""
+
+    def __init__(self, status: int, data: dict, headers: Dict[str, str]):
+        self.status = status
+        self.reason = HTTPStatus(status).phrase
+        self.headers = CIMultiDictProxy(
+            CIMultiDict({"Content-Type": "application/json", **headers})
+        )
+        self.body = json.dumps(data)
+
+    async def text(self, encoding: str = "utf-8") -> str:
+        return self.body
+
+
+class DiscordAPI:
+    """Answers message requests like Discord, see the module docstring
+
+    Args:
+        latency (float, optional): Median seconds a request takes. Defaults to 0.1.
+        jitter (float, optional): Sigma of the log-normal latency. Defaults to 0.5.
+        seed (int, optional): Seed of the latencies. Defaults to 0.
+    """
+
+    def __init__(self, latency: float = 0.1, jitter: float = 0.5, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.buckets: Dict[int, List[float | int]] = {}
+        self.global_window = -1
+        self.global_count = 0
+        self.message_id = 10**18
+        self.counts: Counter = Counter()
+        self.delivered: Dict[int, float] = {}
+
+    def session(self) -> "APISession":
+        return APISession(self)
+
+    async def handle(self, method: str, url: str, data: str | None) -> APIResponse:
+        """Takes half the latency to arrive and half to return"""
+        latency = self.latency * math.exp(self.random.gauss(0, self.jitter))
+        await asyncio.sleep(latency / 2)
+        response = self.respond(method, url, data)
+        await asyncio.sleep(latency / 2)
+        if response.status == 200:
+            self.delivered[int(url.split("/")[-2])] = asyncio.get_running_loop().time()
+        return response
+
+    def rate_limited(self, retry_after: float, scope: str) -> APIResponse:
+        self.counts[f"rate_limited_{scope}"] += 1
+        self.counts["invalid_requests"] += 1
+        headers = {
+            "Retry-After": str(math.ceil(retry_after)),
+            "X-RateLimit-Scope": scope,
+            "Via": "1.1 google",
+        }
+        if scope == "global":
+            headers["X-RateLimit-Global"] = "true"
+        else:
+            headers |= {
+                "X-RateLimit-Limit": str(ROUTE_LIMIT),
+                "X-RateLimit-Remaining": "0",
+                "X-RateLimit-Reset-After": f"{retry_after:.3f}",
+                "X-RateLimit-Bucket": BUCKET_HASH,
+            }
+        body = {
+            "message": "You are being rate limited.",
+            "retry_after": round(retry_after, 3),
+            "global": scope == "global",
+        }
+        return APIResponse(429, body, headers)
+
+    def respond(self, method: str, url: str, data: str | None) -> APIResponse:
+        self.counts["requests"] += 1
+        now = asyncio.get_running_loop().time()
+        if int(now) != self.global_window:
+            self.global_window, self.global_count = int(now), 0
+        if self.global_count >= GLOBAL_LIMIT:
+            return self.rate_limited(self.global_window + 1 - now, "global")
+        self.global_count += 1
+
+        channel_id = int(url.split("/")[-2])
+        bucket = self.buckets.get(channel_id)
+        if bucket is None or bucket[0] <= now:
+            bucket = self.buckets[channel_id] = [now + ROUTE_WINDOW, ROUTE_LIMIT]
+        reset_at, remaining = bucket
+        if remaining <= 0:
+            return self.rate_limited(reset_at - now, "user")
+        bucket[1] -= 1
+        headers = {
+            "X-RateLimit-Limit": str(ROUTE_LIMIT),
+            "X-RateLimit-Remaining": str(bucket[1]),
+            "X-RateLimit-Reset-After": f"{reset_at - now:.3f}",
+            "X-RateLimit-Bucket": BUCKET_HASH,
+        }
+
+        payload = json.loads(data or "{}")
+        embeds = payload.get("embeds") or []
+        if (
+            len(embeds) > MAX_EMBEDS
+            or sum(embed_characters(embed) for embed in embeds) > MAX_EMBED_CHARACTERS
+        ):
+            self.counts["rejected"] += 1
+            body = {"message": "Invalid Form Body", "code": 50035}
+            return APIResponse(400, body, headers)
+
+        self.counts["messages"] += 1
+        self.counts["embeds"] += len(embeds)
+        self.message_id += 1
+        message = {
+            "id": str(self.message_id),
+            "channel_id": str(channel_id),
+            "type": 0,
+            "content": payload.get("content") or "",
+            "author": BOT_USER,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": embeds,
+            "pinned": False,
+        }
+        return APIResponse(200, message, headers)
+
+
+class APISession:
+    """Takes the place of the aiohttp.ClientSession of discord.py's HTTPClient"""
+
+    closed = False
+
+    def __init__(self, api: DiscordAPI):
+        self.api = api
+
+    @contextlib.asynccontextmanager
+    async def request(self, method: str, url: str, **kwargs):
+        yield await self.api.handle(method, url, kwargs.get("data"))
+
+    async def close(self) -> None:
+        pass
+
+
+class SimulatedBot(FeedBot):
+    """A FeedBot on a scratch database whose HTTPClient talks to a DiscordAPI"""
+
+    database_name = SIMULATION_DATABASE
+
+    def connect_api(self, api: DiscordAPI) -> None:
+        # What HTTPClient.static_login sets up, without logging in
+        self.http._HTTPClient__session = api.session()
+        self.http._global_over = asyncio.Event()
+        self.http._global_over.set()
+        self.http.token = "simulated"
+
+
+def subscriptions(
+    channels: int, feeds: int, feeds_per_channel: int, seed: int = 0
+) -> List[dict]:
+    """feeds_per_channel random feeds for each of channels channels"""
+    generator = random.Random(seed)
+    return [
+        {"channel_id": 10**17 + channel, "feed_url": f"https://example.com/{feed}"}
+        for channel in range(channels)
+        for feed in generator.sample(range(feeds), min(feeds_per_channel, feeds))
+    ]
+
+
+def entry_embeds(feed_url: str, entries: int) -> List[discord.Embed]:
+    """The embeds of entries new entries of feed_url, about 700 characters each"""
+    return [
+        RSSFeed.build_entry_embed(
+            [
+                feed_url,
+                f"Entry {number} of {feed_url}",
+                "https://example.com/logo.png",
+                "",
+                {"name": "Author"},
+                f"{feed_url}/entry{number}",
+                "Mon, 01 Jan 2024 00:00:00 GMT",
+                "",
+                "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 11,
+                f"https://example.com/images/{number}.jpg",
+            ]
+        )
+        for number in range(entries)
+    ]
+
+
+async def run_phase(bot: SimulatedBot, api: DiscordAPI, fan_out) -> dict:
+    """Runs the coroutine fan_out and waits until the delivery queue is drained"""
+    loop = asyncio.get_running_loop()
+    counts_before = Counter(api.counts)
+    queue_before = bot.delivery.stats()
+    api.delivered = {}
+    started_at, started = loop.time(), time.perf_counter()
+    await fan_out
+    enqueued_at = loop.time()
+    await bot.delivery.join()
+    lags = [delivered - started_at for delivered in api.delivered.values()]
+    queue = bot.delivery.stats()
+    counts = Counter(api.counts)
+    counts.subtract(counts_before)
+    return {
+        "makespan_seconds": round(max(lags, default=0.0), 3),
+        "enqueue_seconds": round(enqueued_at - started_at, 3),
+        "lag_p50_seconds": round(percentile(lags, 0.5), 3),
+        "lag_p99_seconds": round(percentile(lags, 0.99), 3),
+        "channels": len(lags),
+        **{key: value for key, value in sorted(counts.items()) if value},
+        "retried": queue["retried"] - queue_before["retried"],
+        "dropped": queue["failed"] - queue_before["failed"],
+        "simulation_seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+async def simulate(
+    channels: int,
+    feeds_per_channel: int = 3,
+    channels_per_feed: int = 30,
+    entries: int = 2,
+    latency: float = 0.1,
+    workers: int = DELIVERY_WORKERS,
+    rate: float = DELIVERY_GLOBAL_RATE,
+    seed: int = 0,
+    quiet: bool = True,
+) -> dict:
+    """Runs the phases for channels channels and returns their measurements
+
+    Args:
+        channels (int): Subscribing channels
+        feeds_per_channel (int, optional): Feeds each channel subscribes to.
+            Defaults to 3.
+        channels_per_feed (int, optional): Average subscribers of a feed, sets the
+            number of feeds. Defaults to 30.
+        entries (int, optional): New entries of every feed. Defaults to 2.
+        latency (float, optional): See DiscordAPI. Defaults to 0.1.
+        workers (int, optional): DeliveryQueue workers. Defaults to DELIVERY_WORKERS.
+        rate (float, optional): DeliveryQueue rate. Defaults to DELIVERY_GLOBAL_RATE.
+        seed (int, optional): Seed of the subscriptions and latencies. Defaults to 0.
+        quiet (bool, optional): Discard what the bot prints. Defaults to True.
+    """
+    feeds = max(channels * feeds_per_channel // channels_per_feed, 1)
+    api = DiscordAPI(latency=latency, seed=seed)
+    bot = SimulatedBot(db_client=MemoryClient())
+    bot.connect_api(api)
+    bot.delivery = DeliveryQueue(send=bot.channel_send, workers=workers, rate=rate)
+    await migrate(bot.db)
+    documents = subscriptions(channels, feeds, feeds_per_channel, seed)
+    for start in range(0, len(documents), MONGO_BATCH_SIZE):
+        await bot.subscriptions_collection.insert_many(
+            documents[start : start + MONGO_BATCH_SIZE]
+        )
+    await bot.subscription_index.load(bot.subscriptions_collection)
+
+    async def rss_fan_out():
+        for feed in range(feeds):
+            feed_url = f"https://example.com/{feed}"
+            await bot.deliver_entries(
+                feed_url=feed_url, embeds=entry_embeds(feed_url, entries)
+            )
+
+    results = {}
+    bot.delivery.start()
+    output = open(os.devnull, "w") if quiet else contextlib.nullcontext()
+    try:
+        with output as devnull:
+            redirect = (
+                contextlib.redirect_stdout(devnull)
+                if devnull
+                else contextlib.nullcontext()
+            )
+            with redirect:
+                results["rss"] = await run_phase(bot, api, rss_fan_out())
+                results["call_for_support"] = await run_phase(
+                    bot, api, bot.post_call_for_support()
+                )
+    finally:
+        bot.delivery.stop()
+    results["feeds"] = feeds
+    results["subscriptions"] = len(documents)
+    results["peak_rss_bytes"] = (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    )
+    return results
+
+
+def run_scale(kwargs: dict) -> dict:
+    with asyncio.Runner(loop_factory=VirtualClockLoop) as runner:
+        return runner.run(simulate(**kwargs))
+
+
+def run(args: argparse.Namespace) -> int:
+    config = {
+        "feeds_per_channel": args.feeds_per_channel,
+        "channels_per_feed": args.channels_per_feed,
+        "entries": args.entries,
+        "latency": args.latency,
+        "workers": args.workers,
+        "rate": args.rate,
+        "seed": args.seed,
+    }
+    results = {}
+    for channels in [int(scale) for scale in args.scales.split(",")]:
+        print(f"Simulating delivery to {channels} channels")
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results[str(channels)] = executor.submit(
+                run_scale, dict(channels=channels, quiet=not args.verbose, **config)
+            ).result()
+        for phase in PHASES:
+            phase_results = results[str(channels)][phase]
+            print(
+                f"  {phase}: {phase_results.get('messages', 0)} messages, "
+                f"makespan {phase_results['makespan_seconds']}s, "
+                f"lag p50 {phase_results['lag_p50_seconds']}s "
+                f"p99 {phase_results['lag_p99_seconds']}s, "
+                f"{phase_results.get('invalid_requests', 0)} invalid requests, "
+                f"simulated in {phase_results['simulation_seconds']}s"
+            )
+            if phase_results.get("invalid_requests", 0) >= INVALID_REQUEST_LIMIT:
+                print(f"  {phase}: enough invalid requests to be banned by Cloudflare")
+    report = {
+        "config": config,
+        "environment": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    if args.save:
+        path = save_baseline("delivery", report)
+        print(f"Baseline saved to {path}")
+        return 0
+    baseline = load_baseline("delivery")
+    if baseline is None:
+        print("No baseline delivery to compare with, run with --save to create it")
+        return 0
+    if baseline["config"] != config:
+        print(f"The baseline was recorded with {baseline['config']}, not {config}")
+    return 1 if compare(baseline["results"], results, args.tolerance) else 0
+
+
+def add_parser(subparsers) -> None:
+    parser = subparsers.add_parser(
+        "delivery", help="Simulated delivery to tens of thousands of channels"
+    )
+    parser.add_argument(
+        "--scales", default="10000,100000", help="Comma separated numbers of channels"
+    )
+    parser.add_argument(
+        "--feeds-per-channel", type=int, default=3, help="Feeds a channel follows"
+    )
+    parser.add_argument(
+        "--channels-per-feed",
+        type=int,
+        default=30,
+        help="Average subscribers of a feed",
+    )
+    parser.add_argument("--entries", type=int, default=2, help="New entries per feed")
+    parser.add_argument(
+        "--latency", type=float, default=0.1, help="Median seconds of a request"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=DELIVERY_WORKERS, help="Delivery queue workers"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=DELIVERY_GLOBAL_RATE,
+        help="Delivery queue sends per second",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's output")
+    parser.add_argument(
+        "--save", action="store_true", help="Replace the baseline with these results"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Fraction a makespan, lag or run time may grow by before it is a regression",
+    )
+    parser.set_defaults(run=run)
@@ -0,0 +1,566 @@
+"""An in-memory stand-in for the motor client
+
+Runs the queries and writes the poll cycle, the outboxes and migrate make, so a
+benchmark can run without a mongod. Unique indexes are enforced the way the
+dedup keys rely on. Every call is counted in MemoryClient.ops by call site
+(collection.command), the same labels utils/metrics.py uses for a real server.
+
+Only the query and update operators used by feed_bot are supported. Anything else
+raises NotImplementedError rather than returning a wrong result.
+"""
+
+import copy
+from collections import Counter, deque
+from types import SimpleNamespace
+from typing import Any, Deque, Dict, List, Tuple
+from bson import ObjectId
+from pymongo import DeleteMany, DeleteOne, InsertOne, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+MISSING = object()
+
+
+def get_field(doc: dict, path: str) -> Any:
+    value = doc
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return MISSING
+        value = value[part]
+    return value
+
+
+def compare(value: Any, op: str, arg: Any) -> bool:
+    if value is MISSING or value is None:
+        return False
+    try:
+        if op == "$lt":
+            return value < arg
+        if op == "$lte":
+            return value <= arg
+        if op == "$gt":
+            return value > arg
+        return value >= arg
+    except TypeError:
+        return False
+
+
+def equals(value: Any, arg: Any) -> bool:
+    if arg is None:
+        return value is MISSING or value is None
+    if isinstance(value, list) and not isinstance(arg, list):
+        return arg in value
+    return value == arg
+
+
+def contains(values: frozenset, value: Any) -> bool:
+    if value is MISSING:
+        value = None
+    if isinstance(value, list):
+        return any(contains(values, item) for item in value)
+    try:
+        return value in values
+    except TypeError:
+        return False
+
+
+def prepare(filter: dict | None) -> dict:
+    """Turns the $in lists of filter into sets, so matching a document is O(1)"""
+    prepared = {}
+    for key, condition in (filter or {}).items():
+        if key in ("$or", "$and"):
+            condition = [prepare(sub) for sub in condition]
+        elif isinstance(condition, dict) and isinstance(condition.get("$in"), list):
+            try:
+                condition = {**condition, "$in": frozenset(condition["$in"])}
+            except TypeError:
+                pass
+        prepared[key] = condition
+    return prepared
+
+
+def matches_condition(value: Any, condition: Any) -> bool:
+    if not (
+        isinstance(condition, dict)
+        and condition
+        and next(iter(condition)).startswith("$")
+    ):
+        return equals(value, condition)
+    for op, arg in condition.items():
+        if op == "$exists":
+            ok = (value is not MISSING) == bool(arg)
+        elif op == "$eq":
+            ok = equals(value, arg)
+        elif op == "$ne":
+            ok = not equals(value, arg)
+        elif op == "$in" and isinstance(arg, frozenset):
+            ok = contains(arg, value)
+        elif op == "$in":
+            ok = any(equals(value, item) for item in arg)
+        elif op == "$nin":
+            ok = not any(equals(value, item) for item in arg)
+        elif op in ("$lt", "$lte", "$gt", "$gte"):
+            ok = compare(value, op, arg)
+        else:
+            raise NotImplementedError(f"Query operator {op}")
+        if not ok:
+            return False
+    return True
+
+
+def matches(doc: dict, filter: dict | None) -> bool:
+    for key, condition in (filter or {}).items():
+        if key == "$or":
+            if not any(matches(doc, sub) for sub in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, sub) for sub in condition):
+                return False
+        elif key.startswith("$"):
+            raise NotImplementedError(f"Query operator {key}")
+        elif not matches_condition(get_field(doc, key), condition):
+            return False
+    return True
+
+
+def project(doc: dict, projection) -> dict:
+    if not projection:
+        return copy.deepcopy(doc)
+    if not isinstance(projection, dict):
+        projection = {field: 1 for field in projection}
+    include = {k for k, v in projection.items() if v and k != "_id"}
+    if include:
+        fields = include | ({"_id"} if projection.get("_id", 1) else set())
+        return {k: copy.deepcopy(v) for k, v in doc.items() if k in fields}
+    exclude = {k for k, v in projection.items() if not v}
+    return {k: copy.deepcopy(v) for k, v in doc.items() if k not in exclude}
+
+
+def sort_documents(docs: List[dict], sort) -> List[dict]:
+    if isinstance(sort, str):
+        sort = [(sort, 1)]
+    for key, direction in reversed(list(sort or [])):
+        docs.sort(
+            key=lambda doc: (
+                (value := get_field(doc, key)) is not MISSING and value is not None,
+                value if value is not MISSING and value is not None else 0,
+            ),
+            reverse=direction < 0,
+        )
+    return docs
+
+
+def filter_fields(filter: dict) -> dict:
+    """The equality fields of a filter, which an upsert inserts"""
+    return {
+        key: value
+        for key, value in filter.items()
+        if not key.startswith("$")
+        and not (
+            isinstance(value, dict) and value and next(iter(value)).startswith("$")
+        )
+    }
+
+
+def apply_update(doc: dict, update, inserting: bool) -> None:
+    if isinstance(update, list):
+        raise NotImplementedError("Update pipelines")
+    for op, fields in update.items():
+        for key, value in fields.items():
+            current = doc.get(key, MISSING)
+            if op == "$set" or (op == "$setOnInsert" and inserting):
+                doc[key] = copy.deepcopy(value)
+            elif op == "$setOnInsert":
+                continue
+            elif op == "$unset":
+                doc.pop(key, None)
+            elif op == "$inc":
+                doc[key] = (0 if current is MISSING else current) + value
+            elif op == "$max":
+                if current is MISSING or current is None or value > current:
+                    doc[key] = value
+            elif op == "$min":
+                if current is MISSING or current is None or value < current:
+                    doc[key] = value
+            else:
+                raise NotImplementedError(f"Update operator {op}")
+
+
+class MemoryCursor:
+    """Returns the documents of a find or aggregate in batches, like a motor cursor"""
+
+    def __init__(self, collection: "MemoryCollection", command: str, load):
+        self.collection = collection
+        self.command = command
+        self.load = load
+        self.documents: List[dict] | None = None
+        self.sort_spec = None
+        self.limit_count = 0
+        self.size = 0
+        self.buffer: Deque[dict] = deque()
+
+    def sort(self, key, direction: int | None = None) -> "MemoryCursor":
+        self.sort_spec = [(key, direction or 1)] if isinstance(key, str) else key
+        return self
+
+    def limit(self, count: int) -> "MemoryCursor":
+        self.limit_count = count
+        return self
+
+    def batch_size(self, size: int) -> "MemoryCursor":
+        self.size = size
+        return self
+
+    def fetch(self, length: int | None) -> List[dict]:
+        if self.documents is None:
+            self.collection.count(self.command)
+            documents = sort_documents(self.load(), self.sort_spec)
+            self.documents = documents[: self.limit_count or None]
+        elif self.documents:
+            self.collection.count("getMore")
+        batch = self.documents[:length] if length else self.documents
+        self.documents = self.documents[len(batch) :]
+        return batch
+
+    async def to_list(self, length: int | None = None) -> List[dict]:
+        return self.fetch(length)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict:
+        if not self.buffer:
+            self.buffer.extend(self.fetch(self.size or None))
+            if not self.buffer:
+                raise StopAsyncIteration
+        return self.buffer.popleft()
+
+
+class MemoryCollection:
+    """Documents by _id, with a hash index on the first field of every index
+
+    Queries that test one of those fields for equality or $in only match the
+    documents the index holds for the values, like an IXSCAN. Any other query scans
+    the collection.
+    """
+
+    def __init__(self, database: "MemoryDatabase", name: str):
+        self.database = database
+        self.name = name
+        self.documents: Dict[Any, dict] = {}
+        # index name -> (keys, partialFilterExpression, key values -> _id)
+        self.unique: Dict[str, Tuple[List[str], dict | None, Dict[tuple, Any]]] = {}
+        # field -> value -> _ids, the documents whose value can not be hashed are
+        # kept under MISSING and always considered
+        self.fields: Dict[str, Dict[Any, set]] = {}
+
+    def count(self, command: str) -> None:
+        self.database.client.ops[f"{self.name}.{command}"] += 1
+
+    # Indexes
+
+    async def create_indexes(self, models) -> List[str]:
+        self.count("createIndexes")
+        names = []
+        for model in models:
+            document = model.document
+            keys = list(document["key"])
+            if keys[0] not in self.fields:
+                self.fields[keys[0]] = {}
+                for doc in self.documents.values():
+                    self.index_field(keys[0], doc)
+            if document.get("unique"):
+                values = {}
+                self.unique[document["name"]] = (
+                    keys,
+                    document.get("partialFilterExpression"),
+                    values,
+                )
+                for doc in self.documents.values():
+                    if key := self.unique_key(document["name"], doc):
+                        values[key] = doc["_id"]
+            names.append(document["name"])
+        return names
+
+    async def drop_index(self, name: str) -> None:
+        self.count("dropIndexes")
+        self.unique.pop(name, None)
+
+    def unique_key(self, name: str, doc: dict) -> tuple | None:
+        keys, partial, _ = self.unique[name]
+        if partial and not matches(doc, partial):
+            return None
+        return tuple(
+            None if (value := get_field(doc, key)) is MISSING else value for key in keys
+        )
+
+    def index_field(self, field: str, doc: dict, remove: bool = False) -> None:
+        value = get_field(doc, field)
+        value = None if value is MISSING else value
+        try:
+            hash(value)
+        except TypeError:
+            value = MISSING
+        ids = self.fields[field].setdefault(value, set())
+        if remove:
+            ids.discard(doc["_id"])
+        else:
+            ids.add(doc["_id"])
+
+    def store(self, doc: dict) -> None:
+        """Adds doc, or replaces the document with its _id, and indexes it"""
+        if old := self.documents.get(doc["_id"]):
+            self.unstore(old)
+        self.documents[doc["_id"]] = doc
+        for field in self.fields:
+            self.index_field(field, doc)
+        for name, (_, _, values) in self.unique.items():
+            if key := self.unique_key(name, doc):
+                values[key] = doc["_id"]
+
+    def unstore(self, doc: dict) -> None:
+        del self.documents[doc["_id"]]
+        for field in self.fields:
+            self.index_field(field, doc, remove=True)
+        for name, (_, _, values) in self.unique.items():
+            if (key := self.unique_key(name, doc)) and values.get(key) == doc["_id"]:
+                del values[key]
+
+    def duplicate(self, doc: dict, ignore_id=MISSING) -> str | None:
+        """Returns the name of the unique index doc violates, if any"""
+        if doc["_id"] in self.documents and doc["_id"] != ignore_id:
+            return "_id_"
+        for name, (_, _, values) in self.unique.items():
+            key = self.unique_key(name, doc)
+            if key and values.get(key, ignore_id) != ignore_id:
+                return name
+        return None
+
+    def candidates(self, filter: dict | None) -> List[dict]:
+        """The documents that may match filter, see the class docstring"""
+        for field, condition in (filter or {}).items():
+            if field != "_id" and field not in self.fields:
+                continue
+            if isinstance(condition, dict) and condition:
+                if "$in" not in condition:
+                    continue
+                values = condition["$in"]
+            else:
+                values = [condition]
+            try:
+                values = set(values)
+            except TypeError:
+                continue
+            if field == "_id":
+                return [self.documents[v] for v in values if v in self.documents]
+            index = self.fields[field]
+            ids = set(index.get(MISSING, ()))
+            for value in values:
+                ids.update(index.get(value, ()))
+            return [self.documents[id] for id in ids]
+        return list(self.documents.values())
+
+    def select(self, filter: dict | None) -> List[dict]:
+        filter = prepare(filter)
+        return [doc for doc in self.candidates(filter) if matches(doc, filter)]
+
+    # Reads
+
+    def find(self, filter: dict | None = None, projection=None, sort=None, limit=0):
+        cursor = MemoryCursor(
+            self,
+            "find",
+            lambda: [project(doc, projection) for doc in self.select(filter)],
+        )
+        return cursor.sort(sort).limit(limit) if sort else cursor.limit(limit)
+
+    async def find_one(self, filter: dict | None = None, projection=None, **kwargs):
+        documents = await self.find(filter, projection, **kwargs).to_list(1)
+        return documents[0] if documents else None
+
+    async def count_documents(self, filter: dict) -> int:
+        self.count("count")
+        return len(self.select(filter))
+
+    async def distinct(self, key: str, filter: dict | None = None) -> list:
+        self.count("distinct")
+        values = []
+        for doc in self.select(filter):
+            value = get_field(doc, key)
+            if value is not MISSING and value not in values:
+                values.append(value)
+        return values
+
+    def aggregate(self, pipeline: List[dict]) -> MemoryCursor:
+        def run() -> List[dict]:
+            documents = list(self.documents.values())
+            for index, stage in enumerate(pipeline):
+                [(name, spec)] = stage.items()
+                if name == "$match" and index == 0:
+                    documents = self.select(spec)
+                elif name == "$match":
+                    documents = [doc for doc in documents if matches(doc, spec)]
+                elif name == "$group" and list(spec) == ["_id"]:
+                    groups = {}
+                    for doc in documents:
+                        value = get_field(doc, spec["_id"].lstrip("$"))
+                        value = None if value is MISSING else value
+                        groups.setdefault(repr(value), {"_id": value})
+                    documents = list(groups.values())
+                elif name == "$limit":
+                    documents = documents[:spec]
+                else:
+                    raise NotImplementedError(f"Aggregation stage {name}")
+            return copy.deepcopy(documents)
+
+        return MemoryCursor(self, "aggregate", run)
+
+    # Writes
+
+    def insert(self, doc: dict) -> Any:
+        doc.setdefault("_id", ObjectId())
+        stored = copy.deepcopy(doc)
+        if index := self.duplicate(stored):
+            raise DuplicateKeyError(
+                f"E11000 duplicate key error collection: {self.name} index: {index}",
+                11000,
+            )
+        self.store(stored)
+        return stored["_id"]
+
+    def update(self, filter: dict, update, upsert: bool, multi: bool):
+        matched = self.select(filter)
+        if not multi:
+            matched = matched[:1]
+        for doc in matched:
+            updated = copy.deepcopy(doc)
+            apply_update(updated, update, inserting=False)
+            if index := self.duplicate(updated, ignore_id=doc["_id"]):
+                raise DuplicateKeyError(f"E11000 duplicate key index: {index}", 11000)
+            self.store(updated)
+        upserted_id = None
+        if not matched and upsert:
+            doc = copy.deepcopy(filter_fields(filter))
+            apply_update(doc, update, inserting=True)
+            upserted_id = self.insert(doc)
+        return SimpleNamespace(
+            matched_count=len(matched),
+            modified_count=len(matched),
+            upserted_id=upserted_id,
+        )
+
+    async def insert_one(self, document: dict):
+        self.count("insert")
+        return SimpleNamespace(inserted_id=self.insert(document))
+
+    async def insert_many(self, documents: List[dict], ordered: bool = True):
+        self.count("insert")
+        inserted_ids, write_errors = [], []
+        for index, document in enumerate(documents):
+            try:
+                inserted_ids.append(self.insert(document))
+            except DuplicateKeyError as e:
+                write_errors.append({"index": index, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+        if write_errors:
+            raise BulkWriteError(
+                {"writeErrors": write_errors, "nInserted": len(inserted_ids)}
+            )
+        return SimpleNamespace(inserted_ids=inserted_ids)
+
+    async def update_one(self, filter: dict, update, upsert: bool = False):
+        self.count("update")
+        return self.update(filter, update, upsert, multi=False)
+
+    async def update_many(self, filter: dict, update, upsert: bool = False):
+        self.count("update")
+        return self.update(filter, update, upsert, multi=True)
+
+    async def find_one_and_update(
+        self, filter: dict, update, projection=None, upsert: bool = False, **kwargs
+    ):
+        self.count("findAndModify")
+        before = next(iter(self.select(filter)), None)
+        self.update(filter, update, upsert, multi=False)
+        return project(before, projection) if before else None
+
+    async def delete_one(self, filter: dict):
+        self.count("delete")
+        return self.delete(filter, multi=False)
+
+    async def delete_many(self, filter: dict):
+        self.count("delete")
+        return self.delete(filter, multi=True)
+
+    def delete(self, filter: dict, multi: bool):
+        documents = self.select(filter)
+        documents = documents if multi else documents[:1]
+        for doc in documents:
+            self.unstore(doc)
+        return SimpleNamespace(deleted_count=len(documents))
+
+    async def bulk_write(self, requests: list, ordered: bool = True):
+        """Runs requests as one command, like a batch of the same kind of write"""
+        self.count(
+            "update"
+            if requests and isinstance(requests[0], (UpdateOne, UpdateMany))
+            else "bulkWrite"
+        )
+        write_errors = []
+        modified = 0
+        for index, request in enumerate(requests):
+            try:
+                if isinstance(request, (UpdateOne, UpdateMany)):
+                    modified += self.update(
+                        request._filter,
+                        request._doc,
+                        bool(request._upsert),
+                        multi=isinstance(request, UpdateMany),
+                    ).modified_count
+                elif isinstance(request, InsertOne):
+                    self.insert(request._doc)
+                elif isinstance(request, (DeleteOne, DeleteMany)):
+                    self.delete(request._filter, multi=isinstance(request, DeleteMany))
+                else:
+                    raise NotImplementedError(f"Bulk write {type(request).__name__}")
+            except DuplicateKeyError as e:
+                write_errors.append({"index": index, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+        if write_errors:
+            raise BulkWriteError({"writeErrors": write_errors})
+        return SimpleNamespace(bulk_api_result={}, modified_count=modified)
+
+
+class MemoryDatabase:
+    def __init__(self, client: "MemoryClient", name: str):
+        self.client = client
+        self.name = name
+        self.collections: Dict[str, MemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(self, name)
+        return self.collections[name]
+
+    async def list_collection_names(self) -> List[str]:
+        return [name for name, c in self.collections.items() if c.documents]
+
+
+class MemoryClient:
+    """Stands in for motor_asyncio.AsyncIOMotorClient"""
+
+    def __init__(self):
+        self.databases: Dict[str, MemoryDatabase] = {}
+        self.ops: Counter = Counter()
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        if name not in self.databases:
+            self.databases[name] = MemoryDatabase(self, name)
+        return self.databases[name]
+
+    async def drop_database(self, name: str) -> None:
+        self.databases.pop(name, None)
+
+    def close(self) -> None:
+        pass
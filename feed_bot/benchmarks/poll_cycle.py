@@ -0,0 +1,322 @@
+"""End-to-end poll cycle benchmark
+
+    $ poetry run benchmark poll-cycle --scales 10,1000,10000
+
+For every scale (number of feeds) a FeedBot polls a synthetic corpus (corpus.py)
+served from a local HTTP server, reads and writes an in-memory database
+(memory_db.py) or a local mongod with --mongodb-uri, and sends to a recording sink
+in place of channel_send. Each scale runs three phases:
+
+- cold: every entry and submission is new, stored and delivered
+- not_modified: nothing changed, every feed answers 304 Not Modified
+- one_new: every feed and subreddit has one new entry
+
+A phase runs update_all_rss_feeds, then pull_subreddit and post_subreddit, and waits
+for the delivery queue to drain. Its wall time, database operations by call site,
+bytes fetched and messages delivered are reported with the process's peak RSS. Each
+scale runs in a process of its own so peak RSS is not carried over.
+
+The results are compared to the JSON baseline in baselines/ and --save replaces it,
+see baselines.py.
+"""
+
+import os
+import time
+import asyncio
+import aiohttp
+import argparse
+import platform
+import resource
+import contextlib
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+from motor import motor_asyncio
+from pymongo import monitoring
+
+from ..bot import FeedBot
+from ..migrations import migrate
+from ..utils.delivery import DeliveryQueue
+from ..utils.metrics import command_site
+from ..utils.streaming import MONGO_BATCH_SIZE
+from ..utils.workers import shutdown_executor
+from .baselines import compare, load_baseline, save_baseline
+from .corpus import SyntheticReddit, start_corpus
+from .memory_db import MemoryClient
+
+BENCHMARK_DATABASE = "feed_bot_benchmark"
+PHASES = ("cold", "not_modified", "one_new")
+
+
+class BenchmarkBot(FeedBot):
+    """A FeedBot on a scratch database that is never connected to discord"""
+
+    database_name = BENCHMARK_DATABASE
+
+
+class OperationCounter(monitoring.CommandListener):
+    """Counts the commands sent to a real server by call site"""
+
+    def __init__(self):
+        self.ops: Counter = Counter()
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        self.ops[command_site(event)] += 1
+
+    def succeeded(self, event) -> None:
+        pass
+
+    def failed(self, event) -> None:
+        pass
+
+
+class RecordingSink:
+    """Takes the place of FeedBot.channel_send, serializes messages like discord.py"""
+
+    def __init__(self):
+        self.messages = 0
+        self.embeds = 0
+        self.channels = set()
+
+    async def send(self, channel_id: int, *args, **kwargs) -> None:
+        embeds = list(kwargs.get("embeds") or [])
+        if embed := kwargs.get("embed"):
+            embeds.append(embed)
+        for embed in embeds:
+            embed.to_dict()
+        self.messages += 1
+        self.embeds += len(embeds)
+        self.channels.add(channel_id)
+
+    def snapshot(self) -> Dict[str, int]:
+        return {"messages": self.messages, "embeds": self.embeds}
+
+
+def subscriptions(
+    feed_urls: List[str], subreddits: List[str], channels: int
+) -> List[dict]:
+    """channels subscriptions per feed and subreddit
+
+    Channels are shared so that each one subscribes to about four feeds or
+    subreddits, as in a guild that follows a handful of sources.
+    """
+    sources = [("feed_url", url) for url in feed_urls] + [
+        ("subreddit", name) for name in subreddits
+    ]
+    pool = max(channels, len(sources) * channels // 4)
+    return [
+        {"channel_id": 1 + (number * channels + k) % pool, key: value}
+        for number, (key, value) in enumerate(sources)
+        for k in range(channels)
+    ]
+
+
+def difference(after: dict, before: dict) -> dict:
+    return {
+        key: after[key] - before.get(key, 0)
+        for key in after
+        if after[key] - before.get(key, 0)
+    }
+
+
+async def run_poll_cycle(
+    feeds: int,
+    entries: int = 20,
+    channels: int = 2,
+    subreddits: int | None = None,
+    submissions: int = 20,
+    mongodb_uri: str | None = None,
+    quiet: bool = True,
+) -> dict:
+    """Runs the phases against feeds feeds and returns their measurements
+
+    Args:
+        feeds (int): Feeds in the corpus
+        entries (int, optional): Entries per feed. Defaults to 20.
+        channels (int, optional): Channels subscribed to each feed and subreddit.
+            Defaults to 2.
+        subreddits (int | None, optional): Defaults to one per ten feeds
+        submissions (int, optional): Submissions per subreddit. Defaults to 20.
+        mongodb_uri (str | None, optional): A mongod to use in place of the in-memory
+            database. Its feed_bot_benchmark database is dropped.
+        quiet (bool, optional): Discard what the bot prints. Defaults to True.
+    """
+    subreddits = max(feeds // 10, 1) if subreddits is None else subreddits
+    process, base_url = start_corpus(feeds, entries)
+    if mongodb_uri:
+        counter = OperationCounter()
+        db_client = motor_asyncio.AsyncIOMotorClient(
+            mongodb_uri, event_listeners=[counter]
+        )
+        ops = counter.ops
+        await db_client.drop_database(BENCHMARK_DATABASE)
+    else:
+        db_client = MemoryClient()
+        ops = db_client.ops
+    bot = BenchmarkBot(db_client=db_client)
+    sink = RecordingSink()
+    bot.delivery = DeliveryQueue(send=sink.send, rate=0)
+    bot.http_session = aiohttp.ClientSession()
+    bot.reddit_client = SyntheticReddit(submissions)
+    results = {}
+    try:
+        await migrate(bot.db)
+        feed_urls = [f"{base_url}/feeds/{number}.xml" for number in range(feeds)]
+        names = [f"sub{number}" for number in range(subreddits)]
+        documents = subscriptions(feed_urls, names, channels)
+        for start in range(0, len(documents), MONGO_BATCH_SIZE):
+            await bot.subscriptions_collection.insert_many(
+                documents[start : start + MONGO_BATCH_SIZE]
+            )
+        await bot.subscription_index.load(bot.subscriptions_collection)
+        bot.delivery.start()
+        output = open(os.devnull, "w") if quiet else contextlib.nullcontext()
+        with output as devnull:
+            for phase in PHASES:
+                if phase == "one_new":
+                    async with bot.http_session.post(f"{base_url}/publish"):
+                        pass
+                    bot.reddit_client.publish()
+                results[phase] = await run_phase(bot, sink, ops, base_url, devnull)
+        results["peak_rss_bytes"] = (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        )
+        results["subscriptions"] = len(documents)
+        results["channels"] = len(sink.channels)
+    finally:
+        bot.delivery.stop()
+        shutdown_executor()
+        await bot.http_session.close()
+        process.terminate()
+        if mongodb_uri:
+            await db_client.drop_database(BENCHMARK_DATABASE)
+    return results
+
+
+async def run_phase(
+    bot: BenchmarkBot, sink: RecordingSink, ops: Counter, base_url: str, output
+) -> dict:
+    async def corpus_stats() -> dict:
+        async with bot.http_session.get(f"{base_url}/stats") as response:
+            return await response.json()
+
+    ops_before = dict(ops)
+    stats_before = await corpus_stats()
+    sent_before = sink.snapshot()
+    redirect = (
+        contextlib.redirect_stdout(output) if output else contextlib.nullcontext()
+    )
+    with redirect:
+        started = time.perf_counter()
+        await bot.update_all_rss_feeds()
+        rss_done = time.perf_counter()
+        await bot.pull_subreddit()
+        await bot.post_subreddit()
+        reddit_done = time.perf_counter()
+        await bot.delivery.join()
+        finished = time.perf_counter()
+    mongo_ops = difference(dict(ops), ops_before)
+    fetched = difference(await corpus_stats(), stats_before)
+    return {
+        "wall_seconds": round(finished - started, 3),
+        "rss_seconds": round(rss_done - started, 3),
+        "reddit_seconds": round(reddit_done - rss_done, 3),
+        "delivery_drain_seconds": round(finished - reddit_done, 3),
+        "mongo_ops": sum(mongo_ops.values()),
+        "mongo_ops_by_site": dict(sorted(mongo_ops.items())),
+        "feed_requests": fetched.get("requests", 0),
+        "feeds_not_modified": fetched.get("not_modified", 0),
+        "bytes_fetched": fetched.get("bytes", 0),
+        **difference(sink.snapshot(), sent_before),
+    }
+
+
+def run_scale(kwargs: dict) -> dict:
+    return asyncio.run(run_poll_cycle(**kwargs))
+
+
+def run(args: argparse.Namespace) -> int:
+    config = {
+        "entries": args.entries,
+        "channels": args.channels,
+        "submissions": args.submissions,
+        "database": "mongod" if args.mongodb_uri else "memory",
+    }
+    results = {}
+    for feeds in [int(scale) for scale in args.scales.split(",")]:
+        print(f"Benchmarking a poll cycle of {feeds} feeds")
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results[str(feeds)] = executor.submit(
+                run_scale,
+                dict(
+                    feeds=feeds,
+                    entries=args.entries,
+                    channels=args.channels,
+                    submissions=args.submissions,
+                    mongodb_uri=args.mongodb_uri,
+                    quiet=not args.verbose,
+                ),
+            ).result()
+        for phase in PHASES:
+            phase_results = results[str(feeds)][phase]
+            print(
+                f"  {phase}: {phase_results['wall_seconds']}s, "
+                f"{phase_results['mongo_ops']} mongo ops, "
+                f"{phase_results['bytes_fetched']} bytes fetched, "
+                f"{phase_results.get('messages', 0)} messages"
+            )
+        print(f"  peak rss: {results[str(feeds)]['peak_rss_bytes']} bytes")
+    report = {
+        "config": config,
+        "environment": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "worker_pool": os.getenv("WORKER_POOL", "process"),
+        },
+        "results": results,
+    }
+    name = f"poll_cycle_{config['database']}"
+    if args.save:
+        path = save_baseline(name, report)
+        print(f"Baseline saved to {path}")
+        return 0
+    baseline = load_baseline(name)
+    if baseline is None:
+        print(f"No baseline {name} to compare with, run with --save to create it")
+        return 0
+    if baseline["config"] != config:
+        print(f"The baseline was recorded with {baseline['config']}, not {config}")
+    return 1 if compare(baseline["results"], results, args.tolerance) else 0
+
+
+def add_parser(subparsers) -> None:
+    parser = subparsers.add_parser(
+        "poll-cycle", help="End-to-end poll cycles at several scales"
+    )
+    parser.add_argument(
+        "--scales", default="10,1000,10000", help="Comma separated numbers of feeds"
+    )
+    parser.add_argument("--entries", type=int, default=20, help="Entries per feed")
+    parser.add_argument(
+        "--channels", type=int, default=2, help="Channels subscribed to each source"
+    )
+    parser.add_argument(
+        "--submissions", type=int, default=20, help="Submissions per subreddit"
+    )
+    parser.add_argument(
+        "--mongodb-uri", help="Use a local mongod instead of the in-memory database"
+    )
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's output")
+    parser.add_argument(
+        "--save", action="store_true", help="Replace the baseline with these results"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Fraction a timing or peak RSS may grow by before it is a regression",
+    )
+    parser.set_defaults(run=run)
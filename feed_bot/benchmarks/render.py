@@ -0,0 +1,242 @@
+"""Microbenchmarks and golden outputs of embed rendering
+
+    $ poetry run benchmark render --rounds 20
+
+RSSFeed.parse_entry_flat, RSSFeed.create_entry_embed, RSSFeed.create_about_embed
+and Reddit.documents_to_embeds run for every entry and listing a poll delivers. They
+are measured against the recorded corpus in feeds/: feeds in the shape WordPress,
+Substack, a podcast host, YouTube and a plain Atom blog publish them, and stored
+reddit listings.
+
+Like pytest-benchmark, each function is warmed up once and then timed over rounds of
+passes of the whole corpus. The fastest round gives entries_per_second, the slower
+ones are noise from the rest of the machine. A separate pass under tracemalloc gives
+the peak and the retained bytes allocated per entry. The render cache is cleared
+before every pass, so every embed is built.
+
+golden/ holds the embeds the corpus renders to, see test_render.py. A faster
+implementation must render them unchanged. Rewrite them with --save-golden only
+when a change to the output is intended, and review their diff.
+"""
+
+import gc
+import json
+import math
+import time
+import argparse
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from ..utils.reddit import Reddit
+from ..utils.render_cache import render_cache
+from ..utils.rss import RSSFeed, parse_feed
+from .baselines import compare, load_baseline, save_baseline
+
+CORPUS_DIR = Path(__file__).parent / "feeds"
+GOLDEN_DIR = Path(__file__).parent / "golden"
+
+# IMAGES_URL of the reddit embeds in the golden outputs, the environment's is ignored
+GOLDEN_IMAGES_URL = "https://images.example.com"
+
+# Shortest timed round, see measure
+MIN_ROUND_SECONDS = 0.01
+
+
+def load_feeds() -> Dict[str, dict]:
+    """Parses every feed of the corpus
+
+    Returns:
+        Dict[str, dict]: Feed name -> {"feed": ..., "entries": [...]}. The entries
+        have feed_url and thumbnail set from the feed, as stored by the poller.
+    """
+    feeds = {}
+    for path in sorted(CORPUS_DIR.glob("*.xml")):
+        feed_data = parse_feed(path.read_bytes())
+        feed = feed_data["feed"]
+        feed_flat = RSSFeed.parse_feed_flat(feed)
+        feed_url, thumbnail = feed_flat[0], feed_flat[-1]
+        feeds[path.stem] = {
+            "feed": feed,
+            "entries": [
+                {"feed_url": feed_url, "thumbnail": thumbnail, **entry}
+                for entry in feed_data["entries"]
+            ],
+        }
+    return feeds
+
+
+def load_listings() -> List[dict]:
+    """Returns the stored reddit listings of the corpus"""
+    return json.loads((CORPUS_DIR / "reddit.json").read_text())
+
+
+def reddit_renderer() -> Reddit:
+    reddit = Reddit()
+    reddit.IMAGES_URL = GOLDEN_IMAGES_URL
+    return reddit
+
+
+def render_feed(feed: dict) -> dict:
+    """Renders the about embed and the entry embeds of a load_feeds feed"""
+    rss = RSSFeed()
+    render_cache.clear()
+    return {
+        "about": rss.create_about_embed(feed["feed"]).to_dict(),
+        "entries": [
+            rss.create_entry_embed(entry).to_dict() for entry in feed["entries"]
+        ],
+    }
+
+
+def render_listings(listings: List[dict]) -> List[dict]:
+    return [
+        {"channel_id": channel_id, "embed": embed.to_dict(), "_id": object_id}
+        for channel_id, embed, object_id in reddit_renderer().documents_to_embeds(
+            listings
+        )
+    ]
+
+
+def render_corpus() -> Dict[str, dict | list]:
+    """Returns the golden output of every feed and of the reddit listings"""
+    rendered = {name: render_feed(feed) for name, feed in load_feeds().items()}
+    rendered["reddit"] = render_listings(load_listings())
+    return rendered
+
+
+def load_golden(name: str) -> dict | list:
+    return json.loads((GOLDEN_DIR / f"{name}.json").read_text())
+
+
+def save_golden() -> List[Path]:
+    GOLDEN_DIR.mkdir(exist_ok=True)
+    paths = []
+    for name, rendered in render_corpus().items():
+        path = GOLDEN_DIR / f"{name}.json"
+        path.write_text(
+            json.dumps(rendered, indent=2, sort_keys=True, ensure_ascii=False) + "\n"
+        )
+        paths.append(path)
+    return paths
+
+
+def cases() -> Dict[str, tuple[Callable[[], object], int]]:
+    """The functions to measure
+
+    Returns:
+        Dict[str, tuple[Callable[[], object], int]]: Name -> (a pass over the corpus,
+        the number of entries, feeds or listings it renders)
+    """
+    feeds = load_feeds()
+    entries = [entry for feed in feeds.values() for entry in feed["entries"]]
+    listings = load_listings()
+    rss = RSSFeed()
+    reddit = reddit_renderer()
+
+    def parse_entry_flat():
+        return [RSSFeed.parse_entry_flat(entry) for entry in entries]
+
+    def create_entry_embed():
+        render_cache.clear()
+        return [rss.create_entry_embed(entry) for entry in entries]
+
+    def create_about_embed():
+        render_cache.clear()
+        return [rss.create_about_embed(feed["feed"]) for feed in feeds.values()]
+
+    def documents_to_embeds():
+        return reddit.documents_to_embeds(listings)
+
+    return {
+        "parse_entry_flat": (parse_entry_flat, len(entries)),
+        "create_entry_embed": (create_entry_embed, len(entries)),
+        "create_about_embed": (create_about_embed, len(feeds)),
+        "documents_to_embeds": (documents_to_embeds, len(listings)),
+    }
+
+
+def measure(run: Callable[[], object], entries: int, rounds: int) -> dict:
+    """Times rounds rounds of run after a warm up, then traces one pass's allocations
+
+    A round repeats run until it takes at least MIN_ROUND_SECONDS, so the timings of
+    the quick functions are not timer noise. Timings are per pass.
+
+    Args:
+        run (Callable[[], object]): A pass over the corpus
+        entries (int): Entries rendered by a pass
+        rounds (int): Timed rounds
+    """
+    started = time.perf_counter()
+    run()
+    warm_up = time.perf_counter() - started
+    iterations = max(1, math.ceil(MIN_ROUND_SECONDS / max(warm_up, 1e-9)))
+    timings = []
+    gc.collect()
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            run()
+        timings.append((time.perf_counter() - started) / iterations)
+    best = min(timings)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = run()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return {
+        "min_seconds": round(best, 7),
+        "entries_per_second": round(entries / best, 1),
+        "peak_bytes_per_entry": peak // entries,
+        "retained_bytes_per_entry": retained // entries,
+    }
+
+
+def run(args: argparse.Namespace) -> int:
+    if args.save_golden:
+        for path in save_golden():
+            print(f"Golden output saved to {path}")
+        return 0
+    results = {}
+    for name, (function, entries) in cases().items():
+        results[name] = measure(function, entries, args.rounds)
+        print(
+            f"{name}: {results[name]['entries_per_second']} per second, "
+            f"{results[name]['min_seconds'] * 1000:.2f}ms for {entries}, "
+            f"{results[name]['peak_bytes_per_entry']} peak bytes per entry"
+        )
+    report = {"config": {"rounds": args.rounds}, "results": results}
+    if args.save:
+        path = save_baseline("render", report)
+        print(f"Baseline saved to {path}")
+        return 0
+    baseline = load_baseline("render")
+    if baseline is None:
+        print("No baseline render to compare with, run with --save to create it")
+        return 0
+    return 1 if compare(baseline["results"], results, args.tolerance) else 0
+
+
+def add_parser(subparsers) -> None:
+    parser = subparsers.add_parser(
+        "render", help="Parse and embed rendering of the recorded corpus"
+    )
+    parser.add_argument("--rounds", type=int, default=20, help="Timed passes")
+    parser.add_argument(
+        "--save", action="store_true", help="Replace the baseline with these results"
+    )
+    parser.add_argument(
+        "--save-golden",
+        action="store_true",
+        help="Rewrite the golden outputs from the current implementation",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Fraction a measurement may get worse by before it is a regression",
+    )
+    parser.set_defaults(run=run)
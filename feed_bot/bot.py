@@ -11,83 +11,159 @@ Documentation:
     a .env file
 - Message Content Intent
             - Read More: https://discord.com/developers/docs/topics/gateway#message-content-intent
+- SHARD_COUNT and SHARD_IDS
+    - Optional. Run several processes against the same database, each connected to
+    the shards listed in SHARD_IDS (comma separated) out of SHARD_COUNT. Polling is
+    split between the processes with leases, see utils/leases.py. When unset the bot
+    connects to every shard discord recommends.
+- EXTERNAL_POLLERS
+    - Optional. Set to true when feeds and subreddits are polled by headless pollers
+    (`poetry run poller`, see poller.py), the bot then only sends messages. Defaults
+    to false
 """
 
 import os
-import time
+import asyncio
 import discord
-import aiohttp
-from typing import List, Set
-from datetime import datetime
-from motor import motor_asyncio
+from typing import Any, Dict, List, Tuple
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
 from discord.ext import commands, tasks
 
+from .poller import SCHEDULER_TICK, FeedPoller
+from .utils import metrics
 from .utils.reddit import Reddit
-from .utils.rss import RSSFeed
-from .utils.common import chunks
-from .cogs import FileCommands, RedditCommands, RSSFeedCommands
+from .utils.delivery import DeliveryQueue, delivery_kwargs, pack_embeds
+from .utils.outbox import Outbox
+from .utils.retention import compact
+from .utils.streaming import memory_ceiling
+from .migrations import migrate
+from .cogs import DebugCommands, FileCommands, RedditCommands, RSSFeedCommands
 
-
-LOOP_CYCLE = {"minutes": 60.0} if os.getenv("PROD_ENV", False) else {"minutes": 1.0}
 CALL_FOR_SUPPORT_LOOP_CYCLE = (
     {"hours": 12.0} if os.getenv("PROD_ENV", False) else {"hours": 1.0}
 )
+RETENTION_LOOP_CYCLE = (
+    {"hours": 24.0} if os.getenv("PROD_ENV", False) else {"hours": 1.0}
+)
+# Discord's error code for a channel that does not exist (anymore)
+UNKNOWN_CHANNEL = 10003
+
+SHARD_COUNT = int(os.getenv("SHARD_COUNT")) if os.getenv("SHARD_COUNT") else None
+SHARD_IDS = (
+    [int(shard_id) for shard_id in os.getenv("SHARD_IDS").split(",")]
+    if os.getenv("SHARD_IDS")
+    else None
+)
+EXTERNAL_POLLERS = os.getenv("EXTERNAL_POLLERS", "").lower() in ("1", "true", "yes")
 
 
-class FeedBot(commands.Bot):
-    """FeedBot Class Inherited from commands.Bot
+class FeedBot(FeedPoller, commands.AutoShardedBot):
+    """FeedBot Class Inherited from commands.AutoShardedBot
 
-    commands.Bot Documentation:
-        - https://discordpy.readthedocs.io/en/stable/ext/commands/api.html#bot
+    Polls feeds and subreddits in process unless EXTERNAL_POLLERS is set, see poller.py
+
+    commands.AutoShardedBot Documentation:
+        - https://discordpy.readthedocs.io/en/stable/ext/commands/api.html#autoshardedbot
 
     Requires:
         - Message Content Intent
             - Read More: https://discord.com/developers/docs/topics/gateway#message-content-intent
     """
 
-    database_name = "feed_bot_db"
-    reddit_collection_str = "reddit"
-    rss_collection_str = "rss"
-
-    def __init__(self):
+    def __init__(self, db_client=None):
         intents = discord.Intents.default()
         intents.message_content = True
-        super().__init__(
-            command_prefix=commands.when_mentioned_or("."), intents=intents
+        commands.AutoShardedBot.__init__(
+            self,
+            command_prefix=commands.when_mentioned_or("."),
+            intents=intents,
+            shard_count=SHARD_COUNT,
+            shard_ids=SHARD_IDS,
+        )
+        FeedPoller.__init__(self, db_client)
+        self.delivered_channels: Dict[int, datetime] = {}
+        self.delivery = DeliveryQueue(send=self.channel_send)
+        self.reddit_outbox = Outbox(
+            self.reddit_listings_collection,
+            owner=self.instance_id,
+            projection=[
+                "channel_id",
+                "subreddit",
+                "title",
+                "description",
+                "link",
+                "image",
+            ],
+        )
+        self.delivery_outbox = Outbox(
+            self.deliveries_collection,
+            owner=self.instance_id,
+            projection=["channel_id", "content", "embeds"],
+            sort=[("_id", 1)],
         )
-        mongodb_uri = os.getenv("MONGODB_URI")
-        self.db_client = motor_asyncio.AsyncIOMotorClient(mongodb_uri)
-        self.db = self.db_client[self.database_name]
-        self.reddit_collection = self.db[self.reddit_collection_str]
-        self.rss_collection = self.db[self.rss_collection_str]
-        self.http_session = None
 
     async def setup_hook(self):
         """A coroutine to be called to setup the bot.
 
         Overwritten method from commands.Bot
         """
-        self.http_session = aiohttp.ClientSession()
-        print(f"Task Loop Interval: {LOOP_CYCLE}")
-        self.subreddit_task.start()
-        self.rss_feeds_task.start()
+        await self.open_sessions()
+        self.loop_monitor.start()
+        self.delivery.start()
+        await migrate(self.db)
+        await self.subscription_index.start(self.subscriptions_collection)
+        if EXTERNAL_POLLERS:
+            print("Polling is left to headless pollers, see poller.py")
+        else:
+            self.start_polling()
+        self.reddit_outbox_task.start()
+        self.delivery_outbox_task.start()
+        self.delivery_state_task.start()
         self.post_call_for_support.start()
+        self.retention_task.start()
+        await self.add_cog(DebugCommands(self))
         await self.add_cog(FileCommands(self))
         await self.add_cog(RedditCommands(self))
         await self.add_cog(RSSFeedCommands(self))
 
+    async def close(self):
+        """Closes the bot along with the resources it opened in setup_hook.
+
+        Overwritten method from commands.Bot
+        """
+        self.loop_monitor.stop()
+        self.delivery.stop()
+        await self.stop_polling()
+        await super().close()
+
     async def on_ready(self):
         print(f"Logged in as {self.user} (ID: {self.user.id})")
+        print(f"Shards: {sorted(self.shards)} of {self.shard_count}")
         print("------")
 
+    async def invoke(self, ctx: commands.Context):
+        """Runs a command, timed by cog and command, see utils/metrics.py
+
+        Overwritten method from commands.Bot
+        """
+        with metrics.COMMAND_SECONDS.time(
+            cog=ctx.cog.qualified_name if ctx.cog else "",
+            command=ctx.command.qualified_name if ctx.command else "",
+        ):
+            await super().invoke(ctx)
+
+    async def run_once(self, job: str, loop_cycle: dict) -> bool:
+        """Whether this process runs job this cycle, see LeaseManager.acquire_job"""
+        return await self.leases.acquire_job(
+            job, seconds=timedelta(**loop_cycle).total_seconds()
+        )
+
     @tasks.loop(**CALL_FOR_SUPPORT_LOOP_CYCLE)
     async def post_call_for_support(self):
         """A scheduled task to notify users of where the source code for the project can be found."""
-        rss_channel_ids: List = await self.rss_collection.distinct("channel_id")
-        subreddit_channel_ids: List = await self.reddit_collection.distinct(
-            "channel_id"
-        )
-        channel_ids: Set = set(rss_channel_ids).union(set(subreddit_channel_ids))
+        if not await self.run_once("call_for_support", CALL_FOR_SUPPORT_LOOP_CYCLE):
+            return
         call_for_support_embed: discord.Embed = discord.Embed(
             title="Support Feed Bot: A Self-Hostable Open Source RSS Feed Reader",
             url="https://github.com/Audiosutras/feed_bot?tab=readme-ov-file#support-the-project",
@@ -107,218 +183,187 @@ class FeedBot(commands.Bot):
             url="https://d2ixboot0418ao.cloudfront.net/thankyou.jpg"
         )
 
-        for channel_id in list(channel_ids):
-            await self.channel_send(channel_id=channel_id, embed=call_for_support_embed)
+        with memory_ceiling("post_call_for_support"), metrics.TASK_SECONDS.time(
+            task="post_call_for_support"
+        ):
+            for channel_id in self.subscription_index.channel_ids():
+                await self.deliver(channel_id, embed=call_for_support_embed)
 
     @post_call_for_support.before_loop
     async def before_post_call_for_support(self):
         await self.wait_until_ready()  # wait until the bot logs in
 
-    async def channel_send(self, channel_id, *args, **kwargs):
-        channel = self.get_channel(channel_id)
-        if channel:
-            await channel.send(*args, **kwargs)
-        else:
-            print(f"Channel Removed: {channel_id}. Removing Related Entries from DB")
-            await self.reddit_collection.delete_many({"channel_id": channel_id})
-            await self.rss_collection.delete_many({"channel_id": channel_id})
+    @tasks.loop(**RETENTION_LOOP_CYCLE)
+    async def retention_task(self):
+        """Trims stored feed entries and sent listings, see utils/retention.py"""
+        if await self.run_once("retention", RETENTION_LOOP_CYCLE):
+            with metrics.TASK_SECONDS.time(task="retention"):
+                await compact(self.db)
 
-    async def reddit_find_one_or_insert_one_documents(self, dicts: [dict]):
-        """For each dictionary a document is created if a document matching the dictionary is not found.
+    async def deliver(self, channel_id: int, *args, **kwargs) -> asyncio.Future:
+        """Queues a message for channel_id, see utils/delivery.py
 
-        This is done to prevent duplicate documents from entering the database as tasks run.
+        Takes the same arguments as discord.abc.Messageable.send. Only waits when
+        the delivery queue is full.
 
-        Args:
-            collection: MongoDB collection name
-            filter: search dictionary to see if a matching document is within the database
-            dicts (dict]): List of dictionaries to become documents
+        Returns:
+            asyncio.Future: Resolves to True once sent or False once dropped
         """
+        return await self.delivery.enqueue(channel_id, *args, **kwargs)
 
-        inserted = []
-        for d in dicts:
-            doc = await self.reddit_collection.find_one(
-                {
-                    "channel_id": d.get("channel_id"),
-                    "subreddit": d.get("subreddit"),
-                    "title": d.get("title"),
-                    "description": d.get("description"),
-                    "sent": {"$exists": True},
-                }
-            )
-            if not doc:
-                result = await self.reddit_collection.insert_one(d)
-                inserted.append(result.inserted_id)
-        print(f"Of {len(dicts)} new listings {len(inserted)} have been added to db")
-
-    @tasks.loop(**LOOP_CYCLE)
-    async def subreddit_task(self, *args, **kwargs):
-        await self.pull_subreddit(*args, **kwargs)
-        await self.post_subreddit(*args, **kwargs)
-
-    @subreddit_task.before_loop
-    async def before_subreddit(self):
-        await self.wait_until_ready()  # wait until the bot logs in
+    async def channel_send(self, channel_id, *args, **kwargs):
+        """Sends a message to channel_id. Called by the delivery queue's workers
 
-    async def pull_subreddit(self):
-        """Fetches a channel's subreddit new listings and stores them in the database"""
-        pipeline = [
-            {
-                "$match": {
-                    "channel_id": {"$exists": True},
-                    "subreddit": {"$exists": True},
-                    "title": {"$exists": False},
-                    "description": {"$exists": False},
-                    "link": {"$exists": False},
-                    "sent": {"$exists": False},
-                }
-            },
-            {"$group": {"_id": "$channel_id", "subreddits": {"$push": "$subreddit"}}},
-        ]
-        cursor = self.reddit_collection.aggregate(pipeline)
-        documents = await cursor.to_list(None)
-        for doc in documents:
-            channel_id = doc.get("_id")
-            subreddits = doc.get("subreddits")
-            print(f"Channel ID: {channel_id}, Subreddits: {subreddits}")
-            r = Reddit(
-                session=self.http_session,
-                subreddit_names=subreddits,
-                channel_id=channel_id,
+        Channels on shards of other processes are not cached here, they are sent to
+        through the REST API all the same.
+        """
+        channel = self.get_channel(channel_id) or self.get_partial_messageable(
+            channel_id
+        )
+        try:
+            await channel.send(*args, **kwargs)
+            self.delivered_channels[channel_id] = datetime.now()
+        except discord.NotFound as e:
+            if e.code != UNKNOWN_CHANNEL:
+                raise
+            print(f"Channel Removed: {channel_id}. Removing Related Entries from DB")
+            await self.subscriptions_collection.delete_many({"channel_id": channel_id})
+            self.subscription_index.remove_channel(channel_id)
+            await self.reddit_listings_collection.delete_many(
+                {"channel_id": channel_id}
             )
-            await r.get_subreddit_submissions()
-            if r.error:
-                await self.channel_send(channel_id=channel_id, content=r.error_msg)
-            else:
-                await self.reddit_find_one_or_insert_one_documents(r.res_dicts)
+            await self.deliveries_collection.delete_many({"channel_id": channel_id})
+            await self.delivery_state_collection.delete_one({"_id": channel_id})
+
+    @tasks.loop(**SCHEDULER_TICK)
+    async def delivery_state_task(self):
+        """Reports the delivery queue depth and stores the delivery state"""
+        stats = self.delivery.stats()
+        if stats["pending"]:
+            print(f"Delivery queue: {stats}")
+        await self.save_delivery_state()
+
+    @delivery_state_task.before_loop
+    async def before_delivery_state_task(self):
+        await self.wait_until_ready()
 
-    async def post_subreddit(self):
-        """Returns new posts for a subreddit"""
-        cursor = self.reddit_collection.find({"sent": False})
-        unsent_documents = await cursor.to_list(None)
-        if unsent_documents:
-            r = Reddit()
-            channel_embeds = r.documents_to_embeds(documents=unsent_documents)
-            for channel_id, embed, doc_id in channel_embeds:
-                await self.channel_send(channel_id=channel_id, embeds=[embed])
-                await self.reddit_collection.update_one(
-                    filter={"_id": doc_id}, update={"$set": {"sent": True}}
+    async def save_delivery_state(self) -> None:
+        """Stores when each channel was last delivered to in the delivery_state collection"""
+        delivered_channels, self.delivered_channels = self.delivered_channels, {}
+        if not delivered_channels:
+            return
+        await self.delivery_state_collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": channel_id},
+                    {"$max": {"last_delivered_at": delivered_at}},
+                    upsert=True,
                 )
+                for channel_id, delivered_at in delivered_channels.items()
+            ],
+            ordered=False,
+        )
 
-    @tasks.loop(**LOOP_CYCLE)
-    async def rss_feeds_task(self, *args, **kwargs):
-        await self.update_all_rss_feeds(*args, **kwargs)
+    @tasks.loop(**SCHEDULER_TICK)
+    async def reddit_outbox_task(self):
+        await self.post_subreddit()
 
-    @rss_feeds_task.before_loop
-    async def before_rss_feeds_task(self):
+    @reddit_outbox_task.before_loop
+    async def before_reddit_outbox_task(self):
         await self.wait_until_ready()
 
-    async def update_all_rss_feeds(self) -> None:
-        """Sends RSS Feed Updates to subscribed channels.
+    async def post_subreddit(self):
+        """Sends unsent listings one claimed batch at a time, see utils/outbox.py
 
-        Gathers distinct feed_urls from the rss collection and checks if new entries have been added.
-        If entries have been added, channel_ids that subscribe to an updated rss feed receive the new
-        entries as an embed.
+        A batch is acknowledged once the delivery queue has sent it. Listings the
+        queue gave up on are acknowledged with dropped set so they are not retried.
+        """
+        r = Reddit()
+        with memory_ceiling("post_subreddit"), metrics.TASK_SECONDS.time(
+            task="post_subreddit"
+        ):
+            await self.post_subreddit_batches(r)
 
-        This definition is the core logic of the rss_feeds_task.
+    async def post_subreddit_batches(self, r: Reddit):
+        """Sends the listings of each claimed batch in as few messages per channel as fit
 
-        Returns:
-            None
+        See utils/delivery.pack_embeds
         """
-        rss = RSSFeed(session=self.http_session)
-        feed_urls: list = await self.rss_collection.distinct(key="feed_url")
-        await rss.parse_feed_urls(feed_urls=feed_urls)
-        if rss.error:
-            return print(f"An error occurred updating rss feeds: {rss.error_msg}")
-        for feed, entries in rss.res_dicts:
-            parsed_feed = rss.parse_feed_flat(feed)
-            feed_url = parsed_feed[0]
-            thumbnail = parsed_feed[-1]
-            inserted_entries = await self.find_one_rss_entry_or_insert(
-                feed_url=feed_url, thumbnail=thumbnail, entries=entries
+        while documents := await self.reddit_outbox.claim():
+            channel_listings: Dict[Any, Tuple[List[Any], List[discord.Embed]]] = {}
+            for channel_id, embed, doc_id in r.documents_to_embeds(documents=documents):
+                doc_ids, embeds = channel_listings.setdefault(channel_id, ([], []))
+                doc_ids.append(doc_id)
+                embeds.append(embed)
+            messages = []
+            for channel_id, (doc_ids, embeds) in channel_listings.items():
+                start = 0
+                for embed_batch in pack_embeds(embeds):
+                    end = start + len(embed_batch)
+                    messages.append(
+                        (doc_ids[start:end], channel_id, {"embeds": embed_batch})
+                    )
+                    start = end
+            await self.send_outbox_batch(
+                self.reddit_outbox, messages, "reddit listings"
             )
-            if inserted_entries:
-                pipeline = [
-                    {"$match": {"feed_url": feed_url, "channel_id": {"$exists": True}}},
-                    {
-                        "$group": {
-                            "_id": "$feed_url",
-                            "channel_ids": {"$addToSet": "$channel_id"},
-                        }
-                    },
-                ]
-                cursor = self.rss_collection.aggregate(pipeline)
-                documents = await cursor.to_list(None)
-                ## create embeds for inserted entries and send to channels we just aggregated
-                embeds = []
-                for entry in inserted_entries:
-                    embed = rss.create_entry_embed(entry=entry)
-                    embeds.append(embed)
-
-                # Batch the embeds to avoid ValueError thrown by Discord
-                if len(embeds) > 10:
-                    embed_batches = chunks(lst=embeds, n=10)
-
-                    for doc in documents:
-                        channel_ids: list = doc.get("channel_ids")
-                        for channel_id in channel_ids:
-                            for embed_batch in embed_batches:
-                                await self.channel_send(
-                                    channel_id=channel_id,
-                                    embeds=embed_batch,
-                                )
-                else:
-                    for doc in documents:
-                        channel_ids: list = doc.get("channel_ids")
-                        for channel_id in channel_ids:
-                            await self.channel_send(
-                                channel_id=channel_id,
-                                embeds=embeds,
-                            )
-
-    async def find_one_rss_entry_or_insert(
-        self,
-        feed_url: str = "",
-        thumbnail: str = "",
-        entries: [dict] = {},
-        *args,
-        **kwargs,
-    ) -> [dict]:
-        """For each entry a document is created in the rss collection if a matching document for the entry is not found.
-
-        Unlike reddit_find_one_or_insert_one_document at this time, entries are stored with out a channel_id.
-        The feed_url acts as the unique key. See update_all_rss_feeds for how this works for returning new feed_url entries
-        to channels with that given feed_url.
 
-        Args:
-            feed_url (str, optional): _description_. Defaults to "".
-            thumbnail (str, optional): _description_. Defaults to "".
-            entries (dict], optional): _description_. Defaults to {}.
+    @tasks.loop(**SCHEDULER_TICK)
+    async def delivery_outbox_task(self):
+        await self.post_deliveries()
 
-        Returns:
-            [dict]: List of entries that are to be added to the rss collection
+    @delivery_outbox_task.before_loop
+    async def before_delivery_outbox_task(self):
+        await self.wait_until_ready()
+
+    async def post_deliveries(self):
+        """Sends the messages queued by headless pollers, see poller.py"""
+        with memory_ceiling("post_deliveries"), metrics.TASK_SECONDS.time(
+            task="post_deliveries"
+        ):
+            while documents := await self.delivery_outbox.claim():
+                await self.send_outbox_batch(
+                    self.delivery_outbox,
+                    [
+                        ([doc["_id"]], doc["channel_id"], delivery_kwargs(doc))
+                        for doc in documents
+                    ],
+                    "queued messages",
+                )
+
+    async def send_outbox_batch(
+        self, outbox: Outbox, messages: List[Tuple[List[Any], int, dict]], name: str
+    ) -> None:
+        """Delivers a claimed batch then acknowledges it
+
+        The batch's lease is renewed until every message was sent or dropped, so
+        another worker does not claim it while it waits on rate limits.
+
+        Messages the delivery queue gave up on are acknowledged with dropped set so
+        they are not retried.
+
+        Args:
+            outbox (Outbox): The outbox the batch was claimed from
+            messages (List[Tuple[List[Any], int, dict]]): (_ids of the documents a
+                message sends, channel_id, send kwargs)
+            name (str): What is sent, for the log
         """
-        inserted = []
-        for entry in entries:
-            seconds_since_epoch = time.mktime(entry.published_parsed)
-            dt = datetime.fromtimestamp(seconds_since_epoch)
-            find_dict = {
-                "feed_url": feed_url,
-                "title": entry.title,
-                "thumbnail": thumbnail,
-                "dt_published": dt,
-            }
-
-            doc = await self.rss_collection.find_one(find_dict)
-
-            if not doc:
-                insert_dict = {**find_dict, **entry}
-                result = await self.rss_collection.insert_one(insert_dict)
-                if result.inserted_id:
-                    inserted.append(insert_dict)
+        ids = [doc_id for doc_ids, _, _ in messages for doc_id in doc_ids]
+        async with outbox.renewing(ids):
+            deliveries = [
+                (doc_ids, await self.deliver(channel_id, **kwargs))
+                for doc_ids, channel_id, kwargs in messages
+            ]
+            results = await asyncio.gather(*(future for _, future in deliveries))
+        sent, dropped = [], []
+        for (doc_ids, _), ok in zip(deliveries, results):
+            (sent if ok else dropped).extend(doc_ids)
+        await outbox.ack(sent)
+        await outbox.ack(dropped, dropped=True)
         print(
-            f"Of {len(entries)} entries for {feed_url} {len(inserted)} have been added to db"
+            f"Sent {len(sent)} {name} in {len(messages)} messages, "
+            f"dropped {len(dropped)}"
         )
-        return inserted
 
 
 def main():
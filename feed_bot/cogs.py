@@ -13,10 +13,49 @@ import discord
 from discord.ext import commands
 
 from feed_bot.utils.common import REDDIT_URL_PATTERN
+from feed_bot.utils.delivery import pack_embeds
+from feed_bot.utils.streaming import stream_batches
+from feed_bot.utils.indexes import (
+    RSS_SUBSCRIPTION_FILTER,
+    SUBREDDIT_SUBSCRIPTION_FILTER,
+    verify_query_plans,
+)
 from feed_bot.utils.reddit import Reddit
 from feed_bot.utils.rss import RSSFeed
 
 
+async def send_embeds(
+    channel: discord.abc.Messageable, content: str, embeds: List[discord.Embed]
+) -> None:
+    """Sends content with embeds, in as many messages as Discord's limits require"""
+    for i, embed_batch in enumerate(pack_embeds(embeds) or [[]]):
+        await channel.send(content if i == 0 else None, embeds=embed_batch)
+
+
+class DebugCommands(commands.Cog):
+    """Commands for inspecting the bot's database
+
+    Only the bot owner can invoke these commands.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.command(name="explain")
+    @commands.is_owner()
+    async def explain(self, ctx: commands.Context) -> None:
+        """Explains every production query and lists those that scan a whole collection"""
+        async with ctx.typing():
+            report = await verify_query_plans(self.bot.db)
+            if report:
+                lines = "\n".join(
+                    f"{name}: {stages}" for name, stages in report.items()
+                )
+                await ctx.send(f"**Queries falling back to COLLSCAN:**\n{lines}")
+            else:
+                await ctx.send("**All production queries use an index**")
+
+
 class FileCommands(commands.Cog):
     """Commands for exporting channel subscriptions
 
@@ -31,75 +70,37 @@ class FileCommands(commands.Cog):
         """Sends a generated .txt file of all the channel's subscriptions to the channel"""
         async with ctx.typing():
             channel = ctx.message.channel
-            pipeline = [
-                {
-                    "$lookup": {
-                        "from": self.bot.reddit_collection_str,
-                        "localField": "channel_id",
-                        "foreignField": "channel_id",
-                        "pipeline": [
-                            {
-                                "$match": {
-                                    "channel_id": {"$exists": True},
-                                    "subreddit": {"$exists": True},
-                                    "title": {"$exists": False},
-                                    "description": {"$exists": False},
-                                    "link": {"$exists": False},
-                                    "sent": {"$exists": False},
-                                }
-                            },
-                        ],
-                        "as": "reddit_docs",
-                    }
-                },
-                {"$unwind": "$reddit_docs"},
-                {
-                    "$project": {
-                        "_id": 1,
-                        "channel_id": 1,
-                        "feed_url": 1,
-                        "subreddit": "$reddit_docs.subreddit",
-                    }
-                },
-                {"$match": {"channel_id": channel.id}},
-                {
-                    "$group": {
-                        "_id": "$channel_id",
-                        "feed_urls": {"$addToSet": "$feed_url"},
-                        "subreddits": {"$addToSet": "$subreddit"},
-                    }
-                },
-            ]
-
-            cursor = self.bot.rss_collection.aggregate(pipeline)
-            documents: List = await cursor.to_list(None)
-            if documents:
-                doc: Dict = documents[0]
-                feed_urls: List[str] = doc.get("feed_urls", [])
-                subreddits: List[str] = doc.get("subreddits", [])
-
-                if feed_urls or subreddits:
-                    to_file_write: Dict = {
-                        ".rss add": ",".join(feed_urls),
-                        ".subreddit add": ",".join(subreddits),
-                    }
+            cursor = self.bot.subscriptions_collection.find(
+                {"channel_id": channel.id},
+                projection={"_id": 0, "feed_url": 1, "subreddit": 1},
+            )
+            feed_urls: List[str] = []
+            subreddits: List[str] = []
+            async for documents in stream_batches(cursor):
+                feed_urls += [
+                    doc["feed_url"] for doc in documents if doc.get("feed_url")
+                ]
+                subreddits += [
+                    doc["subreddit"] for doc in documents if doc.get("subreddit")
+                ]
+            if feed_urls or subreddits:
+                to_file_write: Dict = {
+                    ".rss add": ",".join(feed_urls),
+                    ".subreddit add": ",".join(subreddits),
+                }
 
-                    with tempfile.NamedTemporaryFile(
-                        mode="w+t", suffix=".txt", delete_on_close=False
-                    ) as fp:
-                        for key, value in to_file_write.items():
-                            fp.write(f"{key} {value}\n")
-                        fp.close()
+                with tempfile.NamedTemporaryFile(
+                    mode="w+t", suffix=".txt", delete_on_close=False
+                ) as fp:
+                    for key, value in to_file_write.items():
+                        fp.write(f"{key} {value}\n")
+                    fp.close()
 
-                        filename = f"{channel.name}.txt"
-                        file = discord.File(fp.name, filename=filename)
-                        await channel.send(
-                            content=f"**Channel Subscriptions Export: {filename}**",
-                            file=file,
-                        )
-                else:
+                    filename = f"{channel.name}.txt"
+                    file = discord.File(fp.name, filename=filename)
                     await channel.send(
-                        content="**Channel has no subscriptions to export**"
+                        content=f"**Channel Subscriptions Export: {filename}**",
+                        file=file,
                     )
             else:
                 await channel.send(content="**Channel has no subscriptions to export**")
@@ -137,38 +138,18 @@ class RedditCommands(commands.Cog):
         channel = ctx.message.channel
         await channel.send("**Getting subreddits...**")
         async with ctx.typing():
-            pipeline = [
-                {
-                    "$match": {
-                        "channel_id": channel.id,
-                        "subreddit": {"$exists": True},
-                        "title": {"$exists": False},
-                        "description": {"$exists": False},
-                        "link": {"$exists": False},
-                        "sent": {"$exists": False},
-                    }
-                },
-                {
-                    "$group": {
-                        "_id": "$channel_id",
-                        "subreddits": {"$push": "$subreddit"},
-                    }
-                },
-            ]
-            cursor = self.bot.reddit_collection.aggregate(pipeline)
-            documents = await cursor.to_list(None)
-            if not documents:
+            cursor = self.bot.subscriptions_collection.find(
+                {"channel_id": channel.id, **SUBREDDIT_SUBSCRIPTION_FILTER},
+                projection={"_id": 0, "subreddit": 1},
+            )
+            subreddits = []
+            async for documents in stream_batches(cursor):
+                subreddits += [doc.get("subreddit") for doc in documents]
+            if not subreddits:
                 await channel.send("**No Subreddit Subscriptions**")
             else:
-                for doc in documents:  # should be only 1 document
-                    subreddits = doc.get("subreddits")
-                    subreddits_str = ", ".join(subreddits)
-                    if subreddits:  # this always should be the case
-                        await channel.send(
-                            f"**Subreddit Subscriptions: {subreddits_str}**"
-                        )
-                    else:
-                        await channel.send("**No Subreddit Subscriptions**")
+                subreddits_str = ", ".join(subreddits)
+                await channel.send(f"**Subreddit Subscriptions: {subreddits_str}**")
 
     @subreddit.command(name="add")
     @commands.is_owner()
@@ -214,23 +195,25 @@ class RedditCommands(commands.Cog):
 
                 # Find or Insert logic
                 doc_dict = {"channel_id": channel_id, "subreddit": subreddit}
-                filter_dict = {
-                    **doc_dict,
-                    "title": {"$exists": False},
-                    "description": {"$exists": False},
-                    "link": {"$exists": False},
-                    "sent": {"$exists": False},
-                }
-                doc = await self.bot.reddit_collection.find_one(filter_dict)
+                doc = await self.bot.subscriptions_collection.find_one(doc_dict)
                 if doc:
                     await channel.send(f"**Already subscribed to r/{subreddit}**")
                 else:
-                    r = Reddit(session=self.bot.http_session, channel_id=channel_id)
+                    r = Reddit(
+                        session=self.bot.http_session,
+                        channel_id=channel_id,
+                        reddit=self.bot.reddit_client,
+                    )
                     exists, msg = await r.check_subreddit_exists(
                         subreddit_name=subreddit
                     )
                     if exists:
-                        await self.bot.reddit_collection.insert_one(doc_dict)
+                        result = await self.bot.subscriptions_collection.insert_one(
+                            doc_dict
+                        )
+                        self.bot.subscription_index.add(
+                            channel_id, "subreddit", subreddit, result.inserted_id
+                        )
                         await channel.send(
                             f"**Subscribed to r/{subreddit} 'new' listings**"
                         )
@@ -242,7 +225,7 @@ class RedditCommands(commands.Cog):
     async def rm(self, ctx: commands.Context, arg: str) -> None:
         """Remove rss feed of subreddit(s) from this channel
 
-        Removes both the "reference" marking document and unsent documents
+        Removes both the subscription document and unsent listings
         with the same channel_id and subreddit
         Args:
             ctx (commands.Context): Invocation Context Object
@@ -264,7 +247,17 @@ class RedditCommands(commands.Cog):
                 if sa.startswith("r/"):
                     subreddit = sa[2:]
                 filter_dict = {"channel_id": channel_id, "subreddit": subreddit}
-                result = await self.bot.reddit_collection.delete_many(filter_dict)
+                result = await self.bot.subscriptions_collection.delete_many(
+                    filter_dict
+                )
+                self.bot.subscription_index.remove(channel_id, "subreddit", subreddit)
+                await self.bot.reddit_listings_collection.delete_many(
+                    {
+                        "channel_id": channel_id,
+                        "subreddit": f"r/{subreddit}",
+                        "sent": False,
+                    }
+                )
                 if result.deleted_count >= 1:
                     print(f"Removed r/{subreddit} from channel: {channel_id}")
                     await channel.send(
@@ -286,8 +279,12 @@ class RedditCommands(commands.Cog):
         channel = ctx.message.channel
         channel_id = channel.id
         async with ctx.typing():
-            filter_dict = {"channel_id": channel_id, "subreddit": {"$exists": True}}
-            result = await self.bot.reddit_collection.delete_many(filter_dict)
+            filter_dict = {"channel_id": channel_id, **SUBREDDIT_SUBSCRIPTION_FILTER}
+            result = await self.bot.subscriptions_collection.delete_many(filter_dict)
+            self.bot.subscription_index.remove_channel(channel_id, "subreddit")
+            await self.bot.reddit_listings_collection.delete_many(
+                {"channel_id": channel_id, "sent": False}
+            )
             if result.deleted_count >= 1:
                 print(f"Removed all subreddits from channel: {channel_id}")
                 await channel.send("**Removed subreddit channel subscription**")
@@ -329,44 +326,20 @@ class RSSFeedCommands(commands.Cog):
         """
         async with ctx.typing():
             channel = ctx.message.channel
-            pipeline = [
-                {
-                    "$match": {
-                        "channel_id": channel.id,
-                        "feed_url": {"$exists": True},
-                    }
-                },
-                {
-                    "$group": {
-                        "_id": "$channel_id",
-                        "feeds": {
-                            "$push": {
-                                "feed_url": "$feed_url",
-                                "title": "$title",
-                                "subtitle": "$subtitle",
-                                "summary": "$summary",
-                                "description": "$description",
-                                "author_detail": "$author_detail",
-                                "link": "$link",
-                                "image": "$image",
-                            }
-                        },
-                    }
-                },
-            ]
-            cursor = self.bot.rss_collection.aggregate(pipeline)
-            documents = await cursor.to_list(None)
-            embeds = []
-            rss = RSSFeed()
-            if not documents:
+            cursor = self.bot.subscriptions_collection.find(
+                {"channel_id": channel.id, **RSS_SUBSCRIPTION_FILTER},
+                projection={"_id": 0, "feed_url": 1},
+            )
+            feed_urls = []
+            async for documents in stream_batches(cursor):
+                feed_urls += [doc.get("feed_url") for doc in documents]
+            if not feed_urls:
                 await channel.send("**No RSS Feed Subscriptions**")
             else:
-                for doc in documents:
-                    for feed in doc.get("feeds"):
-                        feed = {**feed, "image": {"href": feed.get("image")}}
-                        embed = rss.create_about_embed(feed=feed)
-                        embeds.append(embed)
-                await channel.send("**Channel RSS Subscriptions:**", embeds=embeds)
+                feeds = await self.bot.get_feeds(feed_urls=feed_urls)
+                rss = RSSFeed()
+                embeds = [rss.create_about_embed(feed=feed) for feed in feeds]
+                await send_embeds(channel, "**Channel RSS Subscriptions:**", embeds)
 
     @rss.command(name="add")
     @commands.is_owner()
@@ -392,6 +365,7 @@ class RSSFeedCommands(commands.Cog):
         await channel.send("**Getting feeds...**")
         async with ctx.typing():
             db_found_embeds = []
+            found_urls = []
             to_insert = []
             rss = RSSFeed(session=self.bot.http_session, channel_id=channel.id)
 
@@ -399,27 +373,34 @@ class RSSFeedCommands(commands.Cog):
                 url = url if url.endswith("/") else f"{url}/"
 
                 filter_dict = dict(channel_id=channel.id, feed_url=url)
-                doc = await self.bot.rss_collection.find_one(filter_dict)
+                doc = await self.bot.subscriptions_collection.find_one(filter_dict)
 
                 if doc:
+                    found_urls.append(url)
+                else:
+                    to_insert.append(url)
 
-                    feed = {**doc, "image": {"href": doc["image"]}}
+            if found_urls:
+                feeds = await self.bot.get_feeds(feed_urls=found_urls)
+                for feed in feeds:
                     embed = rss.create_about_embed(feed=feed)
                     db_found_embeds.append(embed)
-                else:
-                    to_insert.append(url)
 
             if db_found_embeds:
-                await channel.send(
+                await send_embeds(
+                    channel,
                     "**Channel Already Subscribed to RSS Feeds:**",
-                    embeds=db_found_embeds,
+                    db_found_embeds,
                 )
 
             if to_insert:
                 await rss.parse_feed_urls(feed_urls=to_insert)
 
-                if rss.error:
-                    return await channel.send(f"**{rss.error_msg}**")
+                for error_msg in rss.feed_errors.values():
+                    await channel.send(f"**{error_msg}**")
+
+                if not rss.res_dicts:
+                    return
 
                 db_insert_embeds = []
                 for feed, entries in rss.res_dicts:
@@ -434,29 +415,44 @@ class RSSFeedCommands(commands.Cog):
                         image,
                     ) = rss.parse_feed_flat(feed)
 
-                    await self.bot.rss_collection.insert_one(
+                    await self.bot.feeds_collection.update_one(
+                        {"_id": feed_url},
+                        {
+                            "$set": {
+                                "title": title,
+                                "subtitle": subtitle,
+                                "summary": summary,
+                                "description": description,
+                                "author_detail": author_detail,
+                                "link": link,
+                                "image": image,
+                            }
+                        },
+                        upsert=True,
+                    )
+                    result = await self.bot.subscriptions_collection.update_one(
+                        {"channel_id": channel.id, "feed_url": feed_url},
                         {
-                            "channel_id": channel.id,
-                            "feed_url": feed_url,
-                            "title": title,
-                            "subtitle": subtitle,
-                            "summary": summary,
-                            "description": description,
-                            "author_detail": author_detail,
-                            "link": link,
-                            "image": image,
-                        }
+                            "$setOnInsert": {
+                                "channel_id": channel.id,
+                                "feed_url": feed_url,
+                            }
+                        },
+                        upsert=True,
+                    )
+                    self.bot.subscription_index.add(
+                        channel.id, "feed_url", feed_url, result.upserted_id
                     )
 
-                    await self.bot.find_one_rss_entry_or_insert(
+                    await self.bot.insert_new_rss_entries(
                         feed_url=feed_url, thumbnail=image, entries=entries
                     )
 
                     embed = rss.create_about_embed(feed=feed)
                     db_insert_embeds.append(embed)
 
-                await channel.send(
-                    "**New RSS Feed Subscriptions:**", embeds=db_insert_embeds
+                await send_embeds(
+                    channel, "**New RSS Feed Subscriptions:**", db_insert_embeds
                 )
 
     @rss.command(name="rm")
@@ -478,21 +474,28 @@ class RSSFeedCommands(commands.Cog):
                 feed_urls = [arg]
 
             embeds = []
+            removed_urls = []
             for url in feed_urls:
                 url = url if url.endswith("/") else f"{url}/"
                 filter_dict = {"channel_id": channel.id, "feed_url": url}
-                doc = await self.bot.rss_collection.find_one_and_delete(filter_dict)
+                doc = await self.bot.subscriptions_collection.find_one_and_delete(
+                    filter_dict
+                )
                 if doc:
-                    feed = {**doc, "image": {"href": doc["image"]}}
+                    self.bot.subscription_index.remove(channel.id, "feed_url", url)
+                    removed_urls.append(url)
+
+            if removed_urls:
+                rss = RSSFeed()
+                for feed in await self.bot.get_feeds(feed_urls=removed_urls):
                     title = feed.get("title")
                     print(f"Removed {title} from channel: {channel.id}")
-                    rss = RSSFeed()
                     embed = rss.create_about_embed(feed=feed)
                     embeds.append(embed)
 
             if embeds:
-                return await channel.send(
-                    f"**Removed RSS Feed Subscription:**", embeds=embeds
+                return await send_embeds(
+                    channel, f"**Removed RSS Feed Subscription:**", embeds
                 )
             return await channel.send(f"**Already Unsubscribed**")
 
@@ -507,8 +510,9 @@ class RSSFeedCommands(commands.Cog):
         async with ctx.typing():
             channel = ctx.message.channel
             channel_id = channel.id
-            filter_dict = {"channel_id": channel_id, "feed_url": {"$exists": True}}
-            result = await self.bot.rss_collection.delete_many(filter_dict)
+            filter_dict = {"channel_id": channel_id, **RSS_SUBSCRIPTION_FILTER}
+            result = await self.bot.subscriptions_collection.delete_many(filter_dict)
+            self.bot.subscription_index.remove_channel(channel_id, "feed_url")
             if result.deleted_count >= 1:
                 print(f"Removed all web rss feeds from channel: {channel_id}")
                 await channel.send(f"**Removed web rss feed channel subscription**")
@@ -0,0 +1,357 @@
+"""Migrations for feed_bot_db
+
+Splits the legacy rss and reddit collections into dedicated collections:
+
+- rss
+    - channel subscription documents -> subscriptions (+ feed metadata -> feeds)
+    - feed entry documents -> feed_entries
+- rss_validators -> feeds (etag/last_modified)
+- reddit
+    - "reference" subscription documents -> subscriptions
+    - listing documents -> reddit_listings
+
+The migration runs from FeedBot.setup_hook and HeadlessPoller.run before any task
+starts, and can also be run on its own with `poetry run migrate`. Documents are
+copied in batches ordered by _id and the last copied _id of each legacy collection is
+stored in the migrations collection, so an interrupted migration resumes where it
+stopped. Every write is an
+upsert on a unique key which makes replaying a batch harmless. Legacy collections
+are left untouched.
+
+A second migration (retention_fields) slims feed entries that were stored in full,
+legacy entries included, and sets the seen_at/sent_at of documents stored before
+those fields existed so their TTL indexes can remove them (see utils/retention.py).
+It resumes the same way and only reads the documents that need the change. A third
+(feed_entry_keys) copies the keys of stored feed entries into feed_entry_keys.
+"""
+
+import os
+import asyncio
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+from motor import motor_asyncio
+from pymongo import UpdateOne
+
+from .utils.common import update_many_ignore_duplicates
+from .utils.indexes import ensure_indexes
+from .utils.reddit import Reddit
+from .utils.retention import FEED_ENTRY_FIELDS, FULL_ENTRY_FIELDS
+from .utils.rss import RSSFeed
+
+SPLIT_COLLECTIONS_MIGRATION = "split_collections"
+RETENTION_FIELDS_MIGRATION = "retention_fields"
+FEED_ENTRY_KEYS_MIGRATION = "feed_entry_keys"
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", 500))
+
+FEED_METADATA_FIELDS = [
+    "title",
+    "subtitle",
+    "summary",
+    "description",
+    "author_detail",
+    "link",
+    "image",
+]
+
+
+def convert_rss_document(doc: dict) -> List[Tuple[str, UpdateOne]]:
+    """Converts a legacy rss document into writes for the new collections
+
+    Args:
+        doc (dict): A document from the legacy rss collection
+
+    Returns:
+        List[Tuple[str, UpdateOne]]: (collection name, write) pairs
+    """
+    feed_url = doc.get("feed_url")
+    if "channel_id" in doc:
+        metadata = {key: doc[key] for key in FEED_METADATA_FIELDS if key in doc}
+        return [
+            (
+                "subscriptions",
+                UpdateOne(
+                    {"channel_id": doc["channel_id"], "feed_url": feed_url},
+                    {"$setOnInsert": {"_id": doc["_id"]}},
+                    upsert=True,
+                ),
+            ),
+            (
+                "feeds",
+                UpdateOne({"_id": feed_url}, {"$setOnInsert": metadata}, upsert=True),
+            ),
+        ]
+    entry_key = doc.get("entry_key") or RSSFeed.entry_key(feed_url, doc)
+    entry = {key: value for key, value in doc.items() if key != "entry_key"}
+    return [
+        (
+            "feed_entries",
+            UpdateOne({"entry_key": entry_key}, {"$setOnInsert": entry}, upsert=True),
+        )
+    ]
+
+
+def convert_rss_validators_document(doc: dict) -> List[Tuple[str, UpdateOne]]:
+    """Converts a legacy rss_validators document into a write for the feeds collection"""
+    validator = {
+        "etag": doc.get("etag"),
+        "last_modified": doc.get("last_modified"),
+    }
+    return [("feeds", UpdateOne({"_id": doc["_id"]}, {"$set": validator}, upsert=True))]
+
+
+def convert_reddit_document(doc: dict) -> List[Tuple[str, UpdateOne]]:
+    """Converts a legacy reddit document into a write for the new collections
+
+    Args:
+        doc (dict): A document from the legacy reddit collection
+
+    Returns:
+        List[Tuple[str, UpdateOne]]: (collection name, write) pairs
+    """
+    channel_id = doc.get("channel_id")
+    subreddit = doc.get("subreddit")
+    if "sent" in doc:
+        listing_key = doc.get("listing_key") or Reddit.listing_key(
+            channel_id, subreddit, doc.get("link")
+        )
+        listing = {key: value for key, value in doc.items() if key != "listing_key"}
+        return [
+            (
+                "reddit_listings",
+                UpdateOne(
+                    {"listing_key": listing_key},
+                    {"$setOnInsert": listing},
+                    upsert=True,
+                ),
+            )
+        ]
+    return [
+        (
+            "subscriptions",
+            UpdateOne(
+                {"channel_id": channel_id, "subreddit": subreddit},
+                {"$setOnInsert": {"_id": doc["_id"]}},
+                upsert=True,
+            ),
+        )
+    ]
+
+
+def convert_feed_entry_retention(doc: dict) -> List[Tuple[str, UpdateOne]]:
+    """Drops the fields of a feed entry stored in full and sets its missing seen_at"""
+    update = {}
+    if any(field in doc for field in FULL_ENTRY_FIELDS):
+        update["$unset"] = {
+            key: "" for key in doc if key != "_id" and key not in FEED_ENTRY_FIELDS
+        }
+    if "seen_at" not in doc:
+        update["$set"] = {"seen_at": datetime.now()}
+    if not update:
+        return []
+    return [("feed_entries", UpdateOne({"_id": doc["_id"]}, update))]
+
+
+def convert_reddit_listing_retention(doc: dict) -> List[Tuple[str, UpdateOne]]:
+    """Sets the missing sent_at of a sent listing"""
+    update = {"$set": {"sent_at": datetime.now()}}
+    return [("reddit_listings", UpdateOne({"_id": doc["_id"]}, update))]
+
+
+def convert_feed_entry_key(doc: dict) -> List[Tuple[str, UpdateOne]]:
+    """Converts a stored feed entry into a write of its key to feed_entry_keys"""
+    return [
+        (
+            "feed_entry_keys",
+            UpdateOne(
+                {"_id": doc["entry_key"]},
+                {"$setOnInsert": {"stored_at": datetime.now()}},
+                upsert=True,
+            ),
+        )
+    ]
+
+
+# legacy collection name -> converter, in the order they are migrated
+SPLIT_COLLECTIONS_SOURCES: Dict[str, Callable] = {
+    "rss": convert_rss_document,
+    "rss_validators": convert_rss_validators_document,
+    "reddit": convert_reddit_document,
+}
+
+# collection name -> (documents to convert, converter), in the order they are migrated
+RETENTION_FIELDS_SOURCES: Dict[str, Tuple[dict, Callable]] = {
+    "feed_entries": (
+        {
+            "$or": [{field: {"$exists": True}} for field in FULL_ENTRY_FIELDS]
+            + [{"seen_at": {"$exists": False}}]
+        },
+        convert_feed_entry_retention,
+    ),
+    "reddit_listings": (
+        {"sent": True, "sent_at": {"$exists": False}},
+        convert_reddit_listing_retention,
+    ),
+}
+
+
+async def write_batch(db, documents: List[dict], convert: Callable) -> None:
+    """Groups the converted writes of documents by collection and bulk writes them"""
+    requests: Dict[str, List[UpdateOne]] = {}
+    for doc in documents:
+        for collection_name, request in convert(doc):
+            requests.setdefault(collection_name, []).append(request)
+    for collection_name, collection_requests in requests.items():
+        await update_many_ignore_duplicates(db[collection_name], collection_requests)
+
+
+async def migrate_source(
+    db,
+    migration: str,
+    state: dict,
+    source: str,
+    convert: Callable,
+    query: dict | None = None,
+    batch_size: int = MIGRATION_BATCH_SIZE,
+) -> int:
+    """Converts the documents of source matching query in batches ordered by _id
+
+    The last converted _id is stored under source in the migration's state
+    document, a rerun continues after it.
+
+    Args:
+        db: motor database
+        migration (str): _id of the migration's state document
+        state (dict): The stored state document of the migration
+        source (str): Name of the collection to read
+        convert (Callable): Turns a document into (collection name, write) pairs
+        query (dict, optional): Selects the documents to convert. Defaults to all.
+        batch_size (int, optional): Documents per batch. Defaults to MIGRATION_BATCH_SIZE.
+
+    Returns:
+        int: The number of documents converted
+    """
+    migrations = db["migrations"]
+    query = dict(query or {})
+    last_id = state.get(source)
+    if last_id is not None:
+        query["_id"] = {"$gt": last_id}
+    cursor = db[source].find(query).sort("_id", 1).batch_size(batch_size)
+    migrated = 0
+    batch = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) < batch_size:
+            continue
+        await write_batch(db, batch, convert)
+        migrated += len(batch)
+        await migrations.update_one(
+            {"_id": migration}, {"$set": {source: batch[-1]["_id"]}}, upsert=True
+        )
+        batch = []
+    if batch:
+        await write_batch(db, batch, convert)
+        migrated += len(batch)
+        await migrations.update_one(
+            {"_id": migration}, {"$set": {source: batch[-1]["_id"]}}, upsert=True
+        )
+    return migrated
+
+
+async def migrate_split_collections(db, batch_size: int = MIGRATION_BATCH_SIZE) -> None:
+    """Copies the legacy rss, rss_validators and reddit collections into the new schema
+
+    Args:
+        db: motor database
+        batch_size (int, optional): Documents per batch. Defaults to MIGRATION_BATCH_SIZE.
+    """
+    migrations = db["migrations"]
+    state = await migrations.find_one({"_id": SPLIT_COLLECTIONS_MIGRATION}) or {}
+    if state.get("done"):
+        return
+    for source, convert in SPLIT_COLLECTIONS_SOURCES.items():
+        migrated = await migrate_source(
+            db,
+            SPLIT_COLLECTIONS_MIGRATION,
+            state,
+            source,
+            convert,
+            batch_size=batch_size,
+        )
+        if migrated:
+            print(f"Migrated {migrated} documents from {source}")
+    await migrations.update_one(
+        {"_id": SPLIT_COLLECTIONS_MIGRATION}, {"$set": {"done": True}}, upsert=True
+    )
+
+
+async def migrate_retention_fields(db, batch_size: int = MIGRATION_BATCH_SIZE) -> None:
+    """Slims feed entries stored in full and starts the retention clock of documents
+    stored without seen_at/sent_at, see utils/retention.py
+
+    Args:
+        db: motor database
+        batch_size (int, optional): Documents per batch. Defaults to MIGRATION_BATCH_SIZE.
+    """
+    migrations = db["migrations"]
+    state = await migrations.find_one({"_id": RETENTION_FIELDS_MIGRATION}) or {}
+    if state.get("done"):
+        return
+    for source, (query, convert) in RETENTION_FIELDS_SOURCES.items():
+        migrated = await migrate_source(
+            db,
+            RETENTION_FIELDS_MIGRATION,
+            state,
+            source,
+            convert,
+            query=query,
+            batch_size=batch_size,
+        )
+        if migrated:
+            print(f"Migrated the retention fields of {migrated} {source}")
+    await migrations.update_one(
+        {"_id": RETENTION_FIELDS_MIGRATION}, {"$set": {"done": True}}, upsert=True
+    )
+
+
+async def migrate_feed_entry_keys(db, batch_size: int = MIGRATION_BATCH_SIZE) -> None:
+    """Copies the keys of the stored feed entries into feed_entry_keys
+
+    Entries stored before feed_entry_keys existed would otherwise be sent again once
+    they expired and their feed is read past its last seen mark.
+
+    Args:
+        db: motor database
+        batch_size (int, optional): Documents per batch. Defaults to MIGRATION_BATCH_SIZE.
+    """
+    migrations = db["migrations"]
+    state = await migrations.find_one({"_id": FEED_ENTRY_KEYS_MIGRATION}) or {}
+    if state.get("done"):
+        return
+    migrated = await migrate_source(
+        db,
+        FEED_ENTRY_KEYS_MIGRATION,
+        state,
+        "feed_entries",
+        convert_feed_entry_key,
+        batch_size=batch_size,
+    )
+    if migrated:
+        print(f"Migrated the keys of {migrated} feed_entries")
+    await migrations.update_one(
+        {"_id": FEED_ENTRY_KEYS_MIGRATION}, {"$set": {"done": True}}, upsert=True
+    )
+
+
+async def migrate(db) -> None:
+    """Creates the indexes the migrations rely on and runs every migration"""
+    await ensure_indexes(db)
+    await migrate_split_collections(db)
+    await migrate_retention_fields(db)
+    await migrate_feed_entry_keys(db)
+
+
+def main():
+    from .bot import FeedBot
+
+    client = motor_asyncio.AsyncIOMotorClient(os.getenv("MONGODB_URI"))
+    asyncio.run(migrate(client[FeedBot.database_name]))
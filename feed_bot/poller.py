@@ -0,0 +1,648 @@
+"""FeedPoller
+
+Polls rss feeds and subreddits and stores what is new. FeedBot polls in the same
+process as its gateway connection, which is what a single process deployment runs.
+Fetching, parsing and database writes can also run in their own processes, with no
+discord connection, so they never hold up the gateway's heartbeats and scale on
+their own:
+
+    $ poetry run poller
+
+A headless poller queues every message in the deliveries collection instead of
+sending it, and the gateway sends them, see FeedBot.post_deliveries. New reddit
+listings are sent by the gateway either way. Any number of pollers split the feeds
+and subreddits between them with leases, see utils/leases.py. Set EXTERNAL_POLLERS
+on the gateway so that it only sends.
+
+Environment Variables:
+- MONGODB_URI
+    - The database shared with the gateway
+"""
+
+import os
+import time
+import signal
+import asyncio
+import aiohttp
+import discord
+from abc import ABC, abstractmethod
+from typing import Coroutine, Dict, List, Set, Tuple
+from datetime import datetime, timedelta
+from motor import motor_asyncio
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from discord.ext import tasks
+
+from .utils import metrics
+from .utils.reddit import Reddit, create_reddit_client
+from .utils.rss import RSSFeed
+from .utils.render_cache import render_cache
+from .utils.delivery import delivery_document, pack_embeds
+from .utils.leases import LEASE_SECONDS, LeaseManager
+from .utils.outbox import instance_id
+from .utils.retention import FEED_ENTRY_FIELDS
+from .utils.scheduler import PollScheduler
+from .utils.tracing import span
+from .utils.streaming import MONGO_BATCH_SIZE, memory_ceiling, stream_batches
+from .utils.subscriptions import SubscriptionIndex
+from .utils.workers import LoopBlockMonitor, shutdown_executor
+from .utils.common import insert_many_ignore_duplicates
+from .migrations import FEED_METADATA_FIELDS, migrate
+
+# Default poll interval of a feed or subreddit, see utils/scheduler.py
+LOOP_CYCLE = {"minutes": 60.0} if os.getenv("PROD_ENV", False) else {"minutes": 1.0}
+# How often the schedulers are checked for feeds and subreddits that are due
+SCHEDULER_TICK = (
+    {"seconds": 30.0} if os.getenv("PROD_ENV", False) else {"seconds": 10.0}
+)
+LEASE_HEARTBEAT = {"seconds": LEASE_SECONDS / 3}
+
+
+class FeedPoller(ABC):
+    """The polling pipeline shared by FeedBot and HeadlessPoller
+
+    Subclasses implement deliver and wait_until_ready, which discord.Client provides
+    for FeedBot. A subclass without deliver can not be constructed.
+
+    Args:
+        db_client (optional): motor client. Defaults to None, a client of MONGODB_URI.
+            Benchmarks pass a stand-in, see benchmarks/memory_db.py
+    """
+
+    database_name = "feed_bot_db"
+    subscriptions_collection_str = "subscriptions"
+    feeds_collection_str = "feeds"
+    feed_entries_collection_str = "feed_entries"
+    feed_entry_keys_collection_str = "feed_entry_keys"
+    reddit_listings_collection_str = "reddit_listings"
+    delivery_state_collection_str = "delivery_state"
+    reddit_cursors_collection_str = "reddit_cursors"
+    leases_collection_str = "leases"
+    deliveries_collection_str = "deliveries"
+
+    def __init__(self, db_client=None):
+        self.db_client = db_client or motor_asyncio.AsyncIOMotorClient(
+            os.getenv("MONGODB_URI"), event_listeners=metrics.mongo_event_listeners()
+        )
+        self.db = self.db_client[self.database_name]
+        self.subscriptions_collection = self.db[self.subscriptions_collection_str]
+        self.feeds_collection = self.db[self.feeds_collection_str]
+        self.feed_entries_collection = self.db[self.feed_entries_collection_str]
+        self.feed_entry_keys_collection = self.db[self.feed_entry_keys_collection_str]
+        self.reddit_listings_collection = self.db[self.reddit_listings_collection_str]
+        self.delivery_state_collection = self.db[self.delivery_state_collection_str]
+        self.reddit_cursors_collection = self.db[self.reddit_cursors_collection_str]
+        self.leases_collection = self.db[self.leases_collection_str]
+        self.deliveries_collection = self.db[self.deliveries_collection_str]
+        self.instance_id = instance_id()
+        self.leases = LeaseManager(self.leases_collection, owner=self.instance_id)
+        self.subscription_index = SubscriptionIndex()
+        self.http_session = None
+        self.reddit_client = None
+        self.metrics_server = None
+        self.loop_monitor = LoopBlockMonitor()
+        default_interval = timedelta(**LOOP_CYCLE).total_seconds()
+        self.rss_scheduler = PollScheduler(default_interval=default_interval)
+        self.subreddit_scheduler = PollScheduler(default_interval=default_interval)
+        self.poll_tasks: Set[asyncio.Task] = set()
+
+    @abstractmethod
+    async def deliver(self, channel_id: int, *args, **kwargs):
+        """Sends a message to channel_id, takes the arguments of Messageable.send"""
+
+    async def flush_deliveries(self) -> None:
+        """Called once a poll has delivered its messages"""
+
+    async def open_sessions(self) -> None:
+        self.http_session = aiohttp.ClientSession()
+        # Own session for asyncpraw (it sets its User-Agent on the session and closes
+        # it on close) on the same connection pool as the bot
+        reddit_session = aiohttp.ClientSession(
+            connector=self.http_session.connector, connector_owner=False
+        )
+        self.reddit_client = create_reddit_client(session=reddit_session)
+        self.metrics_server = await metrics.start_metrics_server()
+
+    def start_polling(self) -> None:
+        print(f"Default Poll Interval: {LOOP_CYCLE}, Scheduler Tick: {SCHEDULER_TICK}")
+        self.lease_task.start()
+        self.subreddit_task.start()
+        self.rss_feeds_task.start()
+
+    async def stop_polling(self) -> None:
+        """Stops polling and closes the resources opened by open_sessions"""
+        for task in (self.lease_task, self.subreddit_task, self.rss_feeds_task):
+            task.cancel()
+        poll_tasks = list(self.poll_tasks)
+        for task in poll_tasks:
+            task.cancel()
+        # the polls still hold leases and sessions until they have unwound
+        await asyncio.gather(*poll_tasks, return_exceptions=True)
+        self.subscription_index.stop()
+        try:
+            await self.leases.release()
+        except PyMongoError as e:
+            print(f"Could not release leases: {e}")
+        shutdown_executor()
+        if self.reddit_client:
+            await self.reddit_client.close()
+        if self.http_session:
+            await self.http_session.close()
+        if self.metrics_server:
+            await self.metrics_server.cleanup()
+
+    @tasks.loop(**LEASE_HEARTBEAT)
+    async def lease_task(self):
+        """Renews this process's poll partitions, see utils/leases.py"""
+        owned = set(self.leases.owned)
+        try:
+            await self.leases.heartbeat()
+        except PyMongoError as e:
+            print(f"Lease heartbeat failed: {e}")
+            return
+        if self.leases.owned != owned:
+            print(
+                f"Polling {len(self.leases.owned)} of {self.leases.partitions} "
+                f"partitions, {self.leases.workers} processes are live"
+            )
+
+    async def reddit_insert_new_documents(self, dicts: [dict]) -> [dict]:
+        """Inserts the listings in dicts that are not already in the reddit_listings collection.
+
+        Listings are deduplicated by their "listing_key" which is backed by a unique index,
+        so the whole batch is written with a single unordered insert_many.
+
+        Args:
+            dicts (dict]): List of dictionaries to become documents
+
+        Returns:
+            [dict]: The listings that were inserted
+        """
+        inserted = await insert_many_ignore_duplicates(
+            self.reddit_listings_collection, dicts
+        )
+        metrics.STORED_ENTRIES.inc(len(inserted), kind="reddit", result="inserted")
+        metrics.STORED_ENTRIES.inc(
+            len(dicts) - len(inserted), kind="reddit", result="duplicate"
+        )
+        print(f"Of {len(dicts)} new listings {len(inserted)} have been added to db")
+        return inserted
+
+    def start_poll(self, coro: Coroutine) -> None:
+        """Runs a poll in the background so a slow poll never delays the scheduler tick"""
+        task = asyncio.create_task(coro)
+        self.poll_tasks.add(task)
+        task.add_done_callback(self.poll_tasks.discard)
+
+    @staticmethod
+    def report_overruns(name: str, scheduler: PollScheduler) -> None:
+        overruns = scheduler.overruns()
+        metrics.POLL_OVERRUNS.set(len(overruns), kind=name)
+        for key, seconds in overruns:
+            print(
+                f"Overrun: {name} poll of {key} has been running for {seconds:.0f}s, "
+                "longer than its interval. It will not be started again until it completes"
+            )
+
+    @tasks.loop(**SCHEDULER_TICK)
+    async def subreddit_task(self, *args, **kwargs):
+        """Starts a poll for the subreddits that are due, see utils/scheduler.py"""
+        subreddits = [
+            subreddit
+            for subreddit in self.subscription_index.subreddits()
+            if self.leases.owns(Reddit.subreddit_key(subreddit))
+        ]
+        self.subreddit_scheduler.sync(subreddits)
+        self.report_overruns("subreddit", self.subreddit_scheduler)
+        if due := self.subreddit_scheduler.pop_due():
+            self.start_poll(self.poll_subreddits(subreddits=due))
+
+    @subreddit_task.before_loop
+    async def before_subreddit(self):
+        await self.wait_until_ready()  # wait until the bot logs in
+
+    async def poll_subreddits(self, subreddits: List[str]) -> None:
+        """Pulls new listings of subreddits then schedules their next poll
+
+        New listings are sent by the reddit_outbox_task.
+        """
+        new_listings: Dict[str, int] = {}
+        try:
+            with memory_ceiling("poll_subreddits"), metrics.TASK_SECONDS.time(
+                task="poll_subreddits"
+            ), span("subreddit_cycle", subreddits=len(subreddits)):
+                inserted = await self.pull_subreddit(subreddits=subreddits)
+            for listing in inserted:
+                key = Reddit.subreddit_key(listing.get("subreddit", ""))
+                new_listings[key] = new_listings.get(key, 0) + 1
+        finally:
+            for subreddit in subreddits:
+                key = Reddit.subreddit_key(subreddit)
+                self.subreddit_scheduler.complete(
+                    subreddit, new_entries=new_listings.get(key, 0) > 0
+                )
+
+    async def pull_subreddit(self, subreddits: List[str] | None = None) -> [dict]:
+        """Fetches the new listings of subscribed subreddits and stores them in the database
+
+        Every distinct subreddit is fetched once however many channels subscribe to it,
+        see Reddit.get_multireddit_submissions. Only submissions newer than the cursors
+        stored in the reddit_cursors collection are downloaded.
+
+        Args:
+            subreddits (List[str] | None, optional): Only pull these subreddits.
+                Defaults to None, in which case every subscribed subreddit is pulled.
+
+        Returns:
+            [dict]: The listings that were inserted
+        """
+        if subreddits is None:
+            subreddits = self.subscription_index.subreddits()
+        subscriptions: Dict[str, List[int]] = {
+            subreddit: channel_ids
+            for subreddit in subreddits
+            if (channel_ids := self.subscription_index.subreddit_channels(subreddit))
+        }
+        if not subscriptions:
+            return []
+        print(f"Pulling {len(subscriptions)} subreddits")
+        keys = list({Reddit.subreddit_key(subreddit) for subreddit in subscriptions})
+        cursor = self.reddit_cursors_collection.find({"_id": {"$in": keys}})
+        cursors = {}
+        async for documents in stream_batches(cursor):
+            cursors.update((doc.pop("_id"), doc) for doc in documents)
+        r = Reddit(session=self.http_session, reddit=self.reddit_client)
+        await r.get_multireddit_submissions(
+            subscriptions=subscriptions, cursors=cursors
+        )
+        for channel_id, error_msg in r.channel_errors.items():
+            await self.deliver(channel_id, content=error_msg)
+        await self.flush_deliveries()
+        with span("store", listings=len(r.res_dicts)):
+            inserted = await self.reddit_insert_new_documents(r.res_dicts)
+        # Cursors only move forward once the listings behind them are stored
+        if r.res_cursors:
+            await self.reddit_cursors_collection.bulk_write(
+                [
+                    UpdateOne({"_id": key}, {"$set": cursor}, upsert=True)
+                    for key, cursor in r.res_cursors.items()
+                ],
+                ordered=False,
+            )
+        return inserted
+
+    @tasks.loop(**SCHEDULER_TICK)
+    async def rss_feeds_task(self, *args, **kwargs):
+        """Starts a poll for the rss feeds that are due, see utils/scheduler.py
+
+        Only the feeds in the partitions leased by this process are polled.
+        """
+        feed_urls = [
+            feed_url
+            for feed_url in self.subscription_index.feed_urls()
+            if self.leases.owns(feed_url)
+        ]
+        new_feed_urls = [url for url in feed_urls if url not in self.rss_scheduler]
+        intervals, polled_at = await self.get_feed_poll_intervals(
+            feed_urls=new_feed_urls
+        )
+        self.rss_scheduler.sync(feed_urls, intervals=intervals, polled_at=polled_at)
+        self.report_overruns("rss", self.rss_scheduler)
+        if due := self.rss_scheduler.pop_due():
+            self.start_poll(self.poll_rss_feeds(feed_urls=due))
+
+    @rss_feeds_task.before_loop
+    async def before_rss_feeds_task(self):
+        await self.wait_until_ready()
+
+    async def poll_rss_feeds(self, feed_urls: List[str]) -> None:
+        """Updates feed_urls then adapts and stores their poll intervals"""
+        self.loop_monitor.reset()
+        new_entries: Dict[str, int] = {}
+        poll_hints: Dict[str, float | None] = {}
+        try:
+            with memory_ceiling("poll_rss_feeds"), metrics.TASK_SECONDS.time(
+                task="poll_rss_feeds"
+            ), span("rss_cycle", feeds=len(feed_urls)):
+                new_entries, poll_hints = await self.update_rss_feeds(
+                    feed_urls=feed_urls
+                )
+        finally:
+            intervals = {
+                feed_url: self.rss_scheduler.complete(
+                    feed_url,
+                    new_entries=new_entries.get(feed_url, 0) > 0,
+                    hint=poll_hints.get(feed_url),
+                )
+                for feed_url in feed_urls
+            }
+            await self.save_feed_poll_intervals(intervals=intervals)
+        print(f"Event loop blocking during rss poll: {self.loop_monitor.summary()}")
+        print(f"Render cache: {render_cache.stats()}")
+
+    async def update_all_rss_feeds(self) -> None:
+        """Sends RSS Feed Updates to every subscribed channel at once.
+
+        Passes every subscribed feed_url, see utils/subscriptions.py, to
+        update_rss_feeds. The rss_feeds_task polls feeds on their own schedule instead.
+
+        Returns:
+            None
+        """
+        feed_urls = self.subscription_index.feed_urls()
+        with span("rss_cycle", feeds=len(feed_urls)):
+            await self.update_rss_feeds(feed_urls=feed_urls)
+
+    async def update_rss_feeds(
+        self, feed_urls: List[str]
+    ) -> Tuple[Dict[str, int], Dict[str, float | None]]:
+        """Sends RSS Feed Updates to subscribed channels.
+
+        Checks if new entries have been added to feed_urls.
+        If entries have been added, the new entries are queued as embeds for the channel_ids
+        that subscribe to an updated rss feed.
+
+        Feeds are requested conditionally with the validators stored in the feeds
+        collection. A feed that responds with 304 Not Modified is skipped entirely.
+
+        This definition is the core logic of the rss_feeds_task.
+
+        Args:
+            feed_urls (List[str]): The feed urls to update
+
+        Returns:
+            Tuple[Dict[str, int], Dict[str, float | None]]: The number of new entries of each
+            fetched feed url and the poll interval hints of each fetched feed url
+        """
+        rss = RSSFeed(session=self.http_session)
+        new_entries: Dict[str, int] = {}
+        with span("mongo", op="get_feed_validators"):
+            validators = await self.get_feed_validators(feed_urls=feed_urls)
+        await rss.parse_feed_urls(feed_urls=feed_urls, validators=validators)
+        for error_msg in rss.feed_errors.values():
+            print(f"An error occurred updating rss feeds: {error_msg}")
+        print(
+            f"Of {len(feed_urls)} rss feeds {len(rss.not_modified)} have not been modified"
+        )
+        for request_url, (feed, entries) in zip(rss.res_urls, rss.res_dicts):
+            parsed_feed = rss.parse_feed_flat(feed)
+            feed_url = parsed_feed[0]
+            thumbnail = parsed_feed[-1]
+            with span("store", url=feed_url):
+                inserted_entries = await self.insert_new_rss_entries(
+                    feed_url=feed_url, thumbnail=thumbnail, entries=entries
+                )
+            new_entries[request_url] = len(inserted_entries)
+            if inserted_entries:
+                ## create embeds for inserted entries and send to channels that subscribe
+                embeds = await rss.render_entry_embeds(entries=inserted_entries)
+                await self.deliver_entries(feed_url=feed_url, embeds=embeds)
+        with span("flush_deliveries"):
+            await self.flush_deliveries()
+        with span("mongo", op="save_feed_validators"):
+            await self.save_feed_validators(
+                validators=rss.res_validators
+                | {
+                    url: {**rss.res_validators.get(url, {}), "last_seen": last_seen}
+                    for url, last_seen in rss.res_last_seen.items()
+                }
+            )
+        return new_entries, rss.res_poll_hints
+
+    async def deliver_entries(self, feed_url: str, embeds: List[discord.Embed]) -> None:
+        """Queues the embeds of a feed's new entries for every channel that subscribes
+
+        This is the fan-out of update_rss_feeds, see benchmarks/delivery.py
+
+        Args:
+            feed_url (str): The feed url the entries were stored under
+            embeds (List[discord.Embed]): An embed for each new entry
+        """
+        # Packed once, every channel is sent the same messages
+        embed_batches = pack_embeds(embeds)
+        for channel_id in self.subscription_index.feed_channels(feed_url):
+            with span("deliver", channel_id=channel_id):
+                for embed_batch in embed_batches:
+                    await self.deliver(channel_id, embeds=embed_batch)
+
+    async def get_feeds(self, feed_urls: List[str]) -> List[dict]:
+        """Returns the stored metadata of feed_urls shaped like feedparser's "feed" dictionary
+
+        Args:
+            feed_urls (List[str]): Feed urls
+
+        Returns:
+            List[dict]: Feeds in the order of feed_urls, ready for RSSFeed.create_about_embed
+        """
+        cursor = self.feeds_collection.find(
+            {"_id": {"$in": feed_urls}}, projection=FEED_METADATA_FIELDS
+        )
+        documents = {}
+        async for batch in stream_batches(cursor):
+            documents.update((doc.get("_id"), doc) for doc in batch)
+        return [
+            {
+                **documents[feed_url],
+                "feed_url": feed_url,
+                "image": {"href": documents[feed_url].get("image", "")},
+            }
+            for feed_url in feed_urls
+            if feed_url in documents
+        ]
+
+    async def get_feed_validators(self, feed_urls: List[str]) -> Dict[str, dict]:
+        """Returns the stored ETag/Last-Modified validators for feed_urls keyed by feed url
+
+        Args:
+            feed_urls (List[str]): Feed urls as requested by update_all_rss_feeds
+
+        Returns:
+            Dict[str, dict]: feed url -> {"etag": ..., "last_modified": ..., "last_seen": ...}
+        """
+        cursor = self.feeds_collection.find(
+            {"_id": {"$in": feed_urls}},
+            projection=["etag", "last_modified", "last_seen"],
+        )
+        validators = {}
+        async for documents in stream_batches(cursor):
+            validators.update((doc.get("_id"), doc) for doc in documents)
+        return validators
+
+    async def get_feed_poll_intervals(
+        self, feed_urls: List[str]
+    ) -> Tuple[Dict[str, float], Dict[str, float]]:
+        """Returns the stored poll intervals of feed_urls and the timestamps of their last polls"""
+        intervals, polled_at = {}, {}
+        if not feed_urls:
+            return intervals, polled_at
+        cursor = self.feeds_collection.find(
+            {"_id": {"$in": feed_urls}, "poll_interval": {"$exists": True}},
+            projection=["poll_interval", "polled_at"],
+        )
+        async for documents in stream_batches(cursor):
+            for doc in documents:
+                intervals[doc.get("_id")] = doc.get("poll_interval")
+                if doc.get("polled_at"):
+                    polled_at[doc.get("_id")] = doc["polled_at"].timestamp()
+        return intervals, polled_at
+
+    async def save_feed_poll_intervals(self, intervals: Dict[str, float]) -> None:
+        """Stores the adapted poll intervals so they survive a restart or a takeover"""
+        if not intervals:
+            return
+        now = datetime.now()
+        await self.feeds_collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": feed_url},
+                    {"$set": {"poll_interval": interval, "polled_at": now}},
+                )
+                for feed_url, interval in intervals.items()
+            ],
+            ordered=False,
+        )
+
+    async def save_feed_validators(self, validators: Dict[str, dict]) -> None:
+        """Upserts the validators of feeds that were downloaded in full.
+
+        Validators are only saved once a feed's entries have been stored, so an
+        interrupted cycle downloads the feed again instead of skipping it.
+
+        Args:
+            validators (Dict[str, dict]): feed url -> {"etag": ..., "last_modified": ...,
+                "last_seen": ...}, see feed_stream.last_seen_mark
+        """
+        if not validators:
+            return
+        now = datetime.now()
+        await self.feeds_collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": feed_url},
+                    {"$set": {**validator, "validators_updated_at": now}},
+                    upsert=True,
+                )
+                for feed_url, validator in validators.items()
+            ],
+            ordered=False,
+        )
+
+    async def insert_new_rss_entries(
+        self,
+        feed_url: str = "",
+        thumbnail: str = "",
+        entries: [dict] = {},
+        *args,
+        **kwargs,
+    ) -> [dict]:
+        """For each entry a document is created in the feed_entries collection if a matching document for the entry is not found.
+
+        Documents only hold FEED_ENTRY_FIELDS. The seen_at of entries that are already
+        stored is refreshed so they are kept for as long as the feed lists them, see
+        utils/retention.py
+
+        Unlike reddit_insert_new_documents at this time, entries are stored with out a channel_id.
+        The feed_url acts as the unique key. See update_all_rss_feeds for how this works for returning new feed_url entries
+        to channels with that given feed_url.
+
+        Entries are deduplicated by their "entry_key" (see RSSFeed.entry_key) which is backed by
+        a unique index, so the whole feed is written with a single unordered insert_many.
+        The keys of inserted entries are then written to feed_entry_keys, which keeps
+        them after the entries expired. An entry whose key is already there was sent
+        before and is stored again without being returned.
+
+        Args:
+            feed_url (str, optional): _description_. Defaults to "".
+            thumbnail (str, optional): _description_. Defaults to "".
+            entries (dict], optional): _description_. Defaults to {}.
+
+        Returns:
+            [dict]: The entries that were stored for the first time, with
+            feed_url, title, thumbnail and dt_published set
+        """
+        now = datetime.now()
+        full_entries = {}
+        documents = []
+        for entry in entries:
+            published = entry.get("published_parsed") or entry.get("updated_parsed")
+            dt = datetime.fromtimestamp(time.mktime(published)) if published else None
+            find_dict = {
+                "feed_url": feed_url,
+                "title": entry.get("title", ""),
+                "thumbnail": thumbnail,
+                "dt_published": dt,
+            }
+            entry_key = RSSFeed.entry_key(feed_url=feed_url, entry=entry)
+            full_entry = {**find_dict, **entry, "entry_key": entry_key, "seen_at": now}
+            full_entries[entry_key] = full_entry
+            documents.append(
+                {field: full_entry.get(field) for field in FEED_ENTRY_FIELDS}
+            )
+
+        inserted = await insert_many_ignore_duplicates(
+            self.feed_entries_collection, documents
+        )
+        inserted_keys = {doc["entry_key"] for doc in inserted}
+        if seen_keys := [key for key in full_entries if key not in inserted_keys]:
+            await self.feed_entries_collection.update_many(
+                {"entry_key": {"$in": seen_keys}}, {"$set": {"seen_at": now}}
+            )
+        new_keys = await insert_many_ignore_duplicates(
+            self.feed_entry_keys_collection,
+            [{"_id": doc["entry_key"], "stored_at": now} for doc in inserted],
+        )
+        metrics.STORED_ENTRIES.inc(len(inserted), kind="rss", result="inserted")
+        metrics.STORED_ENTRIES.inc(len(seen_keys), kind="rss", result="duplicate")
+        print(
+            f"Of {len(entries)} entries for {feed_url} {len(inserted)} have been added to db"
+        )
+        return [full_entries[doc["_id"]] for doc in new_keys]
+
+
+class HeadlessPoller(FeedPoller):
+    """Runs the polling pipeline without a discord connection
+
+    Messages are queued in the deliveries collection for the gateway to send.
+    """
+
+    def __init__(self, db_client=None):
+        super().__init__(db_client)
+        self.pending_deliveries: List[dict] = []
+
+    async def wait_until_ready(self) -> None:
+        """There is no gateway connection to wait for"""
+
+    async def deliver(self, channel_id: int, *args, **kwargs) -> None:
+        """Queues a message for the gateway, see utils/delivery.delivery_document"""
+        self.pending_deliveries.append(delivery_document(channel_id, *args, **kwargs))
+        if len(self.pending_deliveries) >= MONGO_BATCH_SIZE:
+            await self.flush_deliveries()
+
+    async def flush_deliveries(self) -> None:
+        """Writes the queued messages to the deliveries collection in one insert_many"""
+        documents, self.pending_deliveries = self.pending_deliveries, []
+        if documents:
+            await self.deliveries_collection.insert_many(documents)
+
+    async def run(self) -> None:
+        """Polls until the process receives SIGINT or SIGTERM"""
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopped.set)
+        await self.open_sessions()
+        self.loop_monitor.start()
+        await migrate(self.db)
+        await self.subscription_index.start(self.subscriptions_collection)
+        self.start_polling()
+        print(f"Headless poller {self.instance_id} started")
+        try:
+            await stopped.wait()
+        finally:
+            self.loop_monitor.stop()
+            await self.stop_polling()
+            await self.flush_deliveries()
+
+
+def main():
+    asyncio.run(HeadlessPoller().run())
@@ -0,0 +1,231 @@
+"""Profiles rss poll cycles offline
+
+    $ poetry run profile path/to/fixtures --channels 50 --mode cprofile
+
+Every file in the fixture directory is served as a feed by a local HTTP server, and
+--channels channels are subscribed to each one in a scratch database of a local
+MongoDB. update_all_rss_feeds then runs --cycles times with a stub sender that
+renders messages the way they are sent to discord but sends nothing, under cProfile
+or tracemalloc. A ranked hotspot report is printed at the end, next to the span
+summary of each cycle (see utils/tracing.py).
+
+The first cycle stores every entry and delivers it, the cycles after it are answered
+304 Not Modified the way unchanged feeds are in production.
+
+Parsing and rendering run on the event loop (--pool inline) by default, since
+cProfile does not see into the worker pool's processes and threads.
+
+Environment Variables:
+- MONGODB_URI
+    - The MongoDB holding the scratch database. Defaults to mongodb://localhost:27017
+"""
+
+import os
+import io
+import re
+import pstats
+import hashlib
+import asyncio
+import argparse
+import cProfile
+import tracemalloc
+import aiohttp
+from pathlib import Path
+from typing import List
+from xml.sax.saxutils import escape
+from aiohttp import web
+
+from .poller import FeedPoller, HeadlessPoller
+from .migrations import migrate
+from .utils import tracing, workers
+from .utils.tracing import span
+
+PROFILE_DATABASE = "feed_bot_profile"
+
+# rel="self" links of rss (atom:link) and atom documents and their href attribute
+SELF_LINK = re.compile(rb"<(?:atom:)?link\b[^>]*\brel=[\"']self[\"'][^>]*>")
+HREF = re.compile(rb"\bhref=(\"[^\"]*\"|'[^']*')")
+
+
+class ProfilePoller(HeadlessPoller):
+    """A HeadlessPoller that renders its messages instead of queueing them"""
+
+    def __init__(self, database_name: str = PROFILE_DATABASE, db_client=None):
+        self.database_name = database_name
+        super().__init__(db_client)
+        self.messages = 0
+        self.embeds = 0
+
+    async def deliver(self, channel_id: int, *args, **kwargs) -> None:
+        """Serializes the message like Messageable.send does, then drops it"""
+        embeds = list(kwargs.get("embeds") or [])
+        if embed := kwargs.get("embed"):
+            embeds.append(embed)
+        for embed in embeds:
+            embed.to_dict()
+        self.messages += 1
+        self.embeds += len(embeds)
+
+    async def flush_deliveries(self) -> None:
+        """Nothing is queued"""
+
+
+def point_self_links(document: bytes, url: str) -> bytes:
+    """Points the self links of a feed document at url"""
+    href = f'href="{escape(url)}"'.encode()
+    return SELF_LINK.sub(
+        lambda match: HREF.sub(lambda _: href, match.group(0)), document
+    )
+
+
+async def serve_fixtures(directory: Path) -> web.AppRunner:
+    """Serves the files of directory on a free port of 127.0.0.1
+
+    The self link of a fixture is pointed at the url it is served from, which is the
+    url the poller stores its entries under and fans them out by (see
+    RSSFeed.parse_feed_flat), as a feed subscribed to with .rss add. parse_feed_flat
+    only reads self links typed application/rss+xml, so atom fixtures are fetched and
+    stored like in the bot but render no messages. Responses carry an ETag, so
+    unchanged fixtures are answered 304 Not Modified.
+    """
+
+    async def fixture(request: web.Request) -> web.Response:
+        path = directory / request.match_info["name"]
+        if not path.is_file():
+            raise web.HTTPNotFound()
+        body = point_self_links(path.read_bytes(), str(request.url))
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(body=body, headers={"ETag": etag})
+
+    app = web.Application()
+    app.router.add_get("/{name}", fixture)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner
+
+
+async def seed(poller: FeedPoller, feed_urls: List[str], channels: int) -> None:
+    """Drops the scratch database and subscribes channels to every feed
+
+    The poller's subscription index is loaded from the seeded subscriptions, see
+    utils/subscriptions.py
+    """
+    await poller.db_client.drop_database(poller.database_name)
+    await migrate(poller.db)
+    await poller.subscriptions_collection.insert_many(
+        [
+            {"channel_id": channel_id, "feed_url": feed_url}
+            for feed_url in feed_urls
+            for channel_id in range(1, channels + 1)
+        ]
+    )
+    await poller.subscription_index.load(poller.subscriptions_collection)
+
+
+def hotspots(profiler: cProfile.Profile, top: int) -> str:
+    """Ranks the functions of a cProfile run by cumulative then own time"""
+    output = io.StringIO()
+    stats = pstats.Stats(profiler, stream=output).strip_dirs()
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(top)
+    return output.getvalue()
+
+
+def allocations(snapshot: tracemalloc.Snapshot, top: int) -> str:
+    """Ranks the lines that allocated the most memory still held"""
+    lines = [f"Top {top} allocations by line"]
+    for stat in snapshot.statistics("lineno")[:top]:
+        lines.append(f"  {stat}")
+    return "\n".join(lines)
+
+
+async def profile(args: argparse.Namespace, db_client=None) -> ProfilePoller:
+    """Runs the profile described by args, see the module docstring
+
+    Args:
+        args (argparse.Namespace): The parsed command line, see main
+        db_client (optional): motor client. Defaults to None, a client of MONGODB_URI.
+            Tests pass a stand-in, see benchmarks/memory_db.py
+
+    Returns:
+        ProfilePoller: The poller that ran the cycles, with its message counts
+    """
+    fixtures = Path(args.fixtures)
+    files = sorted(path.name for path in fixtures.iterdir() if path.is_file())
+    if not files:
+        raise SystemExit(f"No fixture files in {fixtures}")
+    if args.database == FeedPoller.database_name:
+        raise SystemExit(f"Refusing to drop the bot's database {args.database}")
+    os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017")
+
+    runner = await serve_fixtures(fixtures)
+    host, port = runner.addresses[0][:2]
+    feed_urls = [f"http://{host}:{port}/{name}" for name in files]
+    poller = ProfilePoller(database_name=args.database, db_client=db_client)
+    # rss feeds only, so no reddit client is needed
+    poller.http_session = aiohttp.ClientSession()
+    try:
+        await seed(poller, feed_urls, args.channels)
+        print(
+            f"Profiling {args.cycles} cycles of {len(feed_urls)} feeds with "
+            f"{args.channels} channels each ({args.mode})"
+        )
+        tracing.TRACE_SLOW_SECONDS = args.slow
+        workers.WORKER_POOL = args.pool
+        profiler = cProfile.Profile() if args.mode == "cprofile" else None
+        if args.mode == "tracemalloc":
+            tracemalloc.start(args.frames)
+        for cycle in range(1, args.cycles + 1):
+            if profiler:
+                profiler.enable()
+            with span("profile_cycle", report=True, cycle=cycle):
+                await poller.update_all_rss_feeds()
+            if profiler:
+                profiler.disable()
+        print(f"Rendered {poller.messages} messages with {poller.embeds} embeds")
+        if profiler:
+            print(hotspots(profiler, args.top))
+            if args.output:
+                profiler.dump_stats(args.output)
+                print(f"cProfile stats written to {args.output}")
+        elif args.mode == "tracemalloc":
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"Traced memory: {current} bytes held, {peak} bytes at peak")
+            print(allocations(snapshot, args.top))
+    finally:
+        await poller.stop_polling()
+        await runner.cleanup()
+    return poller
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("fixtures", help="Directory of feed documents")
+    parser.add_argument(
+        "--channels", type=int, default=10, help="Channels subscribed to each feed"
+    )
+    parser.add_argument("--cycles", type=int, default=2, help="Poll cycles to run")
+    parser.add_argument(
+        "--mode", choices=["cprofile", "tracemalloc", "none"], default="cprofile"
+    )
+    parser.add_argument(
+        "--pool",
+        choices=["inline", "thread", "process"],
+        default="inline",
+        help="Worker pool parsing and rendering run in, see utils/workers.py",
+    )
+    parser.add_argument("--top", type=int, default=25, help="Hotspots to report")
+    parser.add_argument(
+        "--frames", type=int, default=1, help="Frames tracemalloc keeps per allocation"
+    )
+    parser.add_argument(
+        "--slow", type=float, default=1.0, help="Seconds a span is logged after"
+    )
+    parser.add_argument("--database", default=PROFILE_DATABASE)
+    parser.add_argument("--output", help="Write the cProfile stats to this file")
+    asyncio.run(profile(parser.parse_args()))
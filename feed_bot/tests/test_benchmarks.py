@@ -0,0 +1,195 @@
+import asyncio
+import json
+import pytest
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from ..benchmarks import baselines
+from ..benchmarks.corpus import feed_document
+from ..benchmarks.delivery import (
+    GLOBAL_LIMIT,
+    ROUTE_LIMIT,
+    DiscordAPI,
+    VirtualClockLoop,
+    percentile,
+    run_scale,
+)
+from ..benchmarks.memory_db import MemoryClient
+from ..benchmarks.poll_cycle import run_poll_cycle, subscriptions
+from ..migrations import migrate
+
+
+class TestMemoryDatabase:
+    """Test the in-memory stand-in for motor used by the benchmarks"""
+
+    @pytest.mark.asyncio
+    async def test_queries_and_updates(self):
+        client = MemoryClient()
+        collection = client["feed_bot"]["subscriptions"]
+        await collection.insert_many(
+            [
+                {"channel_id": 1, "feed_url": "a"},
+                {"channel_id": 2, "feed_url": "a"},
+                {"channel_id": 2, "feed_url": "b"},
+            ]
+        )
+        assert await collection.count_documents({"feed_url": "a"}) == 2
+        assert sorted(await collection.distinct("channel_id")) == [1, 2]
+        docs = await collection.find(
+            {"channel_id": {"$in": [2]}}, projection={"_id": 0, "feed_url": 1}
+        ).to_list(None)
+        assert docs == [{"feed_url": "a"}, {"feed_url": "b"}]
+        await collection.bulk_write(
+            [UpdateOne({"feed_url": "c"}, {"$set": {"channel_id": 3}}, upsert=True)]
+        )
+        assert await collection.find_one({"feed_url": "c"}, {"_id": 0}) == {
+            "feed_url": "c",
+            "channel_id": 3,
+        }
+        assert client.ops["subscriptions.insert"] == 1
+        assert client.ops["subscriptions.find"] == 2
+
+    @pytest.mark.asyncio
+    async def test_unique_index(self):
+        client = MemoryClient()
+        db = client["feed_bot"]
+        await migrate(db)
+        collection = db["feed_entries"]
+        await collection.insert_one({"entry_key": "a"})
+        with pytest.raises(BulkWriteError) as error:
+            await collection.insert_many(
+                [{"entry_key": "a"}, {"entry_key": "b"}], ordered=False
+            )
+        assert error.value.details["nInserted"] == 1
+        assert await collection.count_documents({}) == 2
+
+
+class TestPollCycleBenchmark:
+    """Test the end-to-end poll cycle benchmark"""
+
+    def test_subscriptions_share_channels(self):
+        documents = subscriptions(["a", "b", "c", "d"], ["sub"], channels=2)
+        assert len(documents) == 10
+        assert len({doc["channel_id"] for doc in documents}) == 2
+        assert {"channel_id": 1, "subreddit": "sub"} not in documents[:8]
+
+    def test_feed_document_has_self_link(self):
+        document = feed_document(3, entries=2, generation=1, self_url="http://x/3.xml")
+        assert b'<atom:link href="http://x/3.xml" rel="self"' in document
+        assert document.index(b"Entry 2 of feed 3") < document.index(b"Entry 1 of")
+
+    @pytest.mark.asyncio
+    async def test_run_poll_cycle(self):
+        results = await run_poll_cycle(
+            feeds=3, entries=12, channels=2, subreddits=1, submissions=2
+        )
+        cold = results["cold"]
+        assert cold["feed_requests"] == 3
+        assert cold["mongo_ops_by_site"]["feed_entries.insert"] == 3
+        # 3 feeds and 1 subreddit to 2 channels, 12 entries take 2 messages and the
+        # submissions fit in one
+        assert cold["messages"] == 3 * 2 * 2 + 2
+        assert cold["embeds"] == 3 * 2 * 12 + 2 * 2
+        not_modified = results["not_modified"]
+        assert not_modified["feeds_not_modified"] == 3
+        assert "messages" not in not_modified
+        assert "bytes_fetched" not in not_modified or not not_modified["bytes_fetched"]
+        one_new = results["one_new"]
+        assert one_new["embeds"] == 3 * 2 + 2
+        assert results["subscriptions"] == 8
+        assert results["peak_rss_bytes"] > 0
+
+
+class TestDeliverySimulator:
+    """Test the delivery load simulator"""
+
+    def run_virtual(self, coro):
+        with asyncio.Runner(loop_factory=VirtualClockLoop) as runner:
+            return runner.run(coro)
+
+    def test_virtual_clock(self):
+        async def sleep_an_hour():
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(asyncio.sleep(3600), asyncio.sleep(60))
+            return loop.time()
+
+        assert self.run_virtual(sleep_an_hour()) == pytest.approx(3600)
+
+    def test_rate_limits(self):
+        url = "https://discord.com/api/v10/channels/{}/messages"
+
+        async def requests():
+            api = DiscordAPI()
+            statuses = [
+                api.respond("POST", url.format(1), "{}").status
+                for _ in range(ROUTE_LIMIT + 1)
+            ]
+            await asyncio.sleep(5)
+            for channel in range(GLOBAL_LIMIT):
+                api.respond("POST", url.format(channel), "{}")
+            limited = api.respond("POST", url.format(GLOBAL_LIMIT), "{}")
+            await asyncio.sleep(1)
+            embeds = [{"description": "x" * 700}] * 9
+            too_long = api.respond(
+                "POST", url.format(1), json.dumps({"embeds": embeds})
+            )
+            return statuses, limited, too_long, api.counts
+
+        statuses, limited, too_long, counts = self.run_virtual(requests())
+        assert statuses == [200] * ROUTE_LIMIT + [429]
+        assert limited.status == 429
+        assert limited.headers["X-RateLimit-Scope"] == "global"
+        assert json.loads(limited.body)["global"] is True
+        assert too_long.status == 400
+        assert counts["rate_limited_user"] == counts["rate_limited_global"] == 1
+        assert counts["rejected"] == 1
+
+    def test_percentile(self):
+        assert percentile([], 0.5) == 0.0
+        assert percentile([3, 1, 2, 4], 0.5) == 2
+        assert percentile(list(range(1, 101)), 0.99) == 99
+
+    def test_simulate(self):
+        results = run_scale(dict(channels=40, feeds_per_channel=2, channels_per_feed=4))
+        rss = results["rss"]
+        assert results["feeds"] == 20
+        assert rss["messages"] == results["subscriptions"] == 80
+        assert rss["embeds"] == 80 * 2
+        assert rss["channels"] == 40
+        assert (
+            rss["lag_p50_seconds"] <= rss["lag_p99_seconds"] <= rss["makespan_seconds"]
+        )
+        # sends are spaced to DELIVERY_GLOBAL_RATE per second
+        assert rss["makespan_seconds"] >= 80 / 45
+        assert results["call_for_support"]["messages"] == 40
+        assert "rejected" not in rss and rss["dropped"] == 0
+
+
+class TestBaselines:
+    """Test saving and comparing benchmark baselines"""
+
+    def test_flatten(self):
+        results = {"10": {"cold": {"wall_seconds": 1.0, "mongo_ops": 5}}, "note": "x"}
+        assert baselines.flatten(results) == {
+            "10.cold.wall_seconds": 1.0,
+            "10.cold.mongo_ops": 5,
+        }
+
+    def test_compare(self, capsys):
+        baseline = {"10": {"wall_seconds": 1.0, "mongo_ops": 5}}
+        assert not baselines.compare(
+            baseline, {"10": {"wall_seconds": 1.2, "mongo_ops": 5}}, tolerance=0.25
+        )
+        assert baselines.compare(
+            baseline, {"10": {"wall_seconds": 1.0, "mongo_ops": 6}}, tolerance=0.25
+        )
+        assert "10.mongo_ops: 5 -> 6 (+20.0%) REGRESSION" in capsys.readouterr().out
+        assert baselines.compare(
+            {"entries_per_second": 100}, {"entries_per_second": 50}, tolerance=0.25
+        )
+
+    def test_save_and_load(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(baselines, "BASELINES_DIR", tmp_path)
+        assert baselines.load_baseline("example") is None
+        baselines.save_baseline("example", {"results": {"a": 1}})
+        assert baselines.load_baseline("example") == {"results": {"a": 1}}
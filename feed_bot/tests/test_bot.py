@@ -0,0 +1,82 @@
+import asyncio
+import pytest
+
+from ..benchmarks.memory_db import MemoryClient
+from ..benchmarks.poll_cycle import BenchmarkBot
+from ..migrations import migrate
+from ..utils import metrics, streaming
+from ..utils.delivery import DeliveryQueue, delivery_document
+from ..utils.outbox import Outbox
+
+
+class TestFeedBot:
+    """Test FeedBot's outbox tasks on an in-memory database"""
+
+    async def bot(self, send) -> BenchmarkBot:
+        bot = BenchmarkBot(db_client=MemoryClient())
+        await migrate(bot.db)
+        bot.delivery = DeliveryQueue(send=send, rate=0)
+        bot.delivery.start()
+        return bot
+
+    @pytest.mark.asyncio
+    async def test_lease_expires_during_a_send(self):
+        sent = []
+
+        async def slow_send(channel_id, *args, **kwargs):
+            await asyncio.sleep(0.1)  # held up by rate limits
+            sent.append(channel_id)
+
+        bot = await self.bot(slow_send)
+        bot.delivery_outbox.lease_seconds = 0.03
+        other = Outbox(bot.deliveries_collection, owner="bot-b", lease_seconds=0.03)
+        await bot.deliveries_collection.insert_many(
+            [delivery_document(channel_id, content="Hi") for channel_id in (1, 2)]
+        )
+        try:
+            posting = asyncio.create_task(bot.post_deliveries())
+            await asyncio.sleep(0.06)  # past the lease the batch was claimed with
+            assert await other.claim() == []
+            await posting
+        finally:
+            bot.delivery.stop()
+        assert sorted(sent) == [1, 2]
+        assert await bot.deliveries_collection.count_documents({"sent": False}) == 0
+        assert await other.claim() == []
+
+    @pytest.mark.asyncio
+    async def test_post_deliveries_under_memory_ceiling(self, monkeypatch):
+        monkeypatch.setattr(metrics.REGISTRY, "enabled", True)
+        monkeypatch.setattr(streaming, "TASK_MEMORY_CEILING", 64 * 1024 * 1024)
+        monkeypatch.setattr(metrics.TASK_PEAK_BYTES, "values", {})
+        monkeypatch.setattr(metrics.TASK_MEMORY_CEILING_EXCEEDED, "values", {})
+        sent = []
+
+        async def send(channel_id, *args, **kwargs):
+            sent.append(channel_id)
+
+        bot = await self.bot(send)
+        await bot.deliveries_collection.insert_many(
+            [delivery_document(channel_id, content="Hi") for channel_id in range(300)]
+        )
+        try:
+            await bot.post_deliveries()
+        finally:
+            bot.delivery.stop()
+        assert len(sent) == 300
+        peak = metrics.TASK_PEAK_BYTES.values[("post_deliveries",)]
+        assert 0 < peak < streaming.TASK_MEMORY_CEILING
+        assert metrics.TASK_MEMORY_CEILING_EXCEEDED.values == {}
+
+        # the ceiling is advisory, a task above it is counted and still finishes
+        monkeypatch.setattr(streaming, "TASK_MEMORY_CEILING", 1)
+        bot = await self.bot(send)
+        await bot.deliveries_collection.insert_many(
+            [delivery_document(1, content="Hi")]
+        )
+        try:
+            await bot.post_deliveries()
+        finally:
+            bot.delivery.stop()
+        assert len(sent) == 301
+        assert metrics.TASK_MEMORY_CEILING_EXCEEDED.values == {("post_deliveries",): 1}
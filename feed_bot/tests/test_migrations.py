@@ -0,0 +1,156 @@
+from datetime import datetime
+import pytest
+from bson import ObjectId
+
+from ..benchmarks.memory_db import MemoryClient
+from ..migrations import (
+    RETENTION_FIELDS_MIGRATION,
+    convert_reddit_document,
+    convert_rss_document,
+    convert_rss_validators_document,
+    migrate_feed_entry_keys,
+    migrate_retention_fields,
+)
+from ..utils.reddit import Reddit
+from ..utils.rss import RSSFeed
+
+FEED_URL = "https://example.com/feed/"
+
+
+class TestSplitCollectionsMigration:
+    """Test the legacy document converters of the split_collections migration"""
+
+    def test_convert_rss_subscription(self):
+        doc = {
+            "_id": ObjectId(),
+            "channel_id": 1234,
+            "feed_url": FEED_URL,
+            "title": "Example",
+            "image": "https://example.com/image.png",
+        }
+        (subscriptions, subscription), (feeds, feed) = convert_rss_document(doc)
+        assert subscriptions == "subscriptions"
+        assert subscription._filter == {"channel_id": 1234, "feed_url": FEED_URL}
+        assert subscription._doc == {"$setOnInsert": {"_id": doc["_id"]}}
+        assert feeds == "feeds"
+        assert feed._filter == {"_id": FEED_URL}
+        assert feed._doc == {
+            "$setOnInsert": {
+                "title": "Example",
+                "image": "https://example.com/image.png",
+            }
+        }
+
+    def test_convert_rss_entry(self):
+        doc = {
+            "_id": ObjectId(),
+            "feed_url": FEED_URL,
+            "title": "First Post",
+            "dt_published": datetime(2024, 1, 1),
+            "link": "https://example.com/first-post",
+        }
+        [(collection_name, entry)] = convert_rss_document(doc)
+        assert collection_name == "feed_entries"
+        assert entry._filter == {"entry_key": RSSFeed.entry_key(FEED_URL, doc)}
+        assert entry._doc == {"$setOnInsert": doc}
+
+        [(_, keyed_entry)] = convert_rss_document({**doc, "entry_key": "key"})
+        assert keyed_entry._filter == {"entry_key": "key"}
+        assert keyed_entry._doc == {"$setOnInsert": doc}
+
+    def test_convert_rss_validators(self):
+        doc = {"_id": FEED_URL, "etag": '"v1"', "last_modified": None}
+        [(collection_name, feed)] = convert_rss_validators_document(doc)
+        assert collection_name == "feeds"
+        assert feed._filter == {"_id": FEED_URL}
+        assert feed._doc == {"$set": {"etag": '"v1"', "last_modified": None}}
+
+    def test_convert_reddit_documents(self):
+        reference = {"_id": ObjectId(), "channel_id": 1234, "subreddit": "linux"}
+        [(collection_name, subscription)] = convert_reddit_document(reference)
+        assert collection_name == "subscriptions"
+        assert subscription._filter == {"channel_id": 1234, "subreddit": "linux"}
+
+        listing = {
+            "_id": ObjectId(),
+            "channel_id": 1234,
+            "subreddit": "r/linux",
+            "title": "A post",
+            "link": "/r/linux/comments/abc/a_post/",
+            "sent": True,
+        }
+        [(collection_name, reddit_listing)] = convert_reddit_document(listing)
+        assert collection_name == "reddit_listings"
+        assert reddit_listing._filter == {
+            "listing_key": Reddit.listing_key(1234, "r/linux", listing["link"])
+        }
+        assert reddit_listing._doc == {"$setOnInsert": listing}
+
+
+class TestRetentionFieldsMigration:
+    """Test the retention_fields migration"""
+
+    @pytest.mark.asyncio
+    async def test_migrate_retention_fields(self):
+        db = MemoryClient()["feed_bot_db"]
+        seen_at = datetime(2024, 1, 2)
+        entry = {"entry_key": "a", "feed_url": FEED_URL, "title": "A"}
+        await db["feed_entries"].insert_many(
+            [
+                {**entry, "summary": "<p>A</p>", "content": [], "published": "Mon"},
+                {**entry, "entry_key": "b", "seen_at": seen_at},
+                {**entry, "entry_key": "c"},
+                {**entry, "entry_key": "d", "seen_at": seen_at, "links": []},
+            ]
+        )
+        await db["reddit_listings"].insert_many(
+            [
+                {"listing_key": "sent", "sent": True},
+                {"listing_key": "dated", "sent": True, "sent_at": seen_at},
+                {"listing_key": "unsent", "sent": False},
+            ]
+        )
+        await migrate_retention_fields(db, batch_size=2)
+
+        entries = {
+            doc["entry_key"]: doc for doc in await db["feed_entries"].find().to_list()
+        }
+        assert set(entries["a"]) == {"_id", "entry_key", "feed_url", "title", "seen_at"}
+        assert entries["b"]["seen_at"] == seen_at
+        assert "seen_at" in entries["c"]
+        assert entries["d"]["seen_at"] == seen_at and "links" not in entries["d"]
+        listings = {
+            doc["listing_key"]: doc
+            for doc in await db["reddit_listings"].find().to_list()
+        }
+        assert "sent_at" in listings["sent"]
+        assert listings["dated"]["sent_at"] == seen_at
+        assert "sent_at" not in listings["unsent"]
+
+        state = await db["migrations"].find_one({"_id": RETENTION_FIELDS_MIGRATION})
+        assert state["done"] is True
+        # later startups do not scan the collections again
+        await db["feed_entries"].insert_one({**entry, "entry_key": "e"})
+        finds = db.client.ops["feed_entries.find"]
+        await migrate_retention_fields(db)
+        assert db.client.ops["feed_entries.find"] == finds
+        assert "seen_at" not in await db["feed_entries"].find_one({"entry_key": "e"})
+
+
+class TestFeedEntryKeysMigration:
+    """Test the feed_entry_keys migration"""
+
+    @pytest.mark.asyncio
+    async def test_migrate_feed_entry_keys(self):
+        db = MemoryClient()["feed_bot_db"]
+        await db["feed_entries"].insert_many(
+            [{"entry_key": key, "feed_url": FEED_URL} for key in "abc"]
+        )
+        await db["feed_entry_keys"].insert_one({"_id": "a", "stored_at": 1})
+        await migrate_feed_entry_keys(db, batch_size=2)
+        keys = await db["feed_entry_keys"].find().to_list()
+        assert sorted(doc["_id"] for doc in keys) == ["a", "b", "c"]
+        assert await db["feed_entry_keys"].find_one({"_id": "a"}) == {
+            "_id": "a",
+            "stored_at": 1,
+        }
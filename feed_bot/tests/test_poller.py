@@ -0,0 +1,169 @@
+import asyncio
+import discord
+import pytest
+from unittest.mock import AsyncMock
+from aiohttp import web
+
+from .. import poller as poller_module
+from ..poller import FeedPoller, HeadlessPoller
+from ..benchmarks.memory_db import MemoryClient
+from ..migrations import migrate
+from ..utils import workers
+from ..utils.delivery import delivery_kwargs
+
+FEED_XML = """<?xml version="1.0"?>
+<rss version="2.0">
+  <channel>
+    <title>Example</title>
+    <link>https://example.com/</link>
+    <description>An example feed</description>
+    {items}
+  </channel>
+</rss>
+"""
+
+ITEM_XML = """<item>
+      <title>{day}</title>
+      <link>https://example.com/{day}</link>
+      <guid>https://example.com/{day}</guid>
+      <pubDate>{day:02d} Jan 2024 00:00:00 GMT</pubDate>
+    </item>"""
+
+
+class TestHeadlessPoller:
+    """Test the fan-out and the delivery queue of the headless poller"""
+
+    def test_deliver_is_abstract(self):
+        class Poller(FeedPoller):
+            async def wait_until_ready(self) -> None:
+                pass
+
+        with pytest.raises(TypeError, match="deliver"):
+            Poller(db_client=MemoryClient())
+
+    @pytest.mark.asyncio
+    async def test_deliveries_are_queued_in_batches(self, monkeypatch):
+        monkeypatch.setattr(poller_module, "MONGO_BATCH_SIZE", 2)
+        poller = HeadlessPoller()
+        poller.deliveries_collection = AsyncMock()
+        embed = discord.Embed(title="First Post", url="https://example.com/first")
+
+        await poller.deliver(1, embeds=[embed])
+        poller.deliveries_collection.insert_many.assert_not_awaited()
+        await poller.deliver(2, content="Subreddit not found")
+        [documents] = poller.deliveries_collection.insert_many.await_args.args
+        assert [doc["channel_id"] for doc in documents] == [1, 2]
+        assert all(doc["sent"] is False for doc in documents)
+
+        sent = delivery_kwargs(documents[0])
+        assert list(sent) == ["embeds"]
+        assert sent["embeds"][0].to_dict() == embed.to_dict()
+        assert delivery_kwargs(documents[1]) == {"content": "Subreddit not found"}
+
+        await poller.deliver(3, embed=embed)
+        await poller.flush_deliveries()
+        [documents] = poller.deliveries_collection.insert_many.await_args.args
+        assert documents[0]["embeds"] == [embed.to_dict()]
+        await poller.flush_deliveries()  # nothing left to write
+        assert poller.deliveries_collection.insert_many.await_count == 2
+
+    @pytest.mark.asyncio
+    async def test_stop_polling_waits_for_polls(self):
+        poller = HeadlessPoller(db_client=MemoryClient())
+        events = []
+
+        async def poll():
+            try:
+                await asyncio.sleep(60)
+            finally:
+                await asyncio.sleep(0)
+                events.append("poll stopped")
+
+        async def release():
+            events.append("leases released")
+
+        poller.leases.release = release
+        poller.start_poll(poll())
+        await asyncio.sleep(0)
+        await poller.stop_polling()
+        assert events == ["poll stopped", "leases released"]
+        assert not poller.poll_tasks
+
+    @pytest.mark.asyncio
+    async def test_fan_out_reads_the_subscription_index(self):
+        poller = HeadlessPoller()
+        poller.subscriptions_collection = AsyncMock()
+        poller.deliveries_collection = AsyncMock()
+        poller.subscription_index.add(1, "feed_url", "https://example.com/")
+        poller.subscription_index.add(2, "feed_url", "https://example.com/")
+        poller.subscription_index.add(2, "feed_url", "https://other.com/")
+        embed = discord.Embed(title="First Post", url="https://example.com/first")
+
+        await poller.deliver_entries(feed_url="https://example.com/", embeds=[embed])
+        assert sorted(doc["channel_id"] for doc in poller.pending_deliveries) == [1, 2]
+        poller.subscriptions_collection.aggregate.assert_not_called()
+        poller.subscriptions_collection.find.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_expired_entries_are_not_resent(self, aiohttp_client, monkeypatch):
+        monkeypatch.setattr(workers, "WORKER_POOL", "inline")
+        days = [3, 2, 1]
+
+        async def feed(request):
+            items = "".join(ITEM_XML.format(day=day) for day in days)
+            return web.Response(text=FEED_XML.format(items=items))
+
+        app = web.Application()
+        app.router.add_get("/feed", feed)
+        poller = HeadlessPoller(db_client=MemoryClient())
+        await migrate(poller.db)
+        poller.http_session = await aiohttp_client(app)
+        poller.deliver_entries = AsyncMock()
+
+        async def poll() -> list:
+            poller.deliver_entries.reset_mock()
+            await poller.update_rss_feeds(feed_urls=["/feed"])
+            if not poller.deliver_entries.await_count:
+                return []
+            return [
+                embed.title
+                for embed in poller.deliver_entries.await_args.kwargs["embeds"]
+            ]
+
+        assert await poll() == ["3", "2", "1"]
+        # reading stops below the mark, so the seen_at of 2 and 1 is not refreshed
+        days = [4, 3, 2, 1]
+        assert await poll() == ["4"]
+        # and they expire while the feed still lists them
+        await poller.feed_entries_collection.delete_many({"title": {"$in": ["2", "1"]}})
+        # out of order, so the whole feed is read and the expired entries are stored
+        # again, but only the new entry is sent
+        days = [4, 5, 3, 2, 1]
+        assert await poll() == ["5"]
+        assert await poller.feed_entries_collection.count_documents({}) == 5
+        assert await poll() == []
+
+    @pytest.mark.asyncio
+    async def test_back_dated_entries_are_sent(self, aiohttp_client, monkeypatch):
+        monkeypatch.setattr(workers, "WORKER_POOL", "inline")
+        days = [3, 2]
+
+        async def feed(request):
+            items = "".join(ITEM_XML.format(day=day) for day in days)
+            return web.Response(text=FEED_XML.format(items=items))
+
+        app = web.Application()
+        app.router.add_get("/feed", feed)
+        poller = HeadlessPoller(db_client=MemoryClient())
+        await migrate(poller.db)
+        poller.http_session = await aiohttp_client(app)
+        poller.deliver_entries = AsyncMock()
+
+        await poller.update_rss_feeds(feed_urls=["/feed"])
+        poller.deliver_entries.reset_mock()
+        # a new entry dated before the last seen mark, listed out of order so the
+        # whole feed is read
+        days = [4, 5, 1, 3, 2]
+        await poller.update_rss_feeds(feed_urls=["/feed"])
+        embeds = poller.deliver_entries.await_args.kwargs["embeds"]
+        assert [embed.title for embed in embeds] == ["4", "5", "1"]
@@ -0,0 +1,103 @@
+import argparse
+import cProfile
+from pathlib import Path
+import aiohttp
+import discord
+import pytest
+
+from ..benchmarks.memory_db import MemoryClient
+from ..profiler import (
+    ProfilePoller,
+    hotspots,
+    point_self_links,
+    profile,
+    serve_fixtures,
+)
+from ..utils import tracing, workers
+
+FIXTURES = Path(__file__).parents[1] / "benchmarks" / "feeds"
+
+
+class TestProfiler:
+    """Test the offline profiling entry point"""
+
+    @pytest.mark.asyncio
+    async def test_deliver_renders_messages(self):
+        poller = ProfilePoller(database_name="feed_bot_profile_test")
+        assert poller.db.name == "feed_bot_profile_test"
+        embed = discord.Embed(title="First Post", url="https://example.com/first")
+        await poller.deliver(1, embeds=[embed, embed])
+        await poller.deliver(2, embed=embed)
+        await poller.deliver(3, content="Subreddit not found")
+        assert (poller.messages, poller.embeds) == (3, 3)
+
+    @pytest.mark.asyncio
+    async def test_serve_fixtures(self, tmp_path):
+        (tmp_path / "feed.xml").write_text(
+            '<rss><channel><atom:link href="https://example.com/feed" rel="self" '
+            'type="application/rss+xml"/></channel></rss>'
+        )
+        runner = await serve_fixtures(tmp_path)
+        host, port = runner.addresses[0][:2]
+        url = f"http://{host}:{port}/feed.xml"
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(url) as response:
+                    assert response.status == 200
+                    assert (
+                        f'<atom:link href="{url}" rel="self"' in await response.text()
+                    )
+                    etag = response.headers["ETag"]
+                async with session.get(
+                    url, headers={"If-None-Match": etag}
+                ) as response:
+                    assert response.status == 304
+                async with session.get(f"http://{host}:{port}/missing.xml") as response:
+                    assert response.status == 404
+        finally:
+            await runner.cleanup()
+
+    def test_point_self_links(self):
+        document = (
+            b'<feed><link rel="self" href="https://a.com/atom.xml"/>'
+            b'<link rel="alternate" href="https://a.com/"/></feed>'
+        )
+        assert point_self_links(document, "http://127.0.0.1/atom.xml?a=1&b=2") == (
+            b'<feed><link rel="self" href="http://127.0.0.1/atom.xml?a=1&amp;b=2"/>'
+            b'<link rel="alternate" href="https://a.com/"/></feed>'
+        )
+
+    def test_hotspots(self):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        sorted(range(1000), key=str)
+        profiler.disable()
+        assert "cumulative" in hotspots(profiler, top=5)
+
+    @pytest.mark.asyncio
+    async def test_profile(self, monkeypatch, capsys):
+        monkeypatch.setattr(workers, "WORKER_POOL", "inline")
+        monkeypatch.setattr(tracing, "TRACE_SLOW_SECONDS", tracing.TRACE_SLOW_SECONDS)
+        args = argparse.Namespace(
+            fixtures=str(FIXTURES),
+            channels=2,
+            cycles=2,
+            mode="none",
+            pool="inline",
+            top=5,
+            frames=1,
+            slow=1.0,
+            database="feed_bot_profile_test",
+            output=None,
+        )
+        client = MemoryClient()
+        poller = await profile(args, db_client=client)
+        output = capsys.readouterr().out
+        # every xml fixture is fetched, then answered 304 Not Modified
+        assert "Of 6 rss feeds 0 have not been modified" in output
+        assert "Of 6 rss feeds 5 have not been modified" in output
+        # the rss fixtures render their entries once for each of the 2 channels
+        assert client.ops["feed_entries.insert"] == 5
+        assert poller.messages == 3 * 2
+        assert poller.embeds == (3 + 3 + 4) * 2
+        assert f"Rendered {poller.messages} messages" in output
@@ -0,0 +1,48 @@
+import pytest
+
+from ..benchmarks import render
+from ..utils.render_cache import render_cache
+
+FEEDS = render.load_feeds()
+
+
+class TestGoldenRender:
+    """Test that the recorded corpus renders to the golden embeds
+
+    A faster parse_entry_flat or embed builder must keep these passing. When a change
+    to the output is intended, rewrite the golden files with
+    `poetry run benchmark render --save-golden` and review their diff.
+    """
+
+    def test_corpus_is_complete(self):
+        assert set(FEEDS) == {"atom", "podcast", "substack", "wordpress", "youtube"}
+        assert all(feed["entries"] for feed in FEEDS.values())
+
+    @pytest.mark.parametrize("name", sorted(FEEDS))
+    def test_feed(self, name):
+        assert render.render_feed(FEEDS[name]) == render.load_golden(name)
+
+    def test_reddit_listings(self):
+        assert render.render_listings(render.load_listings()) == render.load_golden(
+            "reddit"
+        )
+
+    def test_cached_embeds_match(self):
+        rss = render.RSSFeed()
+        feed = FEEDS["wordpress"]
+        render_cache.clear()
+        first = [rss.create_entry_embed(entry).to_dict() for entry in feed["entries"]]
+        cached = [rss.create_entry_embed(entry).to_dict() for entry in feed["entries"]]
+        assert render_cache.hits >= len(feed["entries"])
+        assert cached == first == render.load_golden("wordpress")["entries"]
+
+
+class TestRenderBenchmark:
+    """Test the render microbenchmarks"""
+
+    def test_measure(self):
+        function, entries = render.cases()["documents_to_embeds"]
+        results = render.measure(function, entries, rounds=2)
+        assert results["entries_per_second"] > 0
+        assert results["min_seconds"] > 0
+        assert results["peak_bytes_per_entry"] >= results["retained_bytes_per_entry"]
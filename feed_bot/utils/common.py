@@ -1,5 +1,8 @@
 import os
+import hashlib
+from typing import List
 from aiohttp import ClientSession
+from pymongo.errors import BulkWriteError
 from bs4 import BeautifulSoup
 from markdownify import MarkdownConverter
 
@@ -21,10 +24,59 @@ def md(soup: BeautifulSoup, **options):
     return MarkdownConverter(**options).convert_soup(soup)
 
 
-def chunks(lst: list, n: int = 10):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i : i + n]
+def dedup_key(*parts) -> str:
+    """Returns a stable hash of parts to be used as a unique document key"""
+    return hashlib.sha1("\x1f".join(str(part) for part in parts).encode()).hexdigest()
+
+
+async def insert_many_ignore_duplicates(
+    collection, documents: List[dict]
+) -> List[dict]:
+    """Inserts documents with one unordered insert_many, skipping duplicate keys
+
+    The collection is expected to have a unique index on the documents' dedup key.
+    Documents rejected by that index are skipped, any other write error is raised.
+
+    Args:
+        collection: motor collection
+        documents (List[dict]): documents to insert
+
+    Returns:
+        List[dict]: The documents that were inserted, in the order they were given
+    """
+    if not documents:
+        return []
+    try:
+        await collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        write_errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != 11000 for error in write_errors):
+            raise
+        duplicates = {error.get("index") for error in write_errors}
+        return [doc for i, doc in enumerate(documents) if i not in duplicates]
+    return documents
+
+
+async def update_many_ignore_duplicates(collection, requests: list) -> int:
+    """Runs requests with one unordered bulk_write, skipping duplicate key errors
+
+    Args:
+        collection: motor collection
+        requests (list): pymongo write operations such as UpdateOne
+
+    Returns:
+        int: The number of documents that were modified
+    """
+    if not requests:
+        return 0
+    try:
+        result = await collection.bulk_write(requests, ordered=False)
+    except BulkWriteError as e:
+        write_errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != 11000 for error in write_errors):
+            raise
+        return e.details.get("nModified", 0)
+    return result.modified_count
 
 
 class CommonUtilities:
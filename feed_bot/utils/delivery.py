@@ -0,0 +1,306 @@
+"""Delivery queue for messages sent to discord channels
+
+Polls enqueue messages instead of awaiting every channel.send in turn. Each channel
+has its own FIFO queue and at most one message in flight, so messages arrive in
+order and a channel that is rate limited only holds up itself. Channels take turns
+on a bounded pool of workers.
+
+discord.py already waits out the per-route buckets (a channel's messages share a
+bucket) and the global limit when it is told about them. Sends are additionally
+spaced to DELIVERY_GLOBAL_RATE per second so a large fan-out does not run into the
+global limit in the first place. pack_embeds fits embeds into as few messages as
+Discord's size limits allow. Transient failures (5xx, 429, network errors) are
+retried with exponential backoff without occupying a worker while waiting.
+
+Messages from a headless poller (see poller.py) reach the queue through the
+deliveries collection. delivery_document and delivery_kwargs convert a message to
+and from a document.
+
+Environment Variables:
+- DELIVERY_WORKERS
+    - Number of sends in flight across all channels. Defaults to 10
+- DELIVERY_MAX_PENDING
+    - Messages queued before enqueue waits for room (backpressure). Defaults to 10000
+- DELIVERY_MAX_RETRIES
+    - Retries of a transient failure before a message is dropped. Defaults to 5
+- DELIVERY_GLOBAL_RATE
+    - Sends per second across all channels. Defaults to 45
+"""
+
+import os
+import time
+import asyncio
+import aiohttp
+import discord
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, List
+
+from . import metrics
+
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", 10))
+DELIVERY_MAX_PENDING = int(os.getenv("DELIVERY_MAX_PENDING", 10000))
+DELIVERY_MAX_RETRIES = int(os.getenv("DELIVERY_MAX_RETRIES", 5))
+DELIVERY_GLOBAL_RATE = float(os.getenv("DELIVERY_GLOBAL_RATE", 45.0))
+
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+# Discord's limits on the embeds of a single message
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARACTERS = 6000
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether sending again later may succeed"""
+    if isinstance(error, discord.HTTPException):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, OSError))
+
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """Seconds to wait before retry number attempt, Retry-After when discord sends one"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return min(float(headers["Retry-After"]), RETRY_MAX_DELAY)
+    except (KeyError, TypeError, ValueError):
+        return min(RETRY_BASE_DELAY * 2 ** (attempt - 1), RETRY_MAX_DELAY)
+
+
+def pack_embeds(
+    embeds: List[discord.Embed],
+    max_embeds: int = MAX_EMBEDS_PER_MESSAGE,
+    max_characters: int = MAX_EMBED_CHARACTERS,
+) -> List[List[discord.Embed]]:
+    """Packs embeds in order into as few messages as Discord accepts
+
+    Discord rejects a message with more than max_embeds embeds or more than
+    max_characters characters in their titles, descriptions, fields, footers and
+    author names, which is what len(embed) counts. Each message is filled until the
+    next embed does not fit, no packing that keeps the embeds in order needs fewer
+    messages. The result is a list so it can be sent to any number of channels.
+
+    Args:
+        embeds (List[discord.Embed]): Embeds in the order they are to be read
+        max_embeds (int, optional): Defaults to MAX_EMBEDS_PER_MESSAGE
+        max_characters (int, optional): Defaults to MAX_EMBED_CHARACTERS
+
+    Returns:
+        List[List[discord.Embed]]: The embeds of each message
+    """
+    batches: List[List[discord.Embed]] = []
+    batch: List[discord.Embed] = []
+    characters = 0
+    for embed in embeds:
+        size = len(embed)
+        if batch and (len(batch) >= max_embeds or characters + size > max_characters):
+            batches.append(batch)
+            batch, characters = [], 0
+        batch.append(embed)
+        characters += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def delivery_document(
+    channel_id: int,
+    content: str | None = None,
+    *,
+    embed: discord.Embed | None = None,
+    embeds: List[discord.Embed] | None = None,
+) -> dict:
+    """Returns an unsent deliveries document for a message to channel_id"""
+    embeds = ([embed] if embed else []) + list(embeds or [])
+    return {
+        "channel_id": channel_id,
+        "content": content,
+        "embeds": [embed.to_dict() for embed in embeds],
+        "sent": False,
+        "created_at": datetime.now(),
+    }
+
+
+def delivery_kwargs(document: dict) -> dict:
+    """Returns the Messageable.send arguments of a deliveries document"""
+    kwargs = {}
+    if document.get("content"):
+        kwargs["content"] = document["content"]
+    if document.get("embeds"):
+        kwargs["embeds"] = [
+            discord.Embed.from_dict(embed) for embed in document["embeds"]
+        ]
+    return kwargs
+
+
+@dataclass
+class Delivery:
+    channel_id: int
+    args: tuple
+    kwargs: dict
+    future: asyncio.Future
+    attempts: int = field(default=0)
+
+
+class RateLimiter:
+    """Spaces calls to acquire at least 1 / rate seconds apart"""
+
+    def __init__(self, rate: float):
+        self.period = 1 / rate if rate > 0 else 0.0
+        self.next_at = 0.0
+
+    async def acquire(self) -> None:
+        now = asyncio.get_running_loop().time()
+        wait = self.next_at - now
+        self.next_at = max(now, self.next_at) + self.period
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class DeliveryQueue:
+    """Per-channel FIFO queues drained by a bounded pool of workers
+
+    Args:
+        send (Callable[..., Awaitable[Any]]): Called as send(channel_id, *args, **kwargs)
+        workers (int, optional): Defaults to DELIVERY_WORKERS
+        max_pending (int, optional): Defaults to DELIVERY_MAX_PENDING
+        max_retries (int, optional): Defaults to DELIVERY_MAX_RETRIES
+        rate (float, optional): Defaults to DELIVERY_GLOBAL_RATE
+    """
+
+    def __init__(
+        self,
+        send: Callable[..., Awaitable[Any]],
+        workers: int = DELIVERY_WORKERS,
+        max_pending: int = DELIVERY_MAX_PENDING,
+        max_retries: int = DELIVERY_MAX_RETRIES,
+        rate: float = DELIVERY_GLOBAL_RATE,
+    ):
+        self.send = send
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.rate_limiter = RateLimiter(rate)
+        # A channel is in queues while it has messages. It is then either waiting in
+        # ready or being sent to by a worker, never both.
+        self.queues: Dict[int, Deque[Delivery]] = {}
+        self.ready: asyncio.Queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(max_pending)
+        self.tasks: List[asyncio.Task] = []
+        self.pending = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        if not self.tasks:
+            self.tasks = [
+                asyncio.create_task(self.worker()) for _ in range(self.workers)
+            ]
+
+    def stop(self) -> None:
+        """Stops the workers. Messages still queued are cancelled"""
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        for queue in self.queues.values():
+            for delivery in queue:
+                delivery.future.cancel()
+        self.queues.clear()
+        self.pending = 0
+
+    async def enqueue(self, channel_id: int, *args, **kwargs) -> asyncio.Future:
+        """Queues a message for channel_id. Only waits when the queue is full
+
+        Returns:
+            asyncio.Future: Resolves to True once sent or False once dropped
+        """
+        await self.slots.acquire()
+        delivery = Delivery(
+            channel_id=channel_id,
+            args=args,
+            kwargs=kwargs,
+            future=asyncio.get_running_loop().create_future(),
+        )
+        self.pending += 1
+        if channel_id in self.queues:
+            self.queues[channel_id].append(delivery)
+        else:
+            self.queues[channel_id] = deque([delivery])
+            self.ready.put_nowait(channel_id)
+        return delivery.future
+
+    async def join(self) -> None:
+        """Waits until every queued message is sent or dropped"""
+        while self.pending:
+            futures = [d.future for queue in self.queues.values() for d in queue]
+            await asyncio.wait(futures)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the queue depth and counters since the queue was created"""
+        return {
+            "pending": self.pending,
+            "channels": len(self.queues),
+            "in_flight": self.in_flight,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+    def finish(self, delivery: Delivery, result: bool) -> None:
+        queue = self.queues[delivery.channel_id]
+        queue.popleft()
+        self.pending -= 1
+        self.slots.release()
+        if not delivery.future.done():
+            delivery.future.set_result(result)
+        if queue:
+            self.ready.put_nowait(delivery.channel_id)
+        else:
+            del self.queues[delivery.channel_id]
+
+    async def worker(self) -> None:
+        while True:
+            channel_id = await self.ready.get()
+            queue = self.queues.get(channel_id)
+            if not queue:
+                continue
+            delivery = queue[0]
+            await self.rate_limiter.acquire()
+            self.in_flight += 1
+            outcome = "ok"
+            started = time.perf_counter()
+            try:
+                await self.send(delivery.channel_id, *delivery.args, **delivery.kwargs)
+            except asyncio.CancelledError:
+                outcome = "cancelled"
+                raise
+            except Exception as e:
+                delivery.attempts += 1
+                if isinstance(e, discord.HTTPException) and e.status == 429:
+                    metrics.RATE_LIMITED.inc()
+                if is_transient(e) and delivery.attempts <= self.max_retries:
+                    outcome = "retry"
+                    self.retried += 1
+                    delay = retry_delay(e, delivery.attempts)
+                    print(f"Retrying delivery to {channel_id} in {delay:.1f}s: {e}")
+                    # the channel stays out of ready until the delay has passed
+                    asyncio.get_running_loop().call_later(
+                        delay, self.ready.put_nowait, channel_id
+                    )
+                else:
+                    outcome = "dropped"
+                    self.failed += 1
+                    print(f"Dropped delivery to {channel_id}: {e}")
+                    self.finish(delivery, False)
+            else:
+                self.sent += 1
+                self.finish(delivery, True)
+            finally:
+                self.in_flight -= 1
+                metrics.SEND_SECONDS.observe(
+                    time.perf_counter() - started, outcome=outcome
+                )
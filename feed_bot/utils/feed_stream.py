@@ -0,0 +1,232 @@
+"""Streaming reads of feed responses
+
+A feed response used to be read in full with response.text() before feedparser built
+every one of its entries. Podcast and archive feeds list thousands of entries, most of
+which were stored polls ago. read_feed reads the body in chunks instead. An expat
+parser (EntryScanner) finds each entry as it arrives, and reading stops once:
+
+- an entry is older than the feed's last seen mark, the newest entry date of the
+previous poll. Entries from there on were seen before.
+- RSS_MAX_ENTRIES entries were read.
+
+The document is cut after the last entry that is kept and its open elements are
+closed, so feedparser only builds the entries that may be new. Both cut-offs assume
+the feed lists its newest entries first. A mark is only stored for feeds that do (see
+last_seen_mark), and a document whose entries turn out not to be in that order is
+read to the end.
+
+A response that is larger than RSS_MAX_FEED_BYTES by the time reading could stop
+raises FeedTooLarge, so a broken or hostile feed can not exhaust memory.
+
+Environment Variables:
+- RSS_MAX_FEED_BYTES
+    - Bytes read from a feed response before it is rejected. Defaults to 10485760
+    (10 MiB)
+- RSS_MAX_ENTRIES
+    - Entries read from a feed, in document order. Defaults to 200, 0 reads every
+    entry
+"""
+
+import os
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import List
+from xml.parsers import expat
+
+from . import metrics
+
+RSS_MAX_FEED_BYTES = int(os.getenv("RSS_MAX_FEED_BYTES", 10 * 1024 * 1024))
+RSS_MAX_ENTRIES = int(os.getenv("RSS_MAX_ENTRIES", 200))
+
+READ_CHUNK_SIZE = 64 * 1024
+
+# Local names of the elements holding an entry (rss, rdf and atom) and its dates
+ENTRY_TAGS = {"item", "entry"}
+DATE_TAGS = {"pubDate", "published", "updated", "date", "issued", "modified"}
+
+
+class FeedTooLarge(Exception):
+    """Raised when a feed response is larger than RSS_MAX_FEED_BYTES"""
+
+
+def parse_date(text: str) -> datetime | None:
+    """Parses an RFC 822 or ISO 8601 date into a naive UTC datetime"""
+    text = text.strip()
+    if not text:
+        return None
+    try:
+        dt = parsedate_to_datetime(text)
+    except (TypeError, ValueError):
+        try:
+            dt = datetime.fromisoformat(text)
+        except ValueError:
+            return None
+    if dt.tzinfo:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def entry_date(entry: dict) -> datetime | None:
+    """Returns the newest of a feedparser entry's published and updated dates (UTC)"""
+    # dict.get skips FeedParserDict's deprecated updated -> published fallback
+    dates = [
+        datetime(*parsed[:6])
+        for key in ("published_parsed", "updated_parsed")
+        if (parsed := dict.get(entry, key))
+    ]
+    return max(dates, default=None)
+
+
+def last_seen_mark(entries: List[dict]) -> datetime | None:
+    """Returns the date of the newest entry when entries are listed newest first
+
+    Returns:
+        datetime | None: None when the entries are in any other order, in which case
+        read_feed can not stop early for the feed
+    """
+    dates = [dt for entry in entries if (dt := entry_date(entry))]
+    if any(newer > older for older, newer in zip(dates, dates[1:])):
+        return None
+    return max(dates, default=None)
+
+
+class EntryScanner:
+    """Scans a feed document for the end of its entries while it is downloaded
+
+    Args:
+        since (datetime | None, optional): Last seen mark, see last_seen_mark
+        max_entries (int, optional): Entries to keep. Defaults to 0, every entry
+    """
+
+    def __init__(self, since: datetime | None = None, max_entries: int = 0):
+        self.since = since
+        self.max_entries = max_entries
+        self.body = bytearray()
+        self.stack: List[str] = []
+        self.entries = 0
+        self.ordered = True
+        self.previous: datetime | None = None
+        # Set while inside an entry, the stack depth of the entry element
+        self.entry_depth: int | None = None
+        self.entry_start = 0
+        self.date: datetime | None = None
+        self.date_text: List[str] | None = None
+        self.cut: int | None = None
+        self.tail = b""
+        self.failed = False
+        self.parser = expat.ParserCreate()
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+        self.parser.CharacterDataHandler = self.text
+
+    @staticmethod
+    def local_name(name: str) -> str:
+        return name.rsplit(":", 1)[-1]
+
+    def feed(self, chunk: bytes) -> bool:
+        """Adds the next chunk of the document
+
+        Returns:
+            bool: True once the rest of the document is not needed
+        """
+        self.body += chunk
+        if not self.failed:
+            try:
+                self.parser.Parse(chunk, False)
+            except expat.ExpatError:
+                # left for feedparser to judge, which tolerates more than expat
+                self.failed = True
+        return self.cut is not None
+
+    def document(self) -> bytes:
+        """Returns the document read so far, cut after the last entry that is kept"""
+        if self.cut is None:
+            return bytes(self.body)
+        return bytes(self.body[: self.cut]) + self.tail
+
+    def stop(self, offset: int) -> None:
+        self.cut = offset
+        self.tail = "".join(f"</{name}>" for name in reversed(self.stack)).encode()
+
+    def start(self, name: str, attrs: dict) -> None:
+        if self.cut is not None:
+            return
+        tag = self.local_name(name)
+        if self.entry_depth is None:
+            if tag in ENTRY_TAGS and self.stack:
+                self.entry_depth = len(self.stack)
+                self.entry_start = self.parser.CurrentByteIndex
+                self.date = None
+        elif len(self.stack) == self.entry_depth + 1 and tag in DATE_TAGS:
+            self.date_text = []
+        self.stack.append(name)
+
+    def text(self, data: str) -> None:
+        if self.date_text is not None:
+            self.date_text.append(data)
+
+    def end(self, name: str) -> None:
+        if self.cut is not None:
+            return
+        self.stack.pop()
+        if self.date_text is not None:
+            dt = parse_date("".join(self.date_text))
+            self.date_text = None
+            if dt and (self.date is None or dt > self.date):
+                self.date = dt
+        elif self.entry_depth is not None and len(self.stack) == self.entry_depth:
+            self.entry_depth = None
+            self.end_entry()
+
+    def end_entry(self) -> None:
+        if self.date:
+            if self.previous and self.date > self.previous:
+                self.ordered = False
+            self.previous = self.date
+        if not self.ordered:
+            return
+        if self.since and self.date and self.date < self.since:
+            self.stop(self.entry_start)
+            return
+        self.entries += 1
+        if self.max_entries and self.entries >= self.max_entries:
+            self.stop(self.body.index(b">", self.parser.CurrentByteIndex) + 1)
+
+
+async def read_feed(
+    response,
+    since: datetime | None = None,
+    max_entries: int | None = None,
+    max_bytes: int | None = None,
+) -> bytes:
+    """Reads a feed response until the entries that may be new have been read
+
+    The bytes received, not the size of the cut document, are recorded in
+    metrics.FEED_FETCH_BYTES.
+
+    Args:
+        response (aiohttp.ClientResponse): A 200 response to a feed request
+        since (datetime | None, optional): Last seen mark, see last_seen_mark
+        max_entries (int | None, optional): Defaults to RSS_MAX_ENTRIES
+        max_bytes (int | None, optional): Defaults to RSS_MAX_FEED_BYTES
+
+    Raises:
+        FeedTooLarge: More than max_bytes had to be read
+
+    Returns:
+        bytes: A feed document for feedparser
+    """
+    max_entries = RSS_MAX_ENTRIES if max_entries is None else max_entries
+    max_bytes = max_bytes or RSS_MAX_FEED_BYTES
+    scanner = EntryScanner(since=since, max_entries=max_entries)
+    received = 0
+    try:
+        async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+            received += len(chunk)
+            if received > max_bytes:
+                raise FeedTooLarge(f"Feed is larger than {max_bytes} bytes")
+            if scanner.feed(chunk):
+                break
+    finally:
+        metrics.FEED_FETCH_BYTES.observe(received)
+    return scanner.document()
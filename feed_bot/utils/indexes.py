@@ -0,0 +1,293 @@
+"""Indexes for the feed_bot_db collections
+
+ensure_indexes is called from FeedBot.setup_hook and is safe to run on every start.
+PRODUCTION_QUERIES mirrors the query shapes used in bot.py, poller.py and cogs.py so
+that verify_query_plans can check that none of them falls back to a collection scan.
+Keep both in sync when adding or changing a query.
+"""
+
+from typing import Dict, List
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from .leases import LEASE_RETENTION_SECONDS
+from .retention import (
+    delivery_ttl,
+    feed_entry_key_ttl,
+    feed_entry_ttl,
+    reddit_listing_ttl,
+)
+from .subscriptions import LOAD_PROJECTION, LOAD_SORT
+
+# Error codes returned when an index with the same name or keys exists with other options
+INDEX_CONFLICT_CODES = (85, 86)
+
+# An rss subscription has a feed_url, a subreddit subscription has a subreddit
+RSS_SUBSCRIPTION_FILTER = {"feed_url": {"$exists": True}}
+SUBREDDIT_SUBSCRIPTION_FILTER = {"subreddit": {"$exists": True}}
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    "subscriptions": [
+        IndexModel(
+            [
+                ("channel_id", ASCENDING),
+                ("feed_url", ASCENDING),
+                ("subreddit", ASCENDING),
+            ],
+            name="channel_id",
+        ),
+        IndexModel(
+            [("feed_url", ASCENDING), ("channel_id", ASCENDING)],
+            name="rss_subscriptions",
+            unique=True,
+            partialFilterExpression=RSS_SUBSCRIPTION_FILTER,
+        ),
+        IndexModel(
+            [("subreddit", ASCENDING), ("channel_id", ASCENDING)],
+            name="subreddit_subscriptions",
+            unique=True,
+            partialFilterExpression=SUBREDDIT_SUBSCRIPTION_FILTER,
+        ),
+    ],
+    "feed_entries": [
+        IndexModel([("entry_key", ASCENDING)], name="entry_key", unique=True),
+        IndexModel(
+            [("seen_at", ASCENDING)],
+            name="seen_at_ttl",
+            expireAfterSeconds=feed_entry_ttl(),
+        ),
+    ],
+    "feed_entry_keys": [
+        IndexModel(
+            [("stored_at", ASCENDING)],
+            name="stored_at_ttl",
+            expireAfterSeconds=feed_entry_key_ttl(),
+        ),
+    ],
+    "reddit_listings": [
+        IndexModel([("listing_key", ASCENDING)], name="listing_key", unique=True),
+        IndexModel(
+            [("sent", ASCENDING), ("lease_until", ASCENDING)],
+            name="unsent",
+            partialFilterExpression={"sent": False},
+        ),
+        IndexModel(
+            [("channel_id", ASCENDING), ("subreddit", ASCENDING)],
+            name="channel_id_subreddit",
+        ),
+        IndexModel(
+            [("sent_at", ASCENDING)],
+            name="sent_at_ttl",
+            expireAfterSeconds=reddit_listing_ttl(),
+            partialFilterExpression={"sent": True},
+        ),
+    ],
+    "deliveries": [
+        IndexModel(
+            [("sent", ASCENDING), ("lease_until", ASCENDING)],
+            name="unsent",
+            partialFilterExpression={"sent": False},
+        ),
+        IndexModel([("channel_id", ASCENDING)], name="channel_id"),
+        IndexModel(
+            [("sent_at", ASCENDING)],
+            name="sent_at_ttl",
+            expireAfterSeconds=delivery_ttl(),
+            partialFilterExpression={"sent": True},
+        ),
+    ],
+    "leases": [
+        IndexModel([("kind", ASCENDING), ("owner", ASCENDING)], name="kind_owner"),
+        IndexModel(
+            [("expires_at", ASCENDING)],
+            name="expires_at_ttl",
+            expireAfterSeconds=LEASE_RETENTION_SECONDS,
+        ),
+    ],
+}
+
+
+# (name, explain command body) for every query run by bot.py, poller.py, cogs.py and
+# the subscription index.
+# feeds, delivery_state and reddit_cursors are only ever read by _id, feed_entry_keys
+# is only written.
+PRODUCTION_QUERIES: List[tuple] = [
+    (
+        "subscription index load",
+        {
+            "find": "subscriptions",
+            "filter": {},
+            "projection": LOAD_PROJECTION,
+            "sort": dict(LOAD_SORT),
+        },
+    ),
+    (
+        "channel_send remove subscriptions",
+        {"delete": "subscriptions", "deletes": [{"q": {"channel_id": 0}, "limit": 0}]},
+    ),
+    (
+        "channel_send remove listings",
+        {
+            "delete": "reddit_listings",
+            "deletes": [{"q": {"channel_id": 0}, "limit": 0}],
+        },
+    ),
+    (
+        "channel_send remove deliveries",
+        {
+            "delete": "deliveries",
+            "deletes": [{"q": {"channel_id": 0}, "limit": 0}],
+        },
+    ),
+    (
+        "post_subreddit claim",
+        {
+            "find": "reddit_listings",
+            "filter": {
+                "sent": False,
+                "$or": [{"lease_until": None}, {"lease_until": {"$lt": 0}}],
+            },
+            "projection": {"_id": 1},
+        },
+    ),
+    (
+        "post_deliveries claim",
+        {
+            "find": "deliveries",
+            "filter": {
+                "sent": False,
+                "$or": [{"lease_until": None}, {"lease_until": {"$lt": 0}}],
+            },
+            "projection": {"_id": 1},
+            "sort": {"_id": 1},
+        },
+    ),
+    (
+        "export/ls subscriptions",
+        {"find": "subscriptions", "filter": {"channel_id": 0}},
+    ),
+    (
+        "subreddit ls/prune",
+        {
+            "find": "subscriptions",
+            "filter": {"channel_id": 0, **SUBREDDIT_SUBSCRIPTION_FILTER},
+        },
+    ),
+    (
+        "subreddit add/rm",
+        {"find": "subscriptions", "filter": {"channel_id": 0, "subreddit": ""}},
+    ),
+    (
+        "subreddit rm/prune listings",
+        {
+            "delete": "reddit_listings",
+            "deletes": [
+                {"q": {"channel_id": 0, "subreddit": "", "sent": False}, "limit": 0}
+            ],
+        },
+    ),
+    (
+        "rss ls/prune",
+        {
+            "find": "subscriptions",
+            "filter": {"channel_id": 0, **RSS_SUBSCRIPTION_FILTER},
+        },
+    ),
+    (
+        "rss add/rm",
+        {"find": "subscriptions", "filter": {"channel_id": 0, "feed_url": ""}},
+    ),
+    (
+        "lease_task live workers",
+        {
+            "count": "leases",
+            "query": {"kind": "worker", "expires_at": {"$gt": 0}},
+        },
+    ),
+    (
+        "lease_task partitions",
+        {
+            "find": "leases",
+            "filter": {"kind": "partition"},
+            "projection": {"owner": 1, "expires_at": 1},
+        },
+    ),
+    (
+        "lease_task renew/release",
+        {
+            "update": "leases",
+            "updates": [
+                {
+                    "q": {"kind": "partition", "owner": ""},
+                    "u": {"$set": {"expires_at": 0}},
+                    "multi": True,
+                }
+            ],
+        },
+    ),
+]
+
+
+async def ensure_indexes(db) -> None:
+    """Creates every index in INDEXES. Existing indexes are left untouched.
+
+    An index whose options changed since it was created is dropped and created again.
+
+    Args:
+        db: motor database
+    """
+    for collection_name, index_models in INDEXES.items():
+        collection = db[collection_name]
+        for index_model in index_models:
+            try:
+                await collection.create_indexes([index_model])
+            except OperationFailure as e:
+                if e.code not in INDEX_CONFLICT_CODES:
+                    raise
+                name = index_model.document["name"]
+                print(f"Recreating index {collection_name}.{name}: {e}")
+                await collection.drop_index(name)
+                await collection.create_indexes([index_model])
+
+
+def find_collscans(explain: dict) -> List[str]:
+    """Returns the COLLSCAN stages found in the winning plans of an explain result
+
+    Args:
+        explain (dict): Result of the explain command with queryPlanner verbosity
+
+    Returns:
+        List[str]: One entry per COLLSCAN stage, the namespace it scans
+    """
+    collscans = []
+
+    def walk(node, in_winning_plan: bool):
+        if isinstance(node, dict):
+            if in_winning_plan and node.get("stage") == "COLLSCAN":
+                collscans.append(node.get("namespace", "COLLSCAN"))
+            for key, value in node.items():
+                walk(value, in_winning_plan or key == "winningPlan")
+        elif isinstance(node, list):
+            for value in node:
+                walk(value, in_winning_plan)
+
+    walk(explain, False)
+    return collscans
+
+
+async def verify_query_plans(db) -> Dict[str, List[str]]:
+    """Explains every query in PRODUCTION_QUERIES
+
+    Args:
+        db: motor database
+
+    Returns:
+        Dict[str, List[str]]: Query name -> COLLSCAN stages. Empty when every query
+        uses an index.
+    """
+    report = {}
+    for name, command in PRODUCTION_QUERIES:
+        explain = await db.command({"explain": command, "verbosity": "queryPlanner"})
+        if collscans := find_collscans(explain):
+            report[name] = collscans
+    return report
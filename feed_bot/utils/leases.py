@@ -0,0 +1,182 @@
+"""Leases that split polling between bot processes
+
+Several FeedBot processes, each connected to its own range of discord shards (see
+SHARD_IDS in bot.py), can share one database. Feeds and subreddits are hashed into
+POLL_PARTITIONS partitions and a process only polls the keys of the partitions it
+holds a lease on, so a feed is fetched by one process however many shards its
+subscribers are spread over.
+
+Leases are documents in the leases collection:
+
+- {"kind": "worker"} documents are heartbeats. Each process renews its own every
+LEASE_SECONDS / 3 seconds and counts the live ones.
+- {"kind": "partition"} documents are held by one process until expires_at. A process
+holds its share, POLL_PARTITIONS / live processes, renews them with its heartbeat,
+releases the ones above its share and acquires free or expired ones below it. When a
+process dies its leases expire after LEASE_SECONDS and the others take over its
+partitions.
+- {"kind": "job"} documents make a periodic job run in one process per cycle.
+
+Leases are not fenced. A process that stalls for longer than LEASE_SECONDS may finish
+a poll of a partition that was taken over in the meantime, which the dedup keys of
+feed entries and listings make harmless.
+
+Environment Variables:
+- POLL_PARTITIONS
+    - Partitions feeds and subreddits are split into. Defaults to 64. Every process
+    must use the same value
+- LEASE_SECONDS
+    - Seconds a lease is held for without a heartbeat. Defaults to 60
+"""
+
+import os
+import math
+import time
+import random
+from datetime import datetime, timedelta
+from typing import Set
+from pymongo.errors import DuplicateKeyError
+
+from .common import dedup_key
+
+POLL_PARTITIONS = int(os.getenv("POLL_PARTITIONS", 64))
+LEASE_SECONDS = float(os.getenv("LEASE_SECONDS", 60.0))
+
+# Expired leases are removed by a TTL index this long after they expired
+LEASE_RETENTION_SECONDS = 3600
+
+
+def partition(key: str, partitions: int) -> int:
+    """Returns the partition of a poll key, the same in every process"""
+    return int(dedup_key(key)[:8], 16) % partitions
+
+
+class LeaseManager:
+    """Holds this process's share of the poll partitions
+
+    Args:
+        collection: motor collection of leases
+        owner (str): Owner written on held leases, see outbox.instance_id
+        partitions (int, optional): Defaults to POLL_PARTITIONS
+        lease_seconds (float, optional): Defaults to LEASE_SECONDS
+    """
+
+    def __init__(
+        self,
+        collection,
+        owner: str,
+        partitions: int = POLL_PARTITIONS,
+        lease_seconds: float = LEASE_SECONDS,
+    ):
+        self.collection = collection
+        self.owner = owner
+        self.partitions = partitions
+        self.lease_seconds = lease_seconds
+        self.owned: Set[int] = set()
+        self.workers = 0
+        # owned is only trusted while the leases behind it are, see heartbeat
+        self.valid_until = 0.0
+
+    @staticmethod
+    def partition_id(number: int) -> str:
+        return f"partition:{number}"
+
+    def owns(self, key: str) -> bool:
+        """Whether this process polls key"""
+        if time.monotonic() > self.valid_until:
+            return False
+        return partition(key, self.partitions) in self.owned
+
+    async def try_acquire(self, lease_id: str, kind: str, seconds: float) -> bool:
+        """Takes or renews a lease that is free, expired or already held by this owner"""
+        now = datetime.now()
+        try:
+            await self.collection.find_one_and_update(
+                {
+                    "_id": lease_id,
+                    "$or": [{"owner": self.owner}, {"expires_at": {"$lte": now}}],
+                },
+                {
+                    "$set": {
+                        "kind": kind,
+                        "owner": self.owner,
+                        "expires_at": now + timedelta(seconds=seconds),
+                    }
+                },
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # the lease exists and is held by someone else
+            return False
+        return True
+
+    async def acquire_job(self, name: str, seconds: float) -> bool:
+        """Whether this process runs the job name for the next seconds"""
+        return await self.try_acquire(f"job:{name}", "job", seconds)
+
+    async def heartbeat(self) -> Set[int]:
+        """Renews this process's leases and moves it towards its share of partitions
+
+        Returns:
+            Set[int]: The partitions now held
+        """
+        started = time.monotonic()
+        now = datetime.now()
+        expires_at = now + timedelta(seconds=self.lease_seconds)
+        await self.collection.update_one(
+            {"_id": f"worker:{self.owner}"},
+            {"$set": {"kind": "worker", "owner": self.owner, "expires_at": expires_at}},
+            upsert=True,
+        )
+        self.workers = await self.collection.count_documents(
+            {"kind": "worker", "expires_at": {"$gt": now}}
+        )
+        share = math.ceil(self.partitions / max(self.workers, 1))
+        await self.collection.update_many(
+            {"kind": "partition", "owner": self.owner},
+            {"$set": {"expires_at": expires_at}},
+        )
+        cursor = self.collection.find(
+            {"kind": "partition"}, projection=["owner", "expires_at"]
+        )
+        leases = {doc["_id"]: doc for doc in await cursor.to_list(None)}
+        held: Set[int] = set()
+        free = []
+        for number in range(self.partitions):
+            lease = leases.get(self.partition_id(number))
+            if lease and lease.get("owner") == self.owner:
+                held.add(number)
+            elif not lease or lease.get("expires_at") <= now:
+                free.append(number)
+
+        if surplus := sorted(held)[share:]:
+            await self.collection.update_many(
+                {
+                    "_id": {"$in": [self.partition_id(n) for n in surplus]},
+                    "owner": self.owner,
+                },
+                {"$set": {"expires_at": now}},
+            )
+            held.difference_update(surplus)
+        random.shuffle(free)
+        for number in free:
+            if len(held) >= share:
+                break
+            if await self.try_acquire(
+                self.partition_id(number), "partition", self.lease_seconds
+            ):
+                held.add(number)
+
+        self.owned = held
+        self.valid_until = started + self.lease_seconds
+        return held
+
+    async def release(self) -> None:
+        """Gives up every lease held so other processes take over right away"""
+        self.owned = set()
+        self.valid_until = 0.0
+        await self.collection.delete_one({"_id": f"worker:{self.owner}"})
+        await self.collection.update_many(
+            {"kind": "partition", "owner": self.owner},
+            {"$set": {"expires_at": datetime.now()}},
+        )
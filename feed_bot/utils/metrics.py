@@ -0,0 +1,308 @@
+"""Metrics in the Prometheus text format
+
+Setting METRICS_PORT serves every metric below on http://METRICS_HOST:METRICS_PORT/metrics.
+When it is not set metrics are disabled, and recording a value returns before doing
+any work.
+
+Metrics are recorded where the work happens (RSSFeed, Reddit, FeedPoller, FeedBot and
+the delivery queue). MongoDB operations are timed by a pymongo command listener
+labelled with the collection and command (the call site), so queries made by the
+cogs are covered without touching them.
+
+Environment Variables:
+- METRICS_PORT
+    - Port the metrics are served on. Defaults to 0, metrics disabled
+- METRICS_HOST
+    - Interface the metrics are served on. Defaults to 127.0.0.1
+"""
+
+import os
+import time
+import bisect
+import threading
+from typing import Dict, List, Tuple
+from aiohttp import web
+from pymongo import monitoring
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Bytes, 1 KiB to 16 MiB
+SIZE_BUCKETS = tuple(1024 * 4**i for i in range(8))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+class Registry:
+    """The metrics served on /metrics"""
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.metrics: List["Metric"] = []
+
+    def render(self) -> str:
+        return "".join(metric.render() for metric in self.metrics)
+
+
+class Metric:
+    """A metric and its values by label values
+
+    Args:
+        name (str): Metric name
+        help (str): Description shown by Prometheus
+        labels (Tuple[str, ...], optional): Label names. Defaults to no labels.
+        registry (Registry | None, optional): Defaults to the module's registry
+    """
+
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Tuple[str, ...] = (),
+        registry: Registry | None = None,
+    ):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.registry = registry or REGISTRY
+        self.registry.metrics.append(self)
+        self.values: Dict[Tuple[str, ...], object] = {}
+        # values are also written from pymongo's monitoring threads
+        self.lock = threading.Lock()
+
+    def key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            lines += self.render_value(dict(zip(self.label_names, key)), value)
+        return "\n".join(lines) + "\n"
+
+    def render_value(self, labels: Dict[str, str], value) -> List[str]:
+        return [f"{self.name}{format_labels(labels)} {value}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        if not self.registry.enabled:
+            return
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Timer:
+    """Observes the seconds a with block takes, see Histogram.time"""
+
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: "Histogram", labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+        self.started = 0.0
+
+    def __enter__(self) -> "Timer":
+        if self.histogram.registry.enabled:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self.started:
+            self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Histogram(Metric):
+    """Counts observations into buckets, values are [bucket counts, sum, count]
+
+    Args:
+        buckets (Tuple[float, ...], optional): Upper bounds. Defaults to LATENCY_BUCKETS
+    """
+
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        if not self.registry.enabled:
+            return
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            counts, _, _ = entry = self.values[key]
+            counts[index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels) -> Timer:
+        """Context manager observing the duration of its block"""
+        return Timer(self, labels)
+
+    def render_value(self, labels: Dict[str, str], value) -> List[str]:
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += bucket_count
+            bucket_labels = format_labels({**labels, "le": bound})
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+        lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+
+def command_site(event: monitoring.CommandStartedEvent) -> str:
+    """Labels a command by its collection and name, e.g. feed_entries.insert"""
+    collection = event.command.get(event.command_name)
+    if not isinstance(collection, str):
+        collection = event.command.get("collection", "")
+    return f"{collection}.{event.command_name}"
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Times every MongoDB command by collection and command name"""
+
+    def __init__(self):
+        self.sites: Dict[int, str] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        self.sites[event.request_id] = command_site(event)
+
+    def finished(self, event, outcome: str) -> None:
+        site = self.sites.pop(event.request_id, event.command_name)
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, site=site, outcome=outcome)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self.finished(event, "ok")
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self.finished(event, "error")
+
+
+def mongo_event_listeners() -> List[monitoring.CommandListener]:
+    """event_listeners for a MongoClient, none when metrics are disabled"""
+    return [MongoCommandListener()] if REGISTRY.enabled else []
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=REGISTRY.render(), headers={"Content-Type": CONTENT_TYPE})
+
+
+def metrics_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    return app
+
+
+async def start_metrics_server() -> web.AppRunner | None:
+    """Serves /metrics when METRICS_PORT is set
+
+    Returns:
+        web.AppRunner | None: Call cleanup() on it to stop serving
+    """
+    if not REGISTRY.enabled:
+        return None
+    runner = web.AppRunner(metrics_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    print(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+
+REGISTRY = Registry(enabled=bool(METRICS_PORT))
+
+FEED_FETCH_SECONDS = Histogram(
+    "feed_bot_feed_fetch_seconds",
+    "Time to fetch and read a feed, by outcome",
+    labels=("outcome",),
+)
+FEED_FETCH_BYTES = Histogram(
+    "feed_bot_feed_fetch_bytes",
+    "Bytes of a feed response read before reading stopped",
+    buckets=SIZE_BUCKETS,
+)
+FEED_PARSE_SECONDS = Histogram(
+    "feed_bot_feed_parse_seconds",
+    "Time feedparser takes to parse a feed, including the worker pool hand-off",
+)
+REDDIT_FETCH_SECONDS = Histogram(
+    "feed_bot_reddit_fetch_seconds",
+    "Time to fetch the new submissions of one multireddit query",
+)
+STORED_ENTRIES = Counter(
+    "feed_bot_entries_total",
+    "Feed entries and reddit listings by kind, inserted or skipped as duplicates",
+    labels=("kind", "result"),
+)
+MONGO_SECONDS = Histogram(
+    "feed_bot_mongo_seconds",
+    "MongoDB command latency by call site (collection.command)",
+    labels=("site", "outcome"),
+)
+SEND_SECONDS = Histogram(
+    "feed_bot_discord_send_seconds",
+    "Time to send a message to discord, by outcome",
+    labels=("outcome",),
+)
+RATE_LIMITED = Counter(
+    "feed_bot_discord_rate_limited_total",
+    "Sends that failed with 429 Too Many Requests",
+)
+TASK_SECONDS = Histogram(
+    "feed_bot_task_seconds",
+    "Duration of a task cycle",
+    labels=("task",),
+)
+TASK_PEAK_BYTES = Gauge(
+    "feed_bot_task_peak_bytes",
+    "Process peak bytes while the last measured cycle of a task ran, see "
+    "TASK_MEMORY_CEILING",
+    labels=("task",),
+)
+TASK_MEMORY_CEILING_EXCEEDED = Counter(
+    "feed_bot_task_memory_ceiling_exceeded_total",
+    "Task cycles that allocated more than TASK_MEMORY_CEILING",
+    labels=("task",),
+)
+POLL_OVERRUNS = Gauge(
+    "feed_bot_poll_overruns",
+    "Polls running longer than their interval",
+    labels=("kind",),
+)
+COMMAND_SECONDS = Histogram(
+    "feed_bot_command_seconds",
+    "Duration of a bot command, by cog and command",
+    labels=("cog", "command"),
+)
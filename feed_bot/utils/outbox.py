@@ -0,0 +1,157 @@
+"""Outbox for reddit listings waiting to be sent
+
+Unsent listings ({"sent": False}) are claimed in batches before they are sent. A
+claim sets lease_owner and lease_until on a batch with a single update_many, and only
+the documents that update matched belong to the claimer. Another worker, in this or
+another bot instance, skips leased documents until the lease expires, so each
+listing is sent once per claim. While a batch is being sent its lease is renewed
+every lease_seconds / 3 (see Outbox.renewing), so a batch held up by rate limits is
+not claimed by another worker. Sent listings are acknowledged by _id with a single
+update_many per batch. If the bot stops halfway through a batch only that batch is
+sent again once its lease expires.
+
+Environment Variables:
+- OUTBOX_BATCH_SIZE
+    - Listings claimed at a time. Defaults to 100
+- OUTBOX_LEASE_SECONDS
+    - Seconds a claim is held for before others may claim the listings again.
+    Defaults to 300
+"""
+
+import os
+import uuid
+import socket
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import AsyncIterator, List
+from pymongo.errors import PyMongoError
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 100))
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", 300.0))
+
+
+def instance_id() -> str:
+    """Returns an id for this process that is unique across hosts and restarts"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class Outbox:
+    """Claims, acknowledges and releases batches of unsent documents
+
+    Args:
+        collection: motor collection of documents with a "sent" flag
+        owner (str): Lease owner written on claimed documents, see instance_id
+        batch_size (int, optional): Defaults to OUTBOX_BATCH_SIZE
+        lease_seconds (float, optional): Defaults to OUTBOX_LEASE_SECONDS
+        projection (List[str] | None, optional): Fields of claimed documents to return.
+            Defaults to None, every field.
+        sort (list | None, optional): Order documents are claimed and returned in, a
+            pymongo sort specification. Defaults to None, natural order.
+    """
+
+    def __init__(
+        self,
+        collection,
+        owner: str,
+        batch_size: int = OUTBOX_BATCH_SIZE,
+        lease_seconds: float = OUTBOX_LEASE_SECONDS,
+        projection: List[str] | None = None,
+        sort: list | None = None,
+    ):
+        self.collection = collection
+        self.owner = owner
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.projection = projection
+        self.sort = sort
+
+    @staticmethod
+    def claimable(now: datetime) -> dict:
+        """Filter of unsent documents that are not leased or whose lease expired"""
+        return {
+            "sent": False,
+            "$or": [{"lease_until": None}, {"lease_until": {"$lt": now}}],
+        }
+
+    async def claim(self) -> List[dict]:
+        """Claims up to batch_size unsent documents
+
+        Returns:
+            List[dict]: The claimed documents. Empty when there is nothing to send.
+        """
+        now = datetime.now()
+        cursor = self.collection.find(
+            self.claimable(now),
+            projection=["_id"],
+            limit=self.batch_size,
+            sort=self.sort,
+        )
+        ids = [doc["_id"] for doc in await cursor.to_list(None)]
+        if not ids:
+            return []
+        claim_id = uuid.uuid4().hex
+        await self.collection.update_many(
+            {"_id": {"$in": ids}, **self.claimable(now)},
+            {
+                "$set": {
+                    "lease_owner": self.owner,
+                    "lease_until": now + timedelta(seconds=self.lease_seconds),
+                    "claim_id": claim_id,
+                }
+            },
+        )
+        cursor = self.collection.find(
+            {"_id": {"$in": ids}, "claim_id": claim_id},
+            projection=self.projection,
+            sort=self.sort,
+        )
+        return await cursor.to_list(None)
+
+    async def renew(self, ids: list) -> None:
+        """Extends the lease of documents claimed by this owner that are not sent yet"""
+        if ids:
+            await self.collection.update_many(
+                {"_id": {"$in": ids}, "lease_owner": self.owner, "sent": False},
+                {
+                    "$set": {
+                        "lease_until": datetime.now()
+                        + timedelta(seconds=self.lease_seconds)
+                    }
+                },
+            )
+
+    @asynccontextmanager
+    async def renewing(self, ids: list) -> AsyncIterator[None]:
+        """Renews the lease of ids every lease_seconds / 3 until the block exits"""
+
+        async def heartbeat():
+            while True:
+                await asyncio.sleep(self.lease_seconds / 3)
+                try:
+                    await self.renew(ids)
+                except PyMongoError as e:
+                    print(f"Could not renew the lease of {len(ids)} documents: {e}")
+
+        task = asyncio.create_task(heartbeat())
+        try:
+            yield
+        finally:
+            task.cancel()
+
+    async def ack(self, ids: list, **fields) -> None:
+        """Marks documents as sent, fields are set alongside
+
+        Documents are matched by _id alone. Should a lease have expired and the
+        documents been claimed again, they are still recorded as sent.
+
+        sent_at is set to now, see retention.py
+        """
+        if ids:
+            await self.collection.update_many(
+                {"_id": {"$in": ids}},
+                {
+                    "$set": {"sent": True, "sent_at": datetime.now(), **fields},
+                    "$unset": {"lease_owner": "", "lease_until": "", "claim_id": ""},
+                },
+            )
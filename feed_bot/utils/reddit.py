@@ -1,68 +1,362 @@
 import discord
-from typing import List, Tuple
+from typing import Dict, Iterable, List, Tuple
 import os
 from aiohttp import ClientSession
 import asyncpraw
 from asyncpraw.exceptions import RedditAPIException, ClientException
-from asyncprawcore.exceptions import Redirect, RequestException
+from asyncprawcore.exceptions import (
+    Forbidden,
+    NotFound,
+    Redirect,
+    RequestException,
+    ResponseException,
+    UnavailableForLegalReasons,
+)
 
-from .common import CommonUtilities
+from . import metrics
+from .tracing import span
+from .common import CommonUtilities, dedup_key
+
+# Longest "+" joined subreddit names sent in one request, keeps the url well within
+# the length reddit and its proxies accept
+REDDIT_MULTI_MAX_LENGTH = int(os.getenv("REDDIT_MULTI_MAX_LENGTH", 1800))
+# Submissions read for the subreddits of a request that have no cursor yet
+REDDIT_NEW_LIMIT = int(os.getenv("REDDIT_NEW_LIMIT", 100))
+# Most submissions paged through to reach the cursors of a request, reddit lists
+# no more than 1000
+REDDIT_MAX_SCAN = int(os.getenv("REDDIT_MAX_SCAN", 1000))
+
+# Responses to a subreddit that is private, banned, quarantined or gone. Any one
+# subreddit of a multireddit query fails the whole query with them.
+SUBREDDIT_ERRORS = (Forbidden, NotFound, Redirect, UnavailableForLegalReasons)
+# Errors that fail a single request without stopping a poll
+FETCH_ERRORS = (
+    RedditAPIException,
+    ClientException,
+    ResponseException,
+    RequestException,
+)
+
+
+def multireddit_queries(
+    subreddit_names: Iterable[str], max_length: int | None = None
+) -> List[str]:
+    """Packs subreddit_names into the fewest "+" joined queries of at most max_length
+
+    Args:
+        subreddit_names (Iterable[str]): Subreddit names without the r/ prefix
+        max_length (int | None, optional): Defaults to REDDIT_MULTI_MAX_LENGTH
+
+    Returns:
+        List[str]: Queries for asyncpraw's reddit.subreddit
+    """
+    max_length = max_length or REDDIT_MULTI_MAX_LENGTH
+    queries = []
+    query = ""
+    for name in sorted(set(subreddit_names)):
+        if query and len(query) + 1 + len(name) > max_length:
+            queries.append(query)
+            query = ""
+        query = f"{query}+{name}" if query else name
+    if query:
+        queries.append(query)
+    return queries
+
+
+def create_reddit_client(session: ClientSession | None = None) -> asyncpraw.Reddit:
+    """Creates an asyncpraw client from the REDDIT_* environment variables
+
+    The client keeps its OAuth token and only requests a new one once it expires, so
+    it should be created once and reused. Closing the client closes session.
+
+    Args:
+        session (ClientSession | None, optional): Session the client sends its
+            requests with. Defaults to None, in which case asyncpraw creates one.
+    """
+    return asyncpraw.Reddit(
+        client_id=os.getenv("REDDIT_CLIENT_ID"),
+        client_secret=os.getenv("REDDIT_CLIENT_SECRET"),
+        password=os.getenv("REDDIT_PASSWORD"),
+        requestor_kwargs=dict(session=session),
+        user_agent=os.getenv("REDDIT_USER_AGENT"),
+        username=os.getenv("REDDIT_USERNAME"),
+    )
 
 
 class Reddit(CommonUtilities):
     """Utility class for interacting with the reddit api
 
+    Pass the bot's long lived client as reddit. Without one a client is created the
+    first time the api is called, and must be released with close.
+
     Reddit API: https://www.reddit.com/dev/api/
     """
 
+    channel_errors: Dict[int | str, str] = {}
+    res_cursors: Dict[str, dict] = {}
+
     def __init__(
         self,
         session: ClientSession | None = None,
         subreddit_names: List[str] = [],
         channel_id: int | str = "",
+        reddit: asyncpraw.Reddit | None = None,
     ) -> None:
         super().__init__(session=session, channel_id=channel_id)
         self.subreddits_query = "+".join(subreddit_names)
-        self.reddit = asyncpraw.Reddit(
-            client_id=os.getenv("REDDIT_CLIENT_ID"),
-            client_secret=os.getenv("REDDIT_CLIENT_SECRET"),
-            password=os.getenv("REDDIT_PASSWORD"),
-            requestor_kwargs=dict(session=session),
-            user_agent=os.getenv("REDDIT_USER_AGENT"),
-            username=os.getenv("REDDIT_USERNAME"),
-        )
+        self._reddit = reddit
+        self.owns_client = False
+
+    @property
+    def reddit(self) -> asyncpraw.Reddit:
+        if self._reddit is None:
+            self._reddit = create_reddit_client(session=self.session)
+            self.owns_client = True
+        return self._reddit
+
+    async def close(self) -> None:
+        """Closes the client if this object created it"""
+        if self.owns_client:
+            await self._reddit.close()
+            self._reddit = None
+            self.owns_client = False
+
+    def clear(self):
+        super().clear()
+        self.channel_errors = {}
+        self.res_cursors = {}
+
+    @staticmethod
+    def subreddit_key(subreddit: str) -> str:
+        """Normalizes a subscription's subreddit and a listing's r/ prefixed subreddit alike"""
+        subreddit = subreddit.lower()
+        return subreddit[2:] if subreddit.startswith("r/") else subreddit
+
+    @staticmethod
+    def listing_key(channel_id: int | str, subreddit: str, link: str) -> str:
+        """Returns the dedup key of a listing, stored as "listing_key" in the reddit collection"""
+        return dedup_key(channel_id, subreddit, link)
 
     async def get_subreddit_submissions(self) -> None:
+        """Fetches the new listings of this channel's subreddits into self.res_dicts"""
         self.clear()
-        try:
-            subreddits = await self.reddit.subreddit(self.subreddits_query)
-        except (
-            RedditAPIException,
-            ClientException,
-            RequestException,
-        ) as e:
+        submissions, error_msg = await self.fetch_new_submissions(self.subreddits_query)
+        if error_msg:
             self.error = True
-            self.error_msg = f"{e}"
-        else:
-            try:
-                async for submission in subreddits.new():
-                    # Only selfpost (user content) should be shown
-                    if getattr(submission, "permalink"):
-                        submission_dict = dict(
-                            channel_id=self.channel_id,
+            self.error_msg = error_msg
+            return
+        for submission in submissions:
+            self.res_dicts.append(
+                dict(
+                    channel_id=self.channel_id,
+                    **submission,
+                    sent=False,
+                    listing_key=self.listing_key(
+                        self.channel_id, submission["subreddit"], submission["link"]
+                    ),
+                )
+            )
+
+    async def get_multireddit_submissions(
+        self,
+        subscriptions: Dict[str, List[int | str]],
+        cursors: Dict[str, dict] | None = None,
+    ) -> None:
+        """Fetches the new listings of every subscribed subreddit once for all channels
+
+        The distinct subreddits are fetched with as few multireddit requests as fit in
+        REDDIT_MULTI_MAX_LENGTH. Each submission is then copied to every channel that
+        subscribes to its subreddit.
+
+        Only submissions newer than a subreddit's cursor are returned, see
+        fetch_new_submissions. The cursors to store for the next poll are collected in
+        self.res_cursors.
+
+        Exceptions:
+            - A failed request does not stop the others. self.channel_errors holds
+            channel_id -> error message for the channels of the failed request's subreddits.
+            - A subreddit that can not be read (SUBREDDIT_ERRORS) only fails its own
+            channels, see read_isolating_failures.
+            - self.error is set when at least one request failed.
+
+        Args:
+            subscriptions (Dict[str, List[int | str]]): subreddit -> subscribing channel_ids
+            cursors (Dict[str, dict] | None, optional): subreddit_key -> stored cursor.
+                Defaults to None, in which case every subreddit is read in full.
+
+        Returns:
+            None. self.res_dicts holds one listing per subscribing channel.
+        """
+        self.clear()
+        channel_ids: Dict[str, List[int | str]] = {}
+        for subreddit, subreddit_channel_ids in subscriptions.items():
+            channel_ids.setdefault(self.subreddit_key(subreddit), []).extend(
+                subreddit_channel_ids
+            )
+        errors = []
+        cursors = cursors or {}
+        results = []
+        for query in multireddit_queries(channel_ids):
+            results += await self.read_isolating_failures(query, cursors)
+        for query, submissions, error_msg in results:
+            if error_msg:
+                errors.append(error_msg)
+                for name in query.split("+"):
+                    for channel_id in channel_ids[name]:
+                        self.channel_errors[channel_id] = error_msg
+                continue
+            for submission in submissions:
+                key = self.subreddit_key(submission["subreddit"])
+                for channel_id in dict.fromkeys(channel_ids.get(key, [])):
+                    self.res_dicts.append(
+                        dict(
+                            channel_id=channel_id,
+                            **submission,
+                            sent=False,
+                            listing_key=self.listing_key(
+                                channel_id, submission["subreddit"], submission["link"]
+                            ),
+                        )
+                    )
+        if errors:
+            self.error = True
+            self.error_msg = "\n".join(errors)
+
+    @staticmethod
+    def error_message(query: str, error: Exception) -> str:
+        """Returns the message reported for a request of query that failed with error"""
+        if isinstance(error, SUBREDDIT_ERRORS):
+            return (
+                f"**r/{query} can not be read, it may be private, banned or "
+                f"quarantined: {error}**"
+            )
+        if isinstance(error, RequestException):
+            return f"**500 Error while retrieving subreddit(s) new listings: {error}**"
+        return f"{error}"
+
+    async def read_isolating_failures(
+        self, query: str, cursors: Dict[str, dict]
+    ) -> List[Tuple[str, List[dict], str]]:
+        """Reads a multireddit query, isolating the subreddits that can not be read
+
+        One private, banned or quarantined subreddit fails its whole query. The query
+        is then split in halves until each failing subreddit is on its own, so the
+        others are still read at a cost of a few requests per failing subreddit.
+
+        Args:
+            query (str): "+" joined subreddit names, see multireddit_queries
+            cursors (Dict[str, dict]): subreddit_key -> cursor
+
+        Returns:
+            List[Tuple[str, List[dict], str]]: (query, submissions, error_msg) of each
+            query that was read
+        """
+        try:
+            return [(query, await self.read_new_submissions(query, cursors), "")]
+        except SUBREDDIT_ERRORS as e:
+            names = query.split("+")
+            if len(names) == 1:
+                return [(query, [], self.error_message(query, e))]
+            middle = len(names) // 2
+            return await self.read_isolating_failures(
+                "+".join(names[:middle]), cursors
+            ) + await self.read_isolating_failures("+".join(names[middle:]), cursors)
+        except FETCH_ERRORS as e:
+            return [(query, [], self.error_message(query, e))]
+
+    async def fetch_new_submissions(
+        self, query: str, cursors: Dict[str, dict] | None = None
+    ) -> Tuple[List[dict], str]:
+        """read_new_submissions, returning an error message instead of raising
+
+        Returns:
+            Tuple[List[dict], str]: (submissions, error_msg)
+        """
+        try:
+            return await self.read_new_submissions(query, cursors), ""
+        except FETCH_ERRORS as e:
+            return [], self.error_message(query, e)
+
+    async def read_new_submissions(
+        self, query: str, cursors: Dict[str, dict] | None = None
+    ) -> List[dict]:
+        """Returns the new selfposts of a "+" joined subreddit query
+
+        A cursor is the newest submission seen of a subreddit:
+        {"fullname": ..., "created_utc": ...}. The query's new listings are paged
+        from the top and reading stops once it is past every cursor, and at least
+        REDDIT_NEW_LIMIT submissions were read when a subreddit has none yet. A
+        quiet subreddit's cursor is passed as soon as a submission of any subreddit
+        is older than it. A busy subreddit can not hide a quiet one's new posts this
+        way, unlike before= paging, which returns the page just newer than its
+        anchor. Reading never goes past REDDIT_MAX_SCAN submissions.
+
+        The updated cursors of the query's subreddits are stored in self.res_cursors.
+
+        Args:
+            query (str): "+" joined subreddit names, see multireddit_queries
+            cursors (Dict[str, dict] | None, optional): subreddit_key -> cursor
+
+        Raises:
+            FETCH_ERRORS: The request failed
+
+        Returns:
+            List[dict]: The new selfposts
+        """
+        cursors = cursors or {}
+        names = query.lower().split("+")
+        pending = {name for name in names if name in cursors}
+        all_have_cursors = len(pending) == len(names)
+        newest: Dict[str, dict] = {}
+        submissions = []
+        read = 0
+        with metrics.REDDIT_FETCH_SECONDS.time(), span("reddit", query=query):
+            subreddits = await self.reddit.subreddit(query)
+            async for submission in subreddits.new(limit=REDDIT_MAX_SCAN):
+                read += 1
+                key = self.subreddit_key(submission.subreddit_name_prefixed)
+                if key not in newest:
+                    newest[key] = {
+                        "fullname": submission.fullname,
+                        "created_utc": submission.created_utc,
+                    }
+                # The listing is newest first across every subreddit of the
+                # query, so a cursor newer than this submission has been passed
+                # whether or not its own subreddit posted since
+                pending = {
+                    name
+                    for name in pending
+                    if cursors[name]["created_utc"] <= submission.created_utc
+                }
+                cursor = cursors.get(key)
+                if cursor and (
+                    submission.fullname == cursor["fullname"]
+                    or submission.created_utc < cursor["created_utc"]
+                ):
+                    pending.discard(key)
+                # Only selfpost (user content) should be shown
+                elif getattr(submission, "permalink"):
+                    submissions.append(
+                        dict(
                             subreddit=submission.subreddit_name_prefixed,
                             title=submission.title,
                             description=submission.selftext,
                             link=submission.permalink,
                             image=submission.thumbnail,
-                            sent=False,
+                            created_utc=submission.created_utc,
                         )
-                        self.res_dicts.append(submission_dict)
-            except RequestException as e:
-                self.error = True
-                self.error_msg = (
-                    f"**500 Error while retrieving subreddit(s) new listings: {e}**"
-                )
+                    )
+                if not pending and (all_have_cursors or read >= REDDIT_NEW_LIMIT):
+                    break
+        for name in names:
+            cursor = cursors.get(name, {})
+            if name in newest and newest[name]["created_utc"] >= cursor.get(
+                "created_utc", 0
+            ):
+                cursor = {**cursor, **newest[name]}
+            if "fullname" in cursor:
+                self.res_cursors[name] = cursor
+        return submissions
 
     async def check_subreddit_exists(self, subreddit_name: str) -> Tuple[bool, str]:
         """Calls the asyncpraw api and checks whether a given subreddit_name exists"""
@@ -0,0 +1,92 @@
+"""Render cache for discord embeds
+
+Converting an entry's html to markdown (BeautifulSoup + markdownify) is the most
+expensive part of building an embed. The same entry is shown in every channel that
+subscribes to its feed, and the same feed is shown by every `.rss ls`, so finished
+embeds are cached by a hash of the fields they are rendered from. Identical content
+is rendered once, whichever feed document, channel or command it comes from.
+
+Embeds are stored as json, least recently used first, and evicted once the cache
+holds more than RENDER_CACHE_BYTES.
+
+Environment Variables:
+- RENDER_CACHE_BYTES
+    - Size budget of the cache in bytes. Defaults to 16777216 (16 MiB)
+"""
+
+import os
+import json
+import discord
+from collections import OrderedDict
+from typing import Dict
+
+from .common import dedup_key
+
+RENDER_CACHE_BYTES = int(os.getenv("RENDER_CACHE_BYTES", 16 * 1024 * 1024))
+
+
+def payload_key(kind: str, payload) -> str:
+    """Returns a key for payload that only depends on its content
+
+    Args:
+        kind (str): What is rendered from payload, so an about embed and an entry
+            embed of the same content do not share a key
+        payload: Any json serializable value. Dict keys are sorted.
+    """
+    return dedup_key(kind, json.dumps(payload, sort_keys=True, default=str))
+
+
+class RenderCache:
+    """LRU cache of rendered embeds with a size budget in bytes"""
+
+    def __init__(self, max_bytes: int = RENDER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.embeds: OrderedDict[str, str] = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.embeds)
+
+    def get(self, key: str) -> discord.Embed | None:
+        """Returns a new Embed for key, or None on a miss"""
+        data = self.embeds.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.embeds.move_to_end(key)
+        return discord.Embed.from_dict(json.loads(data))
+
+    def put(self, key: str, embed: discord.Embed) -> None:
+        data = json.dumps(embed.to_dict())
+        if len(data) > self.max_bytes:
+            return
+        if key in self.embeds:
+            self.bytes -= len(self.embeds.pop(key))
+        self.embeds[key] = data
+        self.bytes += len(data)
+        while self.bytes > self.max_bytes:
+            _, evicted = self.embeds.popitem(last=False)
+            self.bytes -= len(evicted)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self.embeds.clear()
+        self.bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the cache size and counters since the cache was created"""
+        return {
+            "entries": len(self.embeds),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# Shared by every RSSFeed instance
+render_cache = RenderCache()
@@ -0,0 +1,118 @@
+"""Retention of feed entries and sent reddit listings
+
+feed_entries, feed_entry_keys and reddit_listings only exist to stop an entry or a listing from
+being sent twice, so they do not need to be kept forever:
+
+- A feed entry is kept while polls read it. Every poll that downloads a feed
+refreshes seen_at on the entries it reads, and a TTL index removes entries
+FEED_ENTRY_RETENTION_DAYS after they were last seen. Reading stops at the feed's last
+seen mark (see feed_stream.py), so entries listed below the mark expire even though
+the feed still lists them. Should the feed be read past its mark again, they are
+stored again but not sent, as their entry_key is kept in feed_entry_keys for
+FEED_ENTRY_KEY_RETENTION_DAYS after it was first stored. Only entries whose key is
+not found there are delivered, so a new entry dated before the mark is still sent.
+- A sent listing is removed REDDIT_LISTING_RETENTION_DAYS after sent_at by a TTL
+index. The subreddit cursors (reddit_cursors) keep older submissions from being
+fetched again. Unsent listings never expire.
+- A message queued by a headless poller (deliveries) is removed
+DELIVERY_RETENTION_DAYS after it was sent.
+
+Feed entries are stored with the fields in FEED_ENTRY_FIELDS only. Entries stored in
+full before this existed and documents stored without seen_at/sent_at are fixed once
+by the retention_fields migration (see migrations.py). compact, run by
+FeedBot.retention_task, reports the bytes reclaimed from each collection.
+
+Environment Variables:
+- FEED_ENTRY_RETENTION_DAYS
+    - Days a feed entry is kept after its feed last listed it. Defaults to 30
+- FEED_ENTRY_KEY_RETENTION_DAYS
+    - Days the key of a feed entry is kept after it was first stored. Feeds that
+    list entries for longer may resend them afterwards. Defaults to 365
+- REDDIT_LISTING_RETENTION_DAYS
+    - Days a listing is kept after it was sent. Defaults to 7
+- DELIVERY_RETENTION_DAYS
+    - Days a queued message is kept after it was sent. Defaults to 1
+- RETENTION_COMPACT
+    - Set to true to run MongoDB's compact command on the collections after they
+    were trimmed. Requires the compact privilege. Defaults to false
+"""
+
+import os
+from typing import Dict
+from pymongo.errors import OperationFailure
+
+FEED_ENTRY_RETENTION_DAYS = float(os.getenv("FEED_ENTRY_RETENTION_DAYS", 30))
+FEED_ENTRY_KEY_RETENTION_DAYS = float(os.getenv("FEED_ENTRY_KEY_RETENTION_DAYS", 365))
+REDDIT_LISTING_RETENTION_DAYS = float(os.getenv("REDDIT_LISTING_RETENTION_DAYS", 7))
+DELIVERY_RETENTION_DAYS = float(os.getenv("DELIVERY_RETENTION_DAYS", 1))
+RETENTION_COMPACT = os.getenv("RETENTION_COMPACT", "").lower() in ("1", "true", "yes")
+
+SECONDS_PER_DAY = 86400
+
+# The fields of a stored feed entry, everything else is only needed to render it
+FEED_ENTRY_FIELDS = [
+    "entry_key",
+    "feed_url",
+    "title",
+    "link",
+    "dt_published",
+    "seen_at",
+]
+
+# feedparser fields that are only found on entries stored in full
+FULL_ENTRY_FIELDS = ["summary", "content", "links", "summary_detail", "title_detail"]
+
+
+def feed_entry_ttl() -> int:
+    return int(FEED_ENTRY_RETENTION_DAYS * SECONDS_PER_DAY)
+
+
+def feed_entry_key_ttl() -> int:
+    return int(FEED_ENTRY_KEY_RETENTION_DAYS * SECONDS_PER_DAY)
+
+
+def reddit_listing_ttl() -> int:
+    return int(REDDIT_LISTING_RETENTION_DAYS * SECONDS_PER_DAY)
+
+
+def delivery_ttl() -> int:
+    return int(DELIVERY_RETENTION_DAYS * SECONDS_PER_DAY)
+
+
+async def free_storage_size(db, collection_name: str) -> int:
+    """Returns the bytes of a collection's files that are free for reuse
+
+    Documents removed by the TTL indexes or slimmed by the migrations leave free
+    space in the collection and its indexes. MongoDB reuses it for new documents but
+    only returns it to the operating system when the collection is compacted.
+    """
+    stats = await db.command("collStats", collection_name)
+    return stats.get("freeStorageSize", 0) + stats.get("indexFreeStorageSize", 0)
+
+
+async def compact(db) -> Dict[str, int]:
+    """Reports the bytes the TTL indexes reclaimed from feed_entries and reddit_listings
+
+    With RETENTION_COMPACT the bytes compact returned to the operating system are
+    reported, otherwise the bytes free for reuse, see free_storage_size.
+
+    Args:
+        db: motor database
+
+    Returns:
+        Dict[str, int]: collection name -> bytes reclaimed
+    """
+    reclaimed = {}
+    for name in ("feed_entries", "reddit_listings"):
+        freed = None
+        if RETENTION_COMPACT:
+            try:
+                result = await db.command("compact", name)
+                freed = result.get("bytesFreed")
+            except OperationFailure as e:
+                print(f"Retention: could not compact {name}: {e}")
+        if freed is None:
+            freed = await free_storage_size(db, name)
+        reclaimed[name] = freed
+    print(f"Retention: reclaimed bytes {reclaimed}")
+    return reclaimed
@@ -1,33 +1,230 @@
+import os
+import time
+import asyncio
 import discord
 import feedparser
+from urllib.parse import urlsplit
 from bs4 import BeautifulSoup
+from aiohttp import ClientError, ClientTimeout
 from aiohttp.web import HTTPException
-from .common import CommonUtilities, IMAGE_MIME_TYPES, md
-from typing import Literal, List
+from . import metrics
+from .tracing import span
+from .common import CommonUtilities, IMAGE_MIME_TYPES, dedup_key, md
+from .feed_stream import FeedTooLarge, last_seen_mark, read_feed
+from .render_cache import payload_key, render_cache
+from .scheduler import poll_hint
+from .workers import run_in_pool
+from datetime import datetime
+from typing import Dict, Literal, List, Tuple
+
+# Fetch engine limits. Total in-flight requests, in-flight requests to a
+# single host and seconds before a request to a feed is abandoned.
+RSS_MAX_CONCURRENCY = int(os.getenv("RSS_MAX_CONCURRENCY", 50))
+RSS_MAX_PER_HOST = int(os.getenv("RSS_MAX_PER_HOST", 4))
+RSS_REQUEST_TIMEOUT = float(os.getenv("RSS_REQUEST_TIMEOUT", 30.0))
+
+# The entry keys parse_entry_flat reads. An entry embed is cached by their values.
+ENTRY_RENDER_FIELDS = (
+    "feed_url",
+    "title",
+    "thumbnail",
+    "summary",
+    "author_detail",
+    "link",
+    "published",
+    "content",
+    "imageurl",
+    "links",
+)
+
+
+def parse_feed(rss: str | bytes) -> feedparser.FeedParserDict:
+    """Parses a feed document with feedparser. Runs in the worker pool.
+
+    Only the keys RSSFeed reads are returned so the result stays small and picklable.
+    feedparser detects the encoding of bytes from the document itself.
+    """
+    feed_data = feedparser.parse(rss)
+    return feedparser.FeedParserDict(
+        bozo=feed_data.get("bozo", 1),
+        feed=feed_data.get("feed", feedparser.FeedParserDict()),
+        entries=feed_data.get("entries", []),
+    )
+
+
+def parse_entries_flat(entries: List[dict]) -> List[List[str | dict]]:
+    """RSSFeed.parse_entry_flat for a batch of entries. Runs in the worker pool."""
+    return [RSSFeed.parse_entry_flat(entry) for entry in entries]
 
 
 class RSSFeed(CommonUtilities):
     """Utility class for interacting with website rss feeds"""
 
-    async def get_rss_feed(self, url: str):
-        """Fetch an rss feed within the aiohttp session and have feedparser parse the response text"""
-        async with self.session.get(url) as response:
-            rss = await response.text()
-            return feedparser.parse(rss)
+    feed_errors: Dict[str, str] = {}
+    not_modified: List[str] = []
+    res_validators: Dict[str, dict] = {}
+    res_urls: List[str] = []
+    res_poll_hints: Dict[str, float | None] = {}
+    res_last_seen: Dict[str, datetime | None] = {}
+
+    def clear(self):
+        super().clear()
+        self.feed_errors = {}
+        self.not_modified = []
+        self.res_validators = {}
+        self.res_urls = []
+        self.res_poll_hints = {}
+        self.res_last_seen = {}
+
+    async def get_rss_feed(self, url: str, validator: dict | None = None):
+        """Fetch an rss feed within the aiohttp session and have feedparser parse the response text
+
+        When a validator from a previous response is given the request is made conditional
+        with If-None-Match/If-Modified-Since. A 304 response is not parsed, instead an empty
+        result with status 304 is returned the same way feedparser does for its own requests.
+
+        The response is read with feed_stream.read_feed, which stops at the validator's
+        last_seen mark or after RSS_MAX_ENTRIES entries.
+
+        Args:
+            url (str): The feed url
+            validator (dict | None, optional): {"etag": ..., "last_modified": ..., "last_seen": ...}.
+                Defaults to None.
+
+        Raises:
+            FeedTooLarge: The response is larger than RSS_MAX_FEED_BYTES
+
+        Returns:
+            FeedParserDict: The parsed feed. status, etag and modified are set from the response.
+        """
+        headers = {}
+        if validator:
+            if etag := validator.get("etag"):
+                headers["If-None-Match"] = etag
+            if last_modified := validator.get("last_modified"):
+                headers["If-Modified-Since"] = last_modified
+        timeout = ClientTimeout(total=RSS_REQUEST_TIMEOUT)
+        async with self.session.get(url, headers=headers, timeout=timeout) as response:
+            if response.status == 304:
+                feed_data = feedparser.FeedParserDict(
+                    bozo=0, feed=feedparser.FeedParserDict(), entries=[]
+                )
+            else:
+                response.raise_for_status()
+                with span("read", url=url):
+                    rss = await read_feed(
+                        response,
+                        since=validator.get("last_seen") if validator else None,
+                    )
+                if response.charset:
+                    rss = rss.decode(response.charset)
+                with metrics.FEED_PARSE_SECONDS.time(), span("parse", url=url):
+                    feed_data = await run_in_pool(parse_feed, rss)
+            feed_data["status"] = response.status
+            feed_data["etag"] = response.headers.get("ETag")
+            feed_data["modified"] = response.headers.get("Last-Modified")
+            feed_data["cache_control"] = response.headers.get("Cache-Control")
+            return feed_data
+
+    async def fetch_feed(
+        self,
+        url: str,
+        semaphore: asyncio.Semaphore,
+        host_semaphores: Dict[str, asyncio.Semaphore],
+        validator: dict | None = None,
+    ) -> Tuple[str, dict | None, str]:
+        """Fetches and parses a single feed within the concurrency limits
+
+        The per-host slot is acquired before the global slot so that requests queued
+        behind a busy host never hold on to global capacity.
+
+        Args:
+            url (str): The feed url
+            semaphore (asyncio.Semaphore): Global concurrency limit
+            host_semaphores (Dict[str, asyncio.Semaphore]): Per-host concurrency limits keyed by hostname
+            validator (dict | None, optional): See get_rss_feed
+
+        Returns:
+            Tuple[str, dict | None, str]: (url, feed_data, error_msg). feed_data is None when
+            error_msg is set.
+        """
+        host = urlsplit(url).hostname or ""
+        if host not in host_semaphores:
+            host_semaphores[host] = asyncio.Semaphore(RSS_MAX_PER_HOST)
+        outcome = "error"
+        started = time.perf_counter()
+        try:
+            async with host_semaphores[host], semaphore:
+                started = time.perf_counter()
+                with span("fetch", url=url):
+                    feed_data = await self.get_rss_feed(url=url, validator=validator)
+            outcome = "not_modified" if feed_data.get("status") == 304 else "ok"
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            return (
+                url,
+                None,
+                (
+                    f"Timed out after {RSS_REQUEST_TIMEOUT}s while fetching an rss feed "
+                    f"Channel ID: {self.channel_id}, URL: {url}"
+                ),
+            )
+        except FeedTooLarge as e:
+            return (
+                url,
+                None,
+                f"{e} Channel ID: {self.channel_id}, URL: {url}",
+            )
+        except (HTTPException, ClientError, UnicodeDecodeError, LookupError) as e:
+            return (
+                url,
+                None,
+                (
+                    f"An error occurred while fetching an rss feed: {e} "
+                    f"Channel ID: {self.channel_id}, URL: {url}"
+                ),
+            )
+        finally:
+            metrics.FEED_FETCH_SECONDS.observe(
+                time.perf_counter() - started, outcome=outcome
+            )
+        if feed_data.get("bozo", 1) == 1:
+            return (
+                url,
+                None,
+                f"Not well-formed XML Channel ID: {self.channel_id}, URL: {url}",
+            )
+        return (url, feed_data, "")
 
     async def parse_feed_urls(
         self,
         feed_urls: List[str],
         feed_key: Literal["feed", "entries", None] = None,
+        validators: Dict[str, dict] | None = None,
     ) -> None:
-        """Iterates of feed_urls performing GET requests
+        """Concurrently performs GET requests for feed_urls
+
+        Requests are bounded by RSS_MAX_CONCURRENCY in total, RSS_MAX_PER_HOST per host
+        and RSS_REQUEST_TIMEOUT per request. Every url produces its own result so that a
+        slow or broken feed never hides the others.
+
+        When validators are given, requests are conditional. Feeds that respond with
+        304 Not Modified are listed in self.not_modified and left out of self.res_dicts.
+        The validators of every 200 response are collected in self.res_validators so they
+        can be stored for the next poll.
+
+        self.res_urls holds the requested url of each item of self.res_dicts and
+        self.res_poll_hints the publisher's poll interval hint of every fetched url,
+        see scheduler.poll_hint. self.res_last_seen holds the last seen mark of every
+        url that returned entries, to be stored alongside its validators.
 
         Exceptions:
-            - Sets self.error and self.error_msg if an exception is encountered during
-            the aiohttp session request. Errors are raised one at a time instead of
-            being grouped together. Could be changed at a future date.
-            - Also sets self.error and self.error_msg if mal-formed XML is encountered.
-            If this error is shown we recommend not adding the url to your channel feeds
+            - Failed urls are recorded in self.feed_errors as url -> error message. This
+            covers aiohttp session errors, timeouts, non 2xx responses and mal-formed XML.
+            If a mal-formed XML error is shown we recommend not adding the url to your
+            channel feeds.
+            - self.error is set when at least one url failed and self.error_msg holds
+            every error message, one per line.
 
         Args:
             feed_urls ]): A list of feed urls
@@ -35,38 +232,83 @@ class RSSFeed(CommonUtilities):
                 - Determines the dictionary in the response that will be returned.
                 - Defaults to None.
                 - If None a tuple of dictionaries are returned (feed, entry)
+            validators (Dict[str, dict] | None, optional):
+                - Validators from previous responses keyed by feed url.
+                - Defaults to None, in which case every feed is downloaded in full.
 
         Returns:
             None. Note that self.error, self.error_msg, and self.res_dicts are inherited attributes
-            from CommonUtilities and comprise the state of our object.
+            from CommonUtilities and comprise the state of our object. self.res_dicts
+            only holds the feeds that were fetched successfully, in the order of feed_urls.
         """
         self.clear()
-        for url in feed_urls:
-            if url:
-                try:
-                    feed_data = await self.get_rss_feed(url=url)
-                except HTTPException as e:
-                    self.error = True
-                    self.error_msg = (
-                        f"An error occurred while fetching an rss feed: {e} "
-                        f"Channel ID: {self.channel_id}, URL: {url}"
-                    )
-                    break
-                else:
-                    if feed_data.get("bozo", 1) == 1:
-                        self.error = True
-                        self.error_msg = (
-                            f"Not well-formed XML "
-                            f"Channel ID: {self.channel_id}, URL: {url}"
-                        )
-                        break
-                    if feed_key is None:
-                        feed = feed_data.get("feed")
-                        entries = feed_data.get("entries")
-                        data = (feed, entries)
-                    else:
-                        data = feed_data.get(feed_key)
-                    self.res_dicts.append(data)
+        urls = list(dict.fromkeys(url for url in feed_urls if url))
+        semaphore = asyncio.Semaphore(RSS_MAX_CONCURRENCY)
+        host_semaphores: Dict[str, asyncio.Semaphore] = {}
+        validators = validators or {}
+        results = await asyncio.gather(
+            *[
+                self.fetch_feed(
+                    url=url,
+                    semaphore=semaphore,
+                    host_semaphores=host_semaphores,
+                    validator=validators.get(url),
+                )
+                for url in urls
+            ],
+            return_exceptions=True,
+        )
+        for url, result in zip(urls, results):
+            if isinstance(result, BaseException):
+                self.feed_errors[url] = (
+                    f"An error occurred while fetching an rss feed: {result!r} "
+                    f"Channel ID: {self.channel_id}, URL: {url}"
+                )
+                continue
+            _, feed_data, error_msg = result
+            if error_msg:
+                self.feed_errors[url] = error_msg
+                continue
+            self.res_poll_hints[url] = poll_hint(
+                feed_data.get("feed", {}), feed_data.get("cache_control")
+            )
+            if feed_data.get("status") == 304:
+                self.not_modified.append(url)
+                continue
+            if entries := feed_data.get("entries"):
+                self.res_last_seen[url] = last_seen_mark(entries)
+            if feed_data.get("etag") or feed_data.get("modified"):
+                self.res_validators[url] = {
+                    "etag": feed_data.get("etag"),
+                    "last_modified": feed_data.get("modified"),
+                }
+            if feed_key is None:
+                data = (feed_data.get("feed"), feed_data.get("entries"))
+            else:
+                data = feed_data.get(feed_key)
+            self.res_dicts.append(data)
+            self.res_urls.append(url)
+        if self.feed_errors:
+            self.error = True
+            self.error_msg = "\n".join(self.feed_errors.values())
+
+    @staticmethod
+    def entry_key(feed_url: str, entry: dict) -> str:
+        """Returns the dedup key of an entry
+
+        The entry's guid is preferred, then its link, then its title and publish date.
+
+        Args:
+            feed_url (str): The feed url the entry belongs to
+            entry (dict): Value of an entry. From the "entries" key in feed_data
+
+        Returns:
+            str: The dedup key stored as "entry_key" in the rss collection
+        """
+        entry_id = entry.get("id") or entry.get("link")
+        if not entry_id:
+            entry_id = f"{entry.get('title', '')}|{entry.get('published', '')}"
+        return dedup_key(feed_url, entry_id)
 
     @staticmethod
     def parse_feed_flat(feed: dict) -> List[str | dict]:
@@ -178,12 +420,24 @@ class RSSFeed(CommonUtilities):
     def create_about_embed(self, feed: dict) -> discord.Embed:
         """Converts a feed dictionary into a discord Embed.
 
+        Embeds are cached by the fields they are rendered from, see render_cache.py
+
         Args:
             feed (dict): Value of the "feed" key in feed_data
 
         Returns:
             discord.Embed: Represents a Discord embed.
         """
+        feed_flat = self.parse_feed_flat(feed)
+        key = payload_key("about", feed_flat)
+        if (embed := render_cache.get(key)) is None:
+            embed = self.build_about_embed(feed_flat)
+            render_cache.put(key, embed)
+        return embed
+
+    @staticmethod
+    def build_about_embed(feed_flat: List[str | dict]) -> discord.Embed:
+        """Renders the parse_feed_flat result of a feed as a discord Embed"""
         (
             feed_url,
             title,
@@ -193,7 +447,7 @@ class RSSFeed(CommonUtilities):
             author_detail,
             link,
             image,
-        ) = self.parse_feed_flat(feed)
+        ) = feed_flat
 
         if len(title) > 256:
             title = f"{title[:253]}..."
@@ -215,15 +469,72 @@ class RSSFeed(CommonUtilities):
         embed.add_field(name="feed url", value=feed_url, inline=False)
         return embed
 
-    def create_entry_embed(self, entry: dict) -> discord.Embed:
+    async def parse_entries_flat(self, entries: List[dict]) -> List[List[str | dict]]:
+        """Runs parse_entry_flat for every entry in the worker pool
+
+        Args:
+            entries (List[dict]): Entries from the "entries" key in feed_data
+
+        Returns:
+            List[List[str | dict]]: parse_entry_flat result for each entry, in order
+        """
+        if not entries:
+            return []
+        with span("render", entries=len(entries)):
+            return await run_in_pool(parse_entries_flat, entries)
+
+    @staticmethod
+    def entry_render_key(entry: dict) -> str:
+        """Returns the render cache key of an entry, see ENTRY_RENDER_FIELDS"""
+        return payload_key(
+            "entry", {field: entry.get(field) for field in ENTRY_RENDER_FIELDS}
+        )
+
+    async def render_entry_embeds(self, entries: List[dict]) -> List[discord.Embed]:
+        """Converts entries into discord Embeds, parsing only the ones not cached yet
+
+        Cache misses are parsed in the worker pool in a single batch.
+
+        Args:
+            entries (List[dict]): Entries from the "entries" key in feed_data
+
+        Returns:
+            List[discord.Embed]: An embed for each entry, in order
+        """
+        keys = [self.entry_render_key(entry) for entry in entries]
+        embeds = [render_cache.get(key) for key in keys]
+        missing = [i for i, embed in enumerate(embeds) if embed is None]
+        entries_flat = await self.parse_entries_flat([entries[i] for i in missing])
+        for i, entry_flat in zip(missing, entries_flat):
+            embeds[i] = self.build_entry_embed(entry_flat)
+            render_cache.put(keys[i], embeds[i])
+        return embeds
+
+    def create_entry_embed(
+        self, entry: dict, entry_flat: List[str | dict] | None = None
+    ) -> discord.Embed:
         """Converts an entry dictionary into a discord Embed.
 
+        Embeds are cached by the fields they are rendered from, see render_cache.py
+
         Args:
             entry (dict): Value of an entry. From the "entries" key in feed_data
+            entry_flat (List[str | dict] | None, optional):
+                - parse_entry_flat result for entry, see parse_entries_flat.
+                - Defaults to None, in which case entry is parsed on the event loop.
 
         Returns:
             discord.Embed: Represents a Discord embed.
         """
+        key = self.entry_render_key(entry)
+        if (embed := render_cache.get(key)) is None:
+            embed = self.build_entry_embed(entry_flat or self.parse_entry_flat(entry))
+            render_cache.put(key, embed)
+        return embed
+
+    @staticmethod
+    def build_entry_embed(entry_flat: List[str | dict]) -> discord.Embed:
+        """Renders the parse_entry_flat result of an entry as a discord Embed"""
         (
             feed_url,
             title,
@@ -235,7 +546,7 @@ class RSSFeed(CommonUtilities):
             content,
             description,
             entry_image,
-        ) = self.parse_entry_flat(entry)
+        ) = entry_flat
 
         if len(title) > 256:
             title = f"{title[:253]}..."
@@ -0,0 +1,181 @@
+"""Adaptive polling scheduler
+
+Each feed (or subreddit) is polled on its own interval instead of all of them at
+once every LOOP_CYCLE. The interval shrinks while a feed keeps publishing new
+entries and grows while it does not, within POLL_MIN_INTERVAL and POLL_MAX_INTERVAL.
+Publisher hints (Cache-Control max-age, <ttl>, <sy:updatePeriod>) are honoured as a
+lower bound. Start and due times are jittered so polling is spread out evenly.
+
+Environment Variables:
+- POLL_MIN_INTERVAL
+    - Shortest interval in seconds. Defaults to 300
+- POLL_MAX_INTERVAL
+    - Longest interval in seconds. Defaults to 21600 (6 hours)
+- POLL_JITTER
+    - Fraction an interval is randomly stretched or shrunk by. Defaults to 0.1
+"""
+
+import os
+import re
+import time
+import heapq
+import random
+from typing import Callable, Dict, Iterable, List, Tuple
+
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", 300.0))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", 21600.0))
+POLL_JITTER = float(os.getenv("POLL_JITTER", 0.1))
+
+# Interval multipliers applied after a poll with and without new entries
+SPEED_UP = 0.5
+SLOW_DOWN = 1.5
+
+SY_UPDATE_PERIODS = {
+    "hourly": 3600,
+    "daily": 86400,
+    "weekly": 604800,
+    "monthly": 2592000,
+    "yearly": 31536000,
+}
+
+
+def poll_hint(feed: dict, cache_control: str | None = None) -> float | None:
+    """Returns the shortest poll interval in seconds a publisher asks for, if any
+
+    Args:
+        feed (dict): Value of the "feed" key in feed_data
+        cache_control (str | None, optional): Cache-Control response header
+
+    Returns:
+        float | None: The largest of the max-age, <ttl> and <sy:updatePeriod> hints
+    """
+    hints = []
+    if cache_control and (match := re.search(r"max-age=(\d+)", cache_control)):
+        hints.append(float(match.group(1)))
+    ttl = feed.get("ttl")
+    if ttl and str(ttl).isdigit():
+        hints.append(float(ttl) * 60)  # <ttl> is in minutes
+    if period := SY_UPDATE_PERIODS.get(str(feed.get("sy_updateperiod", "")).strip()):
+        frequency = str(feed.get("sy_updatefrequency", "1")).strip()
+        frequency = int(frequency) if frequency.isdigit() and int(frequency) else 1
+        hints.append(period / frequency)
+    return max(hints) if hints else None
+
+
+class PollScheduler:
+    """Priority queue of poll keys (feed urls or subreddits) ordered by next due time
+
+    Keys are handed out by pop_due and are in flight until complete is called for
+    them. A key that is in flight is never handed out again, so a poll that runs
+    longer than its interval is reported by overruns instead of being started twice.
+    """
+
+    def __init__(
+        self,
+        default_interval: float,
+        min_interval: float = POLL_MIN_INTERVAL,
+        max_interval: float = POLL_MAX_INTERVAL,
+        jitter: float = POLL_JITTER,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.min_interval = min(min_interval, default_interval)
+        self.max_interval = max(max_interval, default_interval)
+        self.default_interval = default_interval
+        self.jitter = jitter
+        self.clock = clock
+        self.heap: List[Tuple[float, str]] = []
+        self.due: Dict[str, float] = {}
+        self.intervals: Dict[str, float] = {}
+        self.in_flight: Dict[str, float] = {}
+
+    def __len__(self) -> int:
+        return len(self.due) + len(self.in_flight)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.due or key in self.in_flight
+
+    def jittered(self, interval: float) -> float:
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def schedule(self, key: str, due: float) -> None:
+        self.due[key] = due
+        heapq.heappush(self.heap, (due, key))
+
+    def sync(
+        self,
+        keys: Iterable[str],
+        intervals: Dict[str, float] | None = None,
+        polled_at: Dict[str, float] | None = None,
+    ):
+        """Adds new keys and forgets keys that are no longer polled
+
+        New keys start at a random time within the shortest interval so a restart or a
+        bulk import does not poll everything at once. A key that was polled less than
+        its interval ago, by this or another process, waits for its interval instead.
+
+        Args:
+            keys (Iterable[str]): Every key that should be polled
+            intervals (Dict[str, float] | None, optional): Stored intervals of keys
+            polled_at (Dict[str, float] | None, optional): Timestamps of the last polls
+        """
+        keys = set(keys)
+        intervals = intervals or {}
+        polled_at = polled_at or {}
+        now = self.clock()
+        for key in keys:
+            if key in self.due or key in self.in_flight:
+                continue
+            self.intervals[key] = intervals.get(key, self.default_interval)
+            due = now + random.uniform(0, self.min_interval)
+            if key in polled_at:
+                due = max(due, polled_at[key] + self.intervals[key])
+            self.schedule(key, due)
+        for key in list(self.due):
+            if key not in keys:
+                del self.due[key]
+                self.intervals.pop(key, None)
+
+    def pop_due(self) -> List[str]:
+        """Returns the keys that are due and marks them in flight"""
+        now = self.clock()
+        due_keys = []
+        while self.heap and self.heap[0][0] <= now:
+            due, key = heapq.heappop(self.heap)
+            if self.due.get(key) != due:
+                continue  # removed or rescheduled
+            del self.due[key]
+            self.in_flight[key] = now
+            due_keys.append(key)
+        return due_keys
+
+    def complete(
+        self, key: str, new_entries: bool = False, hint: float | None = None
+    ) -> float:
+        """Adapts the interval of a polled key and schedules its next poll
+
+        Args:
+            key (str): A key returned by pop_due
+            new_entries (bool, optional): Whether the poll found new entries
+            hint (float | None, optional): See poll_hint
+
+        Returns:
+            float: The key's new interval in seconds
+        """
+        self.in_flight.pop(key, None)
+        interval = self.intervals.get(key, self.default_interval)
+        interval *= SPEED_UP if new_entries else SLOW_DOWN
+        if hint:
+            interval = max(interval, hint)
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        self.intervals[key] = interval
+        self.schedule(key, self.clock() + self.jittered(interval))
+        return interval
+
+    def overruns(self) -> List[Tuple[str, float]]:
+        """Returns (key, seconds in flight) for keys in flight for longer than their interval"""
+        now = self.clock()
+        return [
+            (key, now - started)
+            for key, started in self.in_flight.items()
+            if now - started > self.intervals.get(key, self.default_interval)
+        ]
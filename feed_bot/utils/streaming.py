@@ -0,0 +1,140 @@
+"""Streaming reads from MongoDB
+
+cursor.to_list(None) and collection.distinct load a whole result set at once, so the
+memory a task needs grows with the number of subscriptions and listings. The
+helpers below read in batches of MONGO_BATCH_SIZE instead. Pass a projection so only
+the fields a consumer uses are sent over the wire.
+
+memory_ceiling measures the peak memory allocated while a task runs. tracemalloc keeps
+a single peak for the whole process, so only one task is measured at a time, tasks
+that start while another is measured are not measured. The peak also holds what
+concurrently running tasks allocated in the meantime. The ceiling is advisory: a task that allocates more than TASK_MEMORY_CEILING bytes is logged and
+counted in metrics.TASK_MEMORY_CEILING_EXCEEDED but runs to the end. It relies on
+tracemalloc, which slows python down, so it is disabled unless TASK_MEMORY_CEILING
+is set.
+
+Environment Variables:
+- MONGO_BATCH_SIZE
+    - Documents read per batch. Defaults to 500
+- TASK_MEMORY_CEILING
+    - Bytes a task may allocate at its peak before it is reported. Defaults to 0,
+    which disables tracing
+"""
+
+import os
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Iterator, List
+
+from . import metrics
+
+MONGO_BATCH_SIZE = int(os.getenv("MONGO_BATCH_SIZE", 500))
+TASK_MEMORY_CEILING = int(os.getenv("TASK_MEMORY_CEILING", 0))
+
+# Name of the task memory_ceiling is measuring, reset_peak would clobber its peak
+measured_task: str | None = None
+
+
+async def stream_batches(
+    cursor, batch_size: int | None = None
+) -> AsyncIterator[List[dict]]:
+    """Yields the documents of a motor cursor in lists of at most batch_size
+
+    Args:
+        cursor: motor cursor, from find or aggregate
+        batch_size (int | None, optional): Defaults to MONGO_BATCH_SIZE
+    """
+    batch_size = batch_size or MONGO_BATCH_SIZE
+    cursor.batch_size(batch_size)
+    while batch := await cursor.to_list(batch_size):
+        yield batch
+
+
+def distinct_pipeline(key: str, filter: dict | None = None) -> List[dict]:
+    """Aggregation pipeline returning the distinct values of key as _id"""
+    return [
+        {"$match": {key: {"$exists": True}, **(filter or {})}},
+        {"$group": {"_id": f"${key}"}},
+    ]
+
+
+async def distinct_batches(
+    collection, key: str, filter: dict | None = None, batch_size: int | None = None
+) -> AsyncIterator[List[Any]]:
+    """Yields the distinct values of key in lists of at most batch_size
+
+    Unlike collection.distinct the values are grouped by an aggregation that is read
+    in batches, so the result is neither held in memory at once nor limited to the
+    16MB size of a single document.
+
+    Args:
+        collection: motor collection
+        key (str): Field to return the distinct values of
+        filter (dict | None, optional): Only consider documents that match filter
+        batch_size (int | None, optional): Defaults to MONGO_BATCH_SIZE
+    """
+    cursor = collection.aggregate(distinct_pipeline(key, filter))
+    async for batch in stream_batches(cursor, batch_size):
+        yield [doc["_id"] for doc in batch]
+
+
+async def distinct_values(
+    collection, key: str, filter: dict | None = None, batch_size: int | None = None
+) -> List[Any]:
+    """Returns every distinct value of key, read with distinct_batches"""
+    values = []
+    async for batch in distinct_batches(collection, key, filter, batch_size):
+        values += batch
+    return values
+
+
+@dataclass
+class MemoryUsage:
+    name: str
+    ceiling: int
+    peak: int = 0
+    measured: bool = False
+
+
+@contextmanager
+def memory_ceiling(name: str, ceiling: int | None = None) -> Iterator[MemoryUsage]:
+    """Measures the peak memory allocated while the block runs
+
+    Memory is only measured when a ceiling is set and no other block is measured,
+    tracemalloc is started if needed. The peak is that of the whole process while the
+    block runs and is recorded in metrics.TASK_PEAK_BYTES. Exceeding the ceiling is
+    reported, it does not stop the block.
+
+    Args:
+        name (str): Name of the task to report
+        ceiling (int | None, optional): Bytes. Defaults to TASK_MEMORY_CEILING
+
+    Yields:
+        MemoryUsage: peak is set once the block exits, if measured
+    """
+    global measured_task
+    ceiling = TASK_MEMORY_CEILING if ceiling is None else ceiling
+    usage = MemoryUsage(name=name, ceiling=ceiling)
+    if not ceiling or measured_task is not None:
+        yield usage
+        return
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    measured_task = name
+    usage.measured = True
+    tracemalloc.reset_peak()
+    start, _ = tracemalloc.get_traced_memory()
+    try:
+        yield usage
+    finally:
+        measured_task = None
+        _, peak = tracemalloc.get_traced_memory()
+        usage.peak = peak - start
+        metrics.TASK_PEAK_BYTES.set(usage.peak, task=name)
+        if usage.peak > ceiling:
+            metrics.TASK_MEMORY_CEILING_EXCEEDED.inc(task=name)
+            print(
+                f"Memory ceiling exceeded: {name} allocated {usage.peak} bytes, "
+                f"ceiling is {ceiling} bytes"
+            )
@@ -0,0 +1,195 @@
+"""In-process index of the subscriptions collection
+
+Every poll used to ask MongoDB which feeds and subreddits are subscribed to and which
+channels subscribe to a feed with new entries, a round trip per feed. The index
+holds feed_url -> channel_ids, subreddit -> channel_ids and channel_id -> (field,
+value) in memory so those lookups are dict reads.
+
+It is loaded when the bot or a headless poller starts. The cogs update it as they
+write, and a change stream on the subscriptions collection picks up the writes of
+other processes (the gateway's commands for a headless poller, channels removed by
+another shard). Change streams need a replica set. On a standalone mongod the index
+is reloaded every SUBSCRIPTIONS_RELOAD_SECONDS instead.
+
+Environment Variables:
+- SUBSCRIPTIONS_RELOAD_SECONDS
+    - How often the index is reloaded when change streams are not available.
+    Defaults to 60
+"""
+
+import os
+import asyncio
+from typing import Any, Dict, List, Set, Tuple
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure, PyMongoError
+
+from .streaming import stream_batches
+
+SUBSCRIPTIONS_RELOAD_SECONDS = float(os.getenv("SUBSCRIPTIONS_RELOAD_SECONDS", 60))
+# Wait before a change stream that failed is opened again
+WATCH_RETRY_SECONDS = 5.0
+# Error code of $changeStream on a standalone mongod
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
+# The field that makes a subscription an rss or a subreddit subscription
+FIELDS = ("feed_url", "subreddit")
+LOAD_PROJECTION = {"_id": 1, "channel_id": 1, "feed_url": 1, "subreddit": 1}
+# Read through the channel_id index, see indexes.PRODUCTION_QUERIES
+LOAD_SORT = [("channel_id", ASCENDING)]
+
+Key = Tuple[str, str, int]
+
+
+class SubscriptionIndex:
+    """Subscriptions by feed_url, subreddit and channel_id, see the module docstring
+
+    Lookups return copies, so a caller may await while iterating over them.
+    """
+
+    def __init__(self):
+        self.channels: Dict[str, Dict[str, Set[int]]] = {field: {} for field in FIELDS}
+        self.by_channel: Dict[int, Set[Tuple[str, str]]] = {}
+        # Change stream deletes only carry the _id of the document
+        self.ids: Dict[Any, Key] = {}
+        self.keys: Dict[Key, Any] = {}
+        self.task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def feed_urls(self) -> List[str]:
+        return list(self.channels["feed_url"])
+
+    def subreddits(self) -> List[str]:
+        return list(self.channels["subreddit"])
+
+    def channel_ids(self) -> List[int]:
+        return list(self.by_channel)
+
+    def feed_channels(self, feed_url: str) -> List[int]:
+        return list(self.channels["feed_url"].get(feed_url, ()))
+
+    def subreddit_channels(self, subreddit: str) -> List[int]:
+        return list(self.channels["subreddit"].get(subreddit, ()))
+
+    @staticmethod
+    def key_of(doc: dict) -> Key | None:
+        """(field, value, channel_id) of a subscription document"""
+        for field in FIELDS:
+            if field in doc:
+                return field, doc[field], doc.get("channel_id")
+        return None
+
+    def add(self, channel_id: int, field: str, value: str, _id: Any = None) -> None:
+        """Adds a subscription of channel_id to the feed_url or subreddit value
+
+        Args:
+            channel_id (int): The subscribing channel
+            field (str): "feed_url" or "subreddit"
+            value (str): The feed url or subreddit
+            _id (Any, optional): The document's _id, when known. Defaults to None, the
+                change stream fills it in.
+        """
+        key = (field, value, channel_id)
+        self.channels[field].setdefault(value, set()).add(channel_id)
+        self.by_channel.setdefault(channel_id, set()).add((field, value))
+        if _id is not None:
+            self.ids[_id] = key
+            self.keys[key] = _id
+        else:
+            self.keys.setdefault(key, None)
+
+    def remove(self, channel_id: int, field: str, value: str) -> None:
+        """Removes a subscription, if there is one"""
+        key = (field, value, channel_id)
+        _id = self.keys.pop(key, None)
+        self.ids.pop(_id, None)
+        channels = self.channels[field].get(value)
+        if channels is not None:
+            channels.discard(channel_id)
+            if not channels:
+                del self.channels[field][value]
+        subscriptions = self.by_channel.get(channel_id)
+        if subscriptions is not None:
+            subscriptions.discard((field, value))
+            if not subscriptions:
+                del self.by_channel[channel_id]
+
+    def remove_channel(self, channel_id: int, field: str | None = None) -> None:
+        """Removes every subscription of channel_id, or only those of field"""
+        for subscription_field, value in list(self.by_channel.get(channel_id, ())):
+            if field is None or subscription_field == field:
+                self.remove(channel_id, subscription_field, value)
+
+    def add_document(self, doc: dict) -> None:
+        if key := self.key_of(doc):
+            field, value, channel_id = key
+            self.add(channel_id, field, value, doc.get("_id"))
+
+    def remove_document(self, _id: Any) -> None:
+        if (key := self.ids.get(_id)) is not None:
+            field, value, channel_id = key
+            self.remove(channel_id, field, value)
+
+    def apply(self, change: dict) -> None:
+        """Applies a change stream event of the subscriptions collection"""
+        operation = change.get("operationType")
+        if operation not in ("insert", "update", "replace", "delete"):
+            return
+        self.remove_document(change["documentKey"]["_id"])
+        if operation != "delete" and (doc := change.get("fullDocument")):
+            self.add_document(doc)
+
+    async def load(self, collection) -> None:
+        """Replaces the index with the documents of the subscriptions collection"""
+        index = SubscriptionIndex()
+        cursor = collection.find({}, projection=LOAD_PROJECTION, sort=LOAD_SORT)
+        async for documents in stream_batches(cursor):
+            for doc in documents:
+                index.add_document(doc)
+        self.channels, self.by_channel = index.channels, index.by_channel
+        self.ids, self.keys = index.ids, index.keys
+
+    async def start(self, collection) -> None:
+        """Loads the index then keeps it current in the background"""
+        await self.load(collection)
+        if self.task is None:
+            self.task = asyncio.create_task(self.watch(collection))
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def watch(self, collection) -> None:
+        """Applies the changes of the subscriptions collection until cancelled
+
+        The index is reloaded every time the change stream is opened, so changes
+        made while it was closed are not missed.
+        """
+        while True:
+            try:
+                async with collection.watch(full_document="updateLookup") as stream:
+                    await self.load(collection)
+                    async for change in stream:
+                        self.apply(change)
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                    print(
+                        "Change streams are not available, subscriptions are "
+                        f"reloaded every {SUBSCRIPTIONS_RELOAD_SECONDS}s"
+                    )
+                    return await self.reload(collection)
+                print(f"Subscriptions change stream failed: {e}")
+            except PyMongoError as e:
+                print(f"Subscriptions change stream failed: {e}")
+            await asyncio.sleep(WATCH_RETRY_SECONDS)
+
+    async def reload(self, collection) -> None:
+        """Reloads the index every SUBSCRIPTIONS_RELOAD_SECONDS until cancelled"""
+        while True:
+            await asyncio.sleep(SUBSCRIPTIONS_RELOAD_SECONDS)
+            try:
+                await self.load(collection)
+            except PyMongoError as e:
+                print(f"Reloading subscriptions failed: {e}")
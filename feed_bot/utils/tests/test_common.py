@@ -1,7 +1,15 @@
+from unittest.mock import AsyncMock
 import pytest
 from aiohttp import web
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
-from ..common import CommonUtilities
+from ..common import (
+    CommonUtilities,
+    dedup_key,
+    insert_many_ignore_duplicates,
+    update_many_ignore_duplicates,
+)
 
 
 class TestCommonUtilities:
@@ -38,3 +46,58 @@ class TestCommonUtilities:
         assert c.error == False
         assert c.error_msg == ""
         assert c.res_dicts == []
+
+
+def test_dedup_key():
+    assert dedup_key("https://example.com/feed/", "guid") == dedup_key(
+        "https://example.com/feed/", "guid"
+    )
+    assert dedup_key("a", "bc") != dedup_key("ab", "c")
+    assert len(dedup_key(1, None)) == 40
+
+
+class TestInsertManyIgnoreDuplicates:
+    """Test insert_many_ignore_duplicates and update_many_ignore_duplicates"""
+
+    documents = [{"entry_key": "a"}, {"entry_key": "b"}, {"entry_key": "c"}]
+
+    @pytest.mark.asyncio
+    async def test_all_inserted(self):
+        collection = AsyncMock()
+        inserted = await insert_many_ignore_duplicates(collection, self.documents)
+        assert inserted == self.documents
+        collection.insert_many.assert_awaited_once_with(self.documents, ordered=False)
+
+    @pytest.mark.asyncio
+    async def test_nothing_to_insert(self):
+        collection = AsyncMock()
+        assert await insert_many_ignore_duplicates(collection, []) == []
+        collection.insert_many.assert_not_awaited()
+
+    @pytest.mark.asyncio
+    async def test_duplicates_skipped(self):
+        collection = AsyncMock()
+        collection.insert_many.side_effect = BulkWriteError(
+            {"writeErrors": [{"index": 0, "code": 11000}, {"index": 2, "code": 11000}]}
+        )
+        inserted = await insert_many_ignore_duplicates(collection, self.documents)
+        assert inserted == [{"entry_key": "b"}]
+
+    @pytest.mark.asyncio
+    async def test_other_errors_raised(self):
+        collection = AsyncMock()
+        collection.insert_many.side_effect = BulkWriteError(
+            {"writeErrors": [{"index": 0, "code": 11000}, {"index": 1, "code": 121}]}
+        )
+        with pytest.raises(BulkWriteError):
+            await insert_many_ignore_duplicates(collection, self.documents)
+
+    @pytest.mark.asyncio
+    async def test_update_duplicates_skipped(self):
+        collection = AsyncMock()
+        collection.bulk_write.side_effect = BulkWriteError(
+            {"writeErrors": [{"index": 0, "code": 11000}], "nModified": 1}
+        )
+        requests = [UpdateOne({"_id": i}, {"$set": {"k": i}}) for i in range(2)]
+        assert await update_many_ignore_duplicates(collection, requests) == 1
+        assert await update_many_ignore_duplicates(collection, []) == 0
@@ -0,0 +1,157 @@
+import asyncio
+import discord
+import pytest
+from unittest.mock import Mock
+
+from .. import delivery as delivery_module
+from ..delivery import DeliveryQueue, is_transient, pack_embeds
+
+
+def http_exception(status: int) -> discord.HTTPException:
+    return discord.HTTPException(Mock(status=status, reason="", headers={}), "")
+
+
+class TestDeliveryQueue:
+    """Test DeliveryQueue Class (utility class)"""
+
+    @pytest.mark.asyncio
+    async def test_per_channel_fifo(self):
+        sent = []
+        in_flight = {}
+
+        async def send(channel_id, content):
+            in_flight[channel_id] = in_flight.get(channel_id, 0) + 1
+            assert in_flight[channel_id] == 1
+            await asyncio.sleep(0.001)
+            sent.append((channel_id, content))
+            in_flight[channel_id] -= 1
+
+        queue = DeliveryQueue(send=send, workers=4, rate=0)
+        queue.start()
+        for i in range(5):
+            for channel_id in (1, 2, 3):
+                await queue.enqueue(channel_id, content=i)
+        assert queue.stats()["pending"] == 15
+        await queue.join()
+        queue.stop()
+        for channel_id in (1, 2, 3):
+            assert [c for ch, c in sent if ch == channel_id] == list(range(5))
+        assert queue.stats() == {
+            "pending": 0,
+            "channels": 0,
+            "in_flight": 0,
+            "sent": 15,
+            "retried": 0,
+            "failed": 0,
+        }
+
+    @pytest.mark.asyncio
+    async def test_slow_channel_does_not_block_others(self):
+        sent = []
+
+        async def send(channel_id):
+            if channel_id == "slow":
+                await asyncio.sleep(0.2)
+            sent.append(channel_id)
+
+        queue = DeliveryQueue(send=send, workers=2, rate=0)
+        queue.start()
+        slow = await queue.enqueue("slow")
+        fast = [await queue.enqueue(i) for i in range(10)]
+        await asyncio.wait_for(asyncio.gather(*fast), 0.1)
+        assert not slow.done()
+        await queue.join()
+        queue.stop()
+        assert sent[-1] == "slow"
+
+    @pytest.mark.asyncio
+    async def test_retries_transient_failures(self, monkeypatch):
+        monkeypatch.setattr(delivery_module, "RETRY_BASE_DELAY", 0.001)
+        errors = [http_exception(503), asyncio.TimeoutError()]
+
+        async def send(channel_id):
+            if errors:
+                raise errors.pop(0)
+
+        queue = DeliveryQueue(send=send, workers=1, rate=0)
+        queue.start()
+        future = await queue.enqueue(1)
+        assert await future is True
+        queue.stop()
+        assert queue.stats()["retried"] == 2
+
+    @pytest.mark.asyncio
+    async def test_drops_permanent_failures(self, monkeypatch):
+        monkeypatch.setattr(delivery_module, "RETRY_BASE_DELAY", 0.001)
+
+        async def send(channel_id):
+            raise http_exception(403 if channel_id == 1 else 500)
+
+        queue = DeliveryQueue(send=send, workers=1, max_retries=2, rate=0)
+        queue.start()
+        forbidden = await queue.enqueue(1)
+        server_error = await queue.enqueue(2)
+        assert await forbidden is False
+        assert await server_error is False
+        queue.stop()
+        assert queue.stats()["retried"] == 2
+        assert queue.stats()["failed"] == 2
+
+    @pytest.mark.asyncio
+    async def test_backpressure(self):
+        release = asyncio.Event()
+
+        async def send(channel_id):
+            await release.wait()
+
+        queue = DeliveryQueue(send=send, workers=1, max_pending=2, rate=0)
+        queue.start()
+        await queue.enqueue(1)
+        await queue.enqueue(2)
+        blocked = asyncio.create_task(queue.enqueue(3))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+        release.set()
+        await asyncio.wait_for(blocked, 0.1)
+        await queue.join()
+        queue.stop()
+
+    def test_is_transient(self):
+        assert is_transient(http_exception(429))
+        assert is_transient(http_exception(502))
+        assert not is_transient(http_exception(404))
+        assert not is_transient(ValueError())
+
+
+def embed(characters: int) -> discord.Embed:
+    return discord.Embed(title="t", description="d" * (characters - 1))
+
+
+class TestPackEmbeds:
+    """Test pack_embeds (utility function)"""
+
+    def test_count_limit(self):
+        embeds = [embed(10) for _ in range(23)]
+        batches = pack_embeds(embeds)
+        assert [len(batch) for batch in batches] == [10, 10, 3]
+        assert [e for batch in batches for e in batch] == embeds
+
+    def test_character_limit(self):
+        embeds = [embed(700) for _ in range(12)]
+        batches = pack_embeds(embeds)
+        assert [len(batch) for batch in batches] == [8, 4]
+        assert all(sum(len(e) for e in batch) <= 6000 for batch in batches)
+
+    def test_order_is_kept(self):
+        sizes = [3000, 100, 3000, 100, 5900, 100]
+        batches = pack_embeds([embed(size) for size in sizes])
+        assert [[len(e) for e in batch] for batch in batches] == [
+            [3000, 100],
+            [3000, 100],
+            [5900, 100],
+        ]
+
+    def test_too_large_embed_is_sent_alone(self):
+        batches = pack_embeds([embed(10), embed(7000), embed(10)])
+        assert [len(batch) for batch in batches] == [1, 1, 1]
+        assert pack_embeds([]) == []
@@ -0,0 +1,140 @@
+from datetime import datetime
+import feedparser
+import pytest
+
+from .. import metrics
+from ..feed_stream import (
+    EntryScanner,
+    FeedTooLarge,
+    last_seen_mark,
+    parse_date,
+    read_feed,
+)
+
+ITEM = """
+    <item>
+      <title>Post {day}</title>
+      <guid>https://example.com/{day}</guid>
+      <pubDate>{day:02d} Jan 2024 00:00:00 GMT</pubDate>
+    </item>"""
+
+ATOM_ENTRY = """
+  <entry>
+    <title>Post {day}</title>
+    <id>https://example.com/{day}</id>
+    <updated>2024-01-{day:02d}T00:00:00Z</updated>
+  </entry>"""
+
+
+def rss_document(days):
+    items = "".join(ITEM.format(day=day) for day in days)
+    return (
+        '<?xml version="1.0"?>\n<rss version="2.0"><channel><title>Feed</title>'
+        f"{items}\n  </channel>\n</rss>\n"
+    ).encode()
+
+
+def atom_document(days):
+    entries = "".join(ATOM_ENTRY.format(day=day) for day in days)
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        f'<feed xmlns="http://www.w3.org/2005/Atom"><title>Feed</title>{entries}</feed>'
+    ).encode()
+
+
+class Content:
+    """Stands in for aiohttp's StreamReader, read counts the bytes handed out"""
+
+    def __init__(self, body: bytes, chunk_size: int):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.read = 0
+
+    def iter_chunked(self, n):
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.read >= len(self.body):
+            raise StopAsyncIteration
+        chunk = self.body[self.read : self.read + self.chunk_size]
+        self.read += len(chunk)
+        return chunk
+
+
+class Response:
+    def __init__(self, body: bytes, chunk_size: int = 64):
+        self.content = Content(body, chunk_size)
+
+
+def titles(document: bytes):
+    feed_data = feedparser.parse(document)
+    assert feed_data.bozo == 0
+    return [entry.title for entry in feed_data.entries]
+
+
+class TestFeedStream:
+    """Test feed_stream functions (utility functions)"""
+
+    def test_parse_date(self):
+        assert parse_date("Mon, 01 Jan 2024 01:00:00 +0100") == datetime(2024, 1, 1)
+        assert parse_date("2024-01-01T01:00:00+01:00") == datetime(2024, 1, 1)
+        assert parse_date("yesterday") is None
+        assert parse_date("") is None
+
+    def test_last_seen_mark(self):
+        entries = feedparser.parse(rss_document([3, 2, 1])).entries
+        assert last_seen_mark(entries) == datetime(2024, 1, 3)
+        assert last_seen_mark(entries[::-1]) is None
+        assert last_seen_mark([]) is None
+
+    @pytest.mark.asyncio
+    async def test_read_feed_stops_at_last_seen(self):
+        body = rss_document(range(20, 0, -1))
+        response = Response(body)
+        document = await read_feed(response, since=datetime(2024, 1, 17))
+        assert titles(document) == ["Post 20", "Post 19", "Post 18", "Post 17"]
+        assert response.content.read < len(body)
+
+    @pytest.mark.asyncio
+    async def test_read_feed_records_bytes_received(self, monkeypatch):
+        monkeypatch.setattr(metrics.REGISTRY, "enabled", True)
+        monkeypatch.setattr(metrics.FEED_FETCH_BYTES, "values", {})
+        body = rss_document(range(20, 0, -1))
+        response = Response(body)
+        document = await read_feed(response, since=datetime(2024, 1, 17))
+        [_, total, count] = metrics.FEED_FETCH_BYTES.values[()]
+        assert count == 1
+        assert total == response.content.read != len(document)
+
+    @pytest.mark.asyncio
+    async def test_read_feed_max_entries(self):
+        document = await read_feed(
+            Response(atom_document(range(9, 0, -1))), max_entries=2
+        )
+        assert titles(document) == ["Post 9", "Post 8"]
+
+    @pytest.mark.asyncio
+    async def test_read_feed_unordered(self):
+        # oldest first, every entry may be new
+        body = rss_document(range(1, 6))
+        assert await read_feed(Response(body), max_entries=2) == body
+
+    @pytest.mark.asyncio
+    async def test_read_feed_max_bytes(self):
+        body = rss_document(range(30, 0, -1))
+        with pytest.raises(FeedTooLarge):
+            await read_feed(Response(body), max_entries=0, max_bytes=len(body) - 1)
+        # the entries that may be new fit
+        document = await read_feed(
+            Response(body), since=datetime(2024, 1, 29), max_bytes=len(body) // 2
+        )
+        assert titles(document) == ["Post 30", "Post 29"]
+
+    def test_scanner_not_xml(self):
+        scanner = EntryScanner(max_entries=1)
+        assert scanner.feed(b"<html><p>Not a feed<item></html>") is False
+        assert scanner.failed is True
+        assert scanner.document() == b"<html><p>Not a feed<item></html>"
@@ -0,0 +1,44 @@
+import os
+import uuid
+import pytest
+from motor import motor_asyncio
+
+from ..indexes import ensure_indexes, find_collscans, verify_query_plans
+
+MONGODB_URI = os.getenv("MONGODB_URI")
+
+
+def test_find_collscans():
+    ixscan = {
+        "queryPlanner": {
+            "winningPlan": {
+                "stage": "FETCH",
+                "inputStage": {"stage": "IXSCAN", "indexName": "entry_key"},
+            },
+            "rejectedPlans": [{"stage": "COLLSCAN"}],
+        }
+    }
+    assert find_collscans(ixscan) == []
+
+    winning_plan = {"stage": "PROJECTION", "inputStage": {"stage": "COLLSCAN"}}
+    aggregate_collscan = {
+        "stages": [
+            {"$cursor": {"queryPlanner": {"winningPlan": {"queryPlan": winning_plan}}}},
+            {"$group": {"_id": "$channel_id"}},
+        ]
+    }
+    assert find_collscans(aggregate_collscan) == ["COLLSCAN"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not MONGODB_URI, reason="MONGODB_URI is not set")
+async def test_production_queries_use_indexes():
+    client = motor_asyncio.AsyncIOMotorClient(MONGODB_URI)
+    db = client[f"feed_bot_test_{uuid.uuid4().hex}"]
+    try:
+        await ensure_indexes(db)
+        await ensure_indexes(db)  # idempotent
+        assert await verify_query_plans(db) == {}
+    finally:
+        await client.drop_database(db.name)
+        client.close()
@@ -0,0 +1,96 @@
+import os
+import uuid
+import asyncio
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock
+import pytest
+from motor import motor_asyncio
+from pymongo.errors import DuplicateKeyError
+
+from ..leases import LeaseManager, partition
+
+MONGODB_URI = os.getenv("MONGODB_URI")
+
+
+def collection(workers, leases):
+    collection = MagicMock(
+        update_one=AsyncMock(),
+        update_many=AsyncMock(),
+        find_one_and_update=AsyncMock(),
+        count_documents=AsyncMock(return_value=workers),
+    )
+    collection.find.return_value = MagicMock(to_list=AsyncMock(return_value=leases))
+    return collection
+
+
+def lease(number, owner, seconds=60):
+    return {
+        "_id": LeaseManager.partition_id(number),
+        "owner": owner,
+        "expires_at": datetime.now() + timedelta(seconds=seconds),
+    }
+
+
+class TestLeaseManager:
+    """Test LeaseManager Class (utility class)"""
+
+    def test_partition(self):
+        assert partition("https://example.com/feed", 64) == partition(
+            "https://example.com/feed", 64
+        )
+        assert {partition(str(i), 8) for i in range(100)} == set(range(8))
+
+    @pytest.mark.asyncio
+    async def test_heartbeat_acquires_share(self):
+        # partitions 0-3 are held by a live process, 4 by a dead one
+        leases = [lease(n, "other") for n in range(4)] + [lease(4, "dead", -1)]
+        manager = LeaseManager(
+            collection(workers=2, leases=leases), owner="me", partitions=8
+        )
+        assert manager.owns("anything") is False
+        assert await manager.heartbeat() == {4, 5, 6, 7}
+        assert manager.collection.find_one_and_update.await_count == 4
+        keys = [str(i) for i in range(100)]
+        assert {partition(key, 8) for key in keys if manager.owns(key)} == {4, 5, 6, 7}
+
+    @pytest.mark.asyncio
+    async def test_heartbeat_releases_surplus(self):
+        leases = [lease(n, "me") for n in range(8)]
+        manager = LeaseManager(
+            collection(workers=3, leases=leases), owner="me", partitions=8
+        )
+        assert await manager.heartbeat() == {0, 1, 2}
+        release_filter, _ = manager.collection.update_many.call_args.args
+        assert release_filter["_id"]["$in"] == [
+            LeaseManager.partition_id(n) for n in range(3, 8)
+        ]
+
+    @pytest.mark.asyncio
+    async def test_try_acquire_held_elsewhere(self):
+        manager = LeaseManager(collection(workers=1, leases=[]), owner="me")
+        manager.collection.find_one_and_update.side_effect = DuplicateKeyError("dup")
+        assert await manager.acquire_job("retention", seconds=60) is False
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not MONGODB_URI, reason="MONGODB_URI is not set")
+async def test_leases_split_and_take_over():
+    client = motor_asyncio.AsyncIOMotorClient(MONGODB_URI)
+    db = client[f"feed_bot_test_{uuid.uuid4().hex}"]
+    try:
+        a = LeaseManager(db["leases"], owner="a", partitions=16, lease_seconds=1)
+        b = LeaseManager(db["leases"], owner="b", partitions=16, lease_seconds=1)
+        assert len(await a.heartbeat()) == 16
+        await b.heartbeat()  # a still holds every partition
+        await a.heartbeat()  # a gives up its surplus
+        await b.heartbeat()
+        assert len(a.owned) == len(b.owned) == 8
+        assert not a.owned & b.owned
+        assert await a.acquire_job("retention", 60) is True
+        assert await b.acquire_job("retention", 60) is False
+
+        await asyncio.sleep(1.1)  # a dies
+        assert len(await b.heartbeat()) == 16
+    finally:
+        await client.drop_database(db.name)
+        client.close()
@@ -0,0 +1,92 @@
+from unittest.mock import MagicMock
+import pytest
+
+from .. import metrics
+from ..metrics import Counter, Gauge, Histogram, Registry
+
+
+class TestMetrics:
+    """Test metrics classes (utility functions)"""
+
+    def test_disabled(self):
+        registry = Registry(enabled=False)
+        counter = Counter("c_total", "A counter", registry=registry)
+        histogram = Histogram("h_seconds", "A histogram", registry=registry)
+        counter.inc()
+        histogram.observe(1.0)
+        with histogram.time():
+            pass
+        assert counter.values == {}
+        assert histogram.values == {}
+
+    def test_render(self):
+        registry = Registry(enabled=True)
+        counter = Counter("c_total", "A counter", labels=("kind",), registry=registry)
+        gauge = Gauge("g", "A gauge", registry=registry)
+        histogram = Histogram(
+            "h_seconds", "A histogram", buckets=(1, 0.1), registry=registry
+        )
+        counter.inc(2, kind='a"b')
+        counter.inc(kind='a"b')
+        gauge.set(4)
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        assert registry.render() == (
+            "# HELP c_total A counter\n"
+            "# TYPE c_total counter\n"
+            'c_total{kind="a\\"b"} 3\n'
+            "# HELP g A gauge\n"
+            "# TYPE g gauge\n"
+            "g 4\n"
+            "# HELP h_seconds A histogram\n"
+            "# TYPE h_seconds histogram\n"
+            'h_seconds_bucket{le="0.1"} 1\n'
+            'h_seconds_bucket{le="1"} 2\n'
+            'h_seconds_bucket{le="+Inf"} 3\n'
+            "h_seconds_sum 5.55\n"
+            "h_seconds_count 3\n"
+        )
+
+    def test_time(self):
+        registry = Registry(enabled=True)
+        histogram = Histogram(
+            "h_seconds", "A histogram", labels=("task",), registry=registry
+        )
+        with pytest.raises(ValueError):
+            with histogram.time(task="poll"):
+                raise ValueError
+        assert histogram.values[("poll",)][2] == 1
+
+    def test_mongo_command_listener(self, monkeypatch):
+        monkeypatch.setattr(metrics.REGISTRY, "enabled", True)
+        monkeypatch.setattr(metrics.MONGO_SECONDS, "values", {})
+        listener = metrics.MongoCommandListener()
+        listener.started(
+            MagicMock(
+                request_id=1,
+                command_name="find",
+                command={"find": "feed_entries", "filter": {}},
+            )
+        )
+        listener.succeeded(
+            MagicMock(request_id=1, command_name="find", duration_micros=2000)
+        )
+        values = metrics.MONGO_SECONDS.values[("feed_entries.find", "ok")]
+        assert values[1:] == [0.002, 1]
+        assert listener.sites == {}
+
+    def test_mongo_event_listeners(self, monkeypatch):
+        monkeypatch.setattr(metrics.REGISTRY, "enabled", False)
+        assert metrics.mongo_event_listeners() == []
+
+    @pytest.mark.asyncio
+    async def test_metrics_app(self, aiohttp_client, monkeypatch):
+        monkeypatch.setattr(metrics.REGISTRY, "enabled", True)
+        monkeypatch.setattr(metrics.RATE_LIMITED, "values", {})
+        metrics.RATE_LIMITED.inc()
+        client = await aiohttp_client(metrics.metrics_app())
+        response = await client.get("/metrics")
+        assert response.status == 200
+        assert response.headers["Content-Type"] == metrics.CONTENT_TYPE
+        assert "feed_bot_discord_rate_limited_total 1\n" in await response.text()
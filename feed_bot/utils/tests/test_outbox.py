@@ -0,0 +1,81 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+import pytest
+
+from ..outbox import Outbox, instance_id
+
+
+def cursor(documents):
+    return MagicMock(to_list=AsyncMock(return_value=documents))
+
+
+class TestOutbox:
+    """Test Outbox Class (utility class)"""
+
+    def test_instance_id(self):
+        assert instance_id() != instance_id()
+
+    @pytest.mark.asyncio
+    async def test_claim(self):
+        collection = MagicMock(update_many=AsyncMock())
+        collection.find.side_effect = [
+            cursor([{"_id": 1}, {"_id": 2}]),
+            cursor([{"_id": 2, "sent": False}]),  # another worker claimed 1 first
+        ]
+        outbox = Outbox(collection, owner="bot-a", batch_size=2, lease_seconds=60)
+        assert await outbox.claim() == [{"_id": 2, "sent": False}]
+
+        query = collection.find.call_args_list[0]
+        assert query.args[0]["sent"] is False
+        assert {"lease_until": None} in query.args[0]["$or"]
+        assert query.kwargs["limit"] == 2
+
+        claim_filter, claim_update = collection.update_many.call_args.args
+        assert claim_filter["_id"] == {"$in": [1, 2]}
+        assert claim_filter["$or"] == query.args[0]["$or"]
+        lease = claim_update["$set"]
+        assert lease["lease_owner"] == "bot-a"
+        assert (
+            lease["lease_until"] - query.args[0]["$or"][1]["lease_until"]["$lt"]
+        ).seconds == 60
+
+        claimed = collection.find.call_args_list[1].args[0]
+        assert claimed == {"_id": {"$in": [1, 2]}, "claim_id": lease["claim_id"]}
+
+    @pytest.mark.asyncio
+    async def test_claim_nothing_to_send(self):
+        collection = MagicMock(update_many=AsyncMock())
+        collection.find.return_value = cursor([])
+        assert await Outbox(collection, owner="bot-a").claim() == []
+        collection.update_many.assert_not_awaited()
+
+    @pytest.mark.asyncio
+    async def test_ack(self):
+        collection = MagicMock(update_many=AsyncMock())
+        outbox = Outbox(collection, owner="bot-a")
+        await outbox.ack([])
+        collection.update_many.assert_not_awaited()
+        await outbox.ack([1, 2], dropped=True)
+        ack_filter, ack_update = collection.update_many.call_args.args
+        assert ack_filter == {"_id": {"$in": [1, 2]}}
+        assert ack_update["$set"]["sent"] is True
+        assert ack_update["$set"]["dropped"] is True
+        assert "sent_at" in ack_update["$set"]
+        assert "lease_until" in ack_update["$unset"]
+
+    @pytest.mark.asyncio
+    async def test_renewing(self):
+        collection = MagicMock(update_many=AsyncMock())
+        outbox = Outbox(collection, owner="bot-a", lease_seconds=0.03)
+        async with outbox.renewing([1, 2]):
+            await asyncio.sleep(0.035)
+        renew_filter, renew_update = collection.update_many.call_args.args
+        assert renew_filter == {
+            "_id": {"$in": [1, 2]},
+            "lease_owner": "bot-a",
+            "sent": False,
+        }
+        assert "lease_until" in renew_update["$set"]
+        renewals = collection.update_many.await_count
+        await asyncio.sleep(0.02)
+        assert collection.update_many.await_count == renewals
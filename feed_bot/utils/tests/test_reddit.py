@@ -4,7 +4,9 @@ import asyncpraw
 from asyncpraw.exceptions import RedditAPIException, RedditErrorItem
 from aiohttp import web
 
-from ..reddit import Reddit
+from asyncprawcore.exceptions import Forbidden, RequestException, ServerError
+
+from ..reddit import Reddit, multireddit_queries
 
 
 class TestReddit:
@@ -27,4 +29,232 @@ class TestReddit:
         expected_subreddits_query = "+".join(self.subreddit_names)
         assert r.subreddits_query == expected_subreddits_query
         assert r.session == expected_session
+        asyncpraw_reddit.assert_not_called()  # documents_to_embeds needs no client
+        assert r.reddit is r.reddit
         asyncpraw_reddit.assert_called_once()
+        assert r.owns_client is True
+        asyncpraw_reddit.return_value.close = AsyncMock()
+        await r.close()
+        asyncpraw_reddit.return_value.close.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    async def test_shared_client(self, mocker):
+        asyncpraw_reddit = mocker.patch.object(asyncpraw, "Reddit")
+        client = AsyncMock()
+        r = Reddit(reddit=client)
+        assert r.reddit is client
+        await r.close()
+        client.close.assert_not_awaited()
+        asyncpraw_reddit.assert_not_called()
+
+    def test_multireddit_queries(self):
+        names = ["linux", "ROS", "cyberDeck", "linux"]
+        assert multireddit_queries(names) == ["ROS+cyberDeck+linux"]
+        queries = multireddit_queries([f"sub{i:03}" for i in range(100)], 30)
+        assert all(len(query) <= 30 for query in queries)
+        assert len(queries) == 25
+        assert sum(len(query.split("+")) for query in queries) == 100
+
+    @staticmethod
+    def submission(subreddit: str, fullname: str, created_utc: float) -> MagicMock:
+        return MagicMock(
+            subreddit_name_prefixed=subreddit,
+            fullname=fullname,
+            created_utc=created_utc,
+            permalink=f"/{subreddit}/comments/{fullname}",
+        )
+
+    @pytest.mark.asyncio
+    async def test_get_multireddit_submissions(self, mocker, monkeypatch):
+        mocker.patch.object(asyncpraw, "Reddit")
+        monkeypatch.setattr("feed_bot.utils.reddit.REDDIT_MULTI_MAX_LENGTH", 15)
+        posts = {
+            "linux": self.submission("r/linux", "t3_l1", 100.0),
+            "cyberdeck": self.submission("r/cyberDeck", "t3_c1", 100.0),
+        }
+        queries = []
+
+        async def subreddit(query):
+            queries.append(query)
+            if query == "ros":
+                raise RequestException(Exception(), (), {})
+
+            async def new(**kwargs):
+                for name in query.split("+"):
+                    yield posts[name]
+
+            return MagicMock(new=new)
+
+        r = Reddit()
+        r.reddit.subreddit = AsyncMock(side_effect=subreddit)
+        await r.get_multireddit_submissions(
+            subscriptions={
+                "linux": [1, 2],
+                "r/cyberDeck": [2],
+                "ros": [3],
+                "Linux": [2],
+            }
+        )
+        assert queries == ["cyberdeck+linux", "ros"]
+        assert sorted((d["channel_id"], d["subreddit"]) for d in r.res_dicts) == [
+            (1, "r/linux"),
+            (2, "r/cyberDeck"),
+            (2, "r/linux"),
+        ]
+        assert all(d["sent"] is False and d["listing_key"] for d in r.res_dicts)
+        assert list(r.channel_errors) == [3]
+        assert r.error is True
+
+    @pytest.mark.asyncio
+    async def test_unreadable_subreddit_is_isolated(self, mocker):
+        mocker.patch.object(asyncpraw, "Reddit")
+        names = ["a", "b", "c", "d", "e", "f", "g", "h"]
+        posts = {
+            name: self.submission(f"r/{name}", f"t3_{name}", 100.0) for name in names
+        }
+        queries = []
+        failing = {"c": Forbidden(MagicMock(status=403))}
+
+        async def subreddit(query):
+            queries.append(query)
+
+            async def new(**kwargs):
+                for name in query.split("+"):
+                    if name in failing:
+                        raise failing[name]
+                for name in query.split("+"):
+                    yield posts[name]
+
+            return MagicMock(new=new)
+
+        r = Reddit()
+        r.reddit.subreddit = AsyncMock(side_effect=subreddit)
+        subscriptions = {name: [number] for number, name in enumerate(names)}
+        await r.get_multireddit_submissions(subscriptions=subscriptions)
+        # the query is halved until the private subreddit is on its own
+        assert queries == [
+            "a+b+c+d+e+f+g+h",
+            "a+b+c+d",
+            "a+b",
+            "c+d",
+            "c",
+            "d",
+            "e+f+g+h",
+        ]
+        assert sorted(d["channel_id"] for d in r.res_dicts) == [0, 1, 3, 4, 5, 6, 7]
+        assert list(r.channel_errors) == [2]
+        assert "private, banned or quarantined" in r.channel_errors[2]
+
+        # an error that is not the subreddit's fails the query without splitting it
+        queries.clear()
+        failing["c"] = ServerError(MagicMock(status=500))
+        await r.get_multireddit_submissions(subscriptions=subscriptions)
+        assert queries == ["a+b+c+d+e+f+g+h"]
+        assert r.res_dicts == [] and len(r.channel_errors) == 8
+
+    def listing(self, listing: list, requests: list, served: list | None = None):
+        """new() of a multireddit like reddit pages it: 100 a page, newest first
+
+        before= returns the page just newer than its anchor, not the newest posts.
+        Submissions handed out are appended to served.
+        """
+        served = [] if served is None else served
+
+        async def new(limit=None, params=None):
+            params = params or {}
+            requests.append(params)
+            if "before" in params:
+                fullnames = [submission.fullname for submission in listing]
+                anchor = fullnames.index(params["before"])
+                for submission in listing[max(0, anchor - 100) : anchor]:
+                    served.append(submission)
+                    yield submission
+                return
+            for submission in listing[:limit]:
+                served.append(submission)
+                yield submission
+
+        return MagicMock(new=new)
+
+    @pytest.mark.asyncio
+    async def test_fetch_new_submissions_cursors(self, mocker):
+        mocker.patch.object(asyncpraw, "Reddit")
+        listing = [  # newest first
+            self.submission("r/linux", "t3_l3", 300.0),
+            self.submission("r/ROS", "t3_r2", 250.0),
+            self.submission("r/linux", "t3_l2", 200.0),
+            self.submission("r/ROS", "t3_r1", 150.0),
+            self.submission("r/linux", "t3_l1", 100.0),
+        ]
+        requests = []
+        r = Reddit()
+        r.reddit.subreddit = AsyncMock(return_value=self.listing(listing, requests))
+
+        # first poll reads a full page and stores the newest submissions as cursors
+        submissions, error_msg = await r.fetch_new_submissions("linux+ros")
+        assert error_msg == "" and len(submissions) == 5
+        assert r.res_cursors["linux"]["fullname"] == "t3_l3"
+        assert r.res_cursors["ros"]["fullname"] == "t3_r2"
+        cursors, r.res_cursors = r.res_cursors, {}
+
+        # nothing new: reading stops at the cursors
+        submissions, _ = await r.fetch_new_submissions("linux+ros", cursors)
+        assert submissions == []
+        assert requests[-1] == {}
+
+        listing.insert(0, self.submission("r/ROS", "t3_r3", 400.0))
+        submissions, _ = await r.fetch_new_submissions("linux+ros", cursors)
+        assert [s["link"] for s in submissions] == ["/r/ROS/comments/t3_r3"]
+        assert r.res_cursors["ros"]["fullname"] == "t3_r3"
+        assert r.res_cursors["linux"] == cursors["linux"]
+
+    @pytest.mark.asyncio
+    async def test_busy_subreddit_does_not_hide_a_quiet_one(self, mocker):
+        mocker.patch.object(asyncpraw, "Reddit")
+        quiet_cursor = self.submission("r/quiet", "t3_q1", 100.0)
+        quiet_new = self.submission("r/quiet", "t3_q2", 150.0)
+        busy = [self.submission("r/busy", f"t3_b{n}", 1000.0 - n) for n in range(250)]
+        # a page and a half of busy posts above the quiet subreddit's new post
+        listing = busy[:150] + [quiet_new] + busy[150:] + [quiet_cursor]
+        cursors = {
+            "busy": {"fullname": "t3_b200", "created_utc": 800.0},
+            "quiet": {"fullname": "t3_q1", "created_utc": 100.0},
+        }
+        requests = []
+        r = Reddit()
+        r.reddit.subreddit = AsyncMock(return_value=self.listing(listing, requests))
+
+        submissions, _ = await r.fetch_new_submissions("busy+quiet", cursors)
+        links = [s["link"] for s in submissions]
+        assert "/r/quiet/comments/t3_q2" in links
+        assert len(links) == 200 + 1
+        assert r.res_cursors["busy"]["fullname"] == "t3_b0"
+        assert r.res_cursors["quiet"]["fullname"] == "t3_q2"
+        assert all("before" not in params for params in requests)
+
+        # the next poll starts from the top again and finds nothing new
+        cursors, r.res_cursors = r.res_cursors, {}
+        submissions, _ = await r.fetch_new_submissions("busy+quiet", cursors)
+        assert submissions == []
+
+    @pytest.mark.asyncio
+    async def test_quiet_subreddit_does_not_prolong_the_scan(self, mocker):
+        mocker.patch.object(asyncpraw, "Reddit")
+        busy = [self.submission("r/busy", f"t3_b{n}", 1000.0 - n) for n in range(900)]
+        # the quiet subreddit's newest post was removed, so it is never listed
+        cursors = {
+            "busy": {"fullname": "t3_b10", "created_utc": 990.0},
+            "quiet": {"fullname": "t3_gone", "created_utc": 950.5},
+        }
+        served = []
+        r = Reddit()
+        r.reddit.subreddit = AsyncMock(
+            return_value=self.listing(busy, requests=[], served=served)
+        )
+
+        submissions, _ = await r.fetch_new_submissions("busy+quiet", cursors)
+        assert len(submissions) == 10
+        # reading stops at the first submission older than the quiet cursor
+        assert served[-1].fullname == "t3_b50"
+        assert r.res_cursors["quiet"] == cursors["quiet"]
+        assert r.res_cursors["busy"]["fullname"] == "t3_b0"
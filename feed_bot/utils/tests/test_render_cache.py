@@ -0,0 +1,71 @@
+import discord
+import pytest
+
+from .. import rss as rss_module
+from .. import workers
+from ..render_cache import RenderCache, payload_key
+from ..rss import RSSFeed
+
+
+class TestRenderCache:
+    """Test RenderCache Class (utility class)"""
+
+    def test_get_put(self):
+        cache = RenderCache()
+        key = payload_key("entry", {"title": "One", "link": "https://example.com"})
+        assert key == payload_key(
+            "entry", {"link": "https://example.com", "title": "One"}
+        )
+        assert key != payload_key(
+            "about", {"title": "One", "link": "https://example.com"}
+        )
+        assert cache.get(key) is None
+        cache.put(key, discord.Embed(title="One"))
+        first, second = cache.get(key), cache.get(key)
+        assert first.title == "One" and first is not second
+        assert cache.stats()["hits"] == 2
+        assert cache.stats()["misses"] == 1
+
+    def test_byte_budget(self):
+        embed = discord.Embed(title="x" * 100)
+        cache = RenderCache(max_bytes=450)
+        for key in ("a", "b", "c"):
+            cache.put(key, embed)
+        assert len(cache) == 3
+        cache.get("a")  # a is now the most recently used
+        cache.put("d", embed)
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+        assert cache.stats()["evictions"] == 1
+        assert cache.bytes <= 450
+        cache.put("huge", discord.Embed(title="x" * 1000))
+        assert cache.get("huge") is None
+
+    @pytest.mark.asyncio
+    async def test_render_entry_embeds(self, monkeypatch):
+        monkeypatch.setattr(workers, "WORKER_POOL", "inline")
+        monkeypatch.setattr(rss_module, "render_cache", RenderCache())
+        parsed = []
+        parse_entry_flat = RSSFeed.parse_entry_flat
+
+        def counting_parse_entry_flat(entry):
+            parsed.append(entry["title"])
+            return parse_entry_flat(entry)
+
+        monkeypatch.setattr(RSSFeed, "parse_entry_flat", counting_parse_entry_flat)
+        entries = [
+            {"title": "One", "summary": "<p>Hello <b>World</b></p>"},
+            {"title": "Two", "summary": "Plain"},
+        ]
+        rss = RSSFeed()
+        embeds = await rss.render_entry_embeds(entries)
+        assert [embed.title for embed in embeds] == ["One", "Two"]
+        assert embeds[0].description.strip() == "Hello **World**"
+        # The same content stored for another channel or feed document
+        again = [
+            {**entry, "_id": i, "channel_id": 1} for i, entry in enumerate(entries)
+        ]
+        embeds = await rss.render_entry_embeds(again)
+        assert [embed.title for embed in embeds] == ["One", "Two"]
+        assert rss.create_entry_embed(entries[1]).title == "Two"
+        assert parsed == ["One", "Two"]
@@ -0,0 +1,69 @@
+from unittest.mock import AsyncMock, MagicMock
+import pytest
+from pymongo.errors import OperationFailure
+
+from .. import retention
+from ..retention import (
+    compact,
+    feed_entry_ttl,
+    reddit_listing_ttl,
+)
+
+
+def database(free, command=None):
+    """Returns a mock db whose collStats report the free storage sizes of free"""
+    db = MagicMock()
+    collections = {
+        "feed_entries": MagicMock(
+            update_many=AsyncMock(return_value=MagicMock(modified_count=1))
+        ),
+        "reddit_listings": MagicMock(
+            update_many=AsyncMock(return_value=MagicMock(modified_count=2))
+        ),
+    }
+    db.__getitem__.side_effect = collections.__getitem__
+
+    async def run_command(name, collection_name):
+        if name == "collStats":
+            return {
+                "storageSize": 1000,
+                "freeStorageSize": free[collection_name],
+                "indexFreeStorageSize": 10,
+            }
+        return await command(name, collection_name)
+
+    db.command = AsyncMock(side_effect=run_command)
+    return db, collections
+
+
+class TestRetention:
+    """Test retention functions (utility functions)"""
+
+    def test_ttl(self, monkeypatch):
+        monkeypatch.setattr(retention, "FEED_ENTRY_RETENTION_DAYS", 1.5)
+        monkeypatch.setattr(retention, "REDDIT_LISTING_RETENTION_DAYS", 7)
+        assert feed_entry_ttl() == 129600
+        assert reddit_listing_ttl() == 604800
+
+    @pytest.mark.asyncio
+    async def test_compact(self, monkeypatch):
+        monkeypatch.setattr(retention, "RETENTION_COMPACT", False)
+        db, collections = database({"feed_entries": 400, "reddit_listings": 0})
+        # the free space TTL deletes leave, storageSize does not shrink
+        assert await compact(db) == {"feed_entries": 410, "reddit_listings": 10}
+        assert all(call.args[0] == "collStats" for call in db.command.call_args_list)
+        assert not collections["feed_entries"].update_many.called
+        assert not collections["reddit_listings"].update_many.called
+
+    @pytest.mark.asyncio
+    async def test_compact_command(self, monkeypatch):
+        monkeypatch.setattr(retention, "RETENTION_COMPACT", True)
+
+        async def command(name, collection_name):
+            if collection_name == "reddit_listings":
+                raise OperationFailure("not authorized", code=13)
+            return {"bytesFreed": 4096, "ok": 1}
+
+        db, _ = database({"reddit_listings": 90}, command=command)
+        # reddit_listings falls back to the free storage size
+        assert await compact(db) == {"feed_entries": 4096, "reddit_listings": 100}
@@ -0,0 +1,156 @@
+import asyncio
+import pytest
+from datetime import datetime
+from aiohttp import web
+
+from .. import rss as rss_module
+from ..rss import RSSFeed
+
+RSS_XML = """<?xml version="1.0"?>
+<rss version="2.0">
+  <channel>
+    <title>{title}</title>
+    <link>https://example.com/</link>
+    <description>An example feed</description>
+    <item>
+      <title>First Post</title>
+      <link>https://example.com/first-post</link>
+      <guid>https://example.com/first-post</guid>
+      <pubDate>Mon, 01 Jan 2024 00:00:00 GMT</pubDate>
+      <description>Hello World</description>
+    </item>
+  </channel>
+</rss>
+"""
+
+
+class TestRSSFeed:
+    """Test RSSFeed Class (utility class)"""
+
+    async def feed_server(self, aiohttp_client):
+        async def good(request):
+            title = request.match_info["title"]
+            return web.Response(
+                text=RSS_XML.format(title=title), content_type="application/rss+xml"
+            )
+
+        async def broken(request):
+            raise web.HTTPInternalServerError()
+
+        async def not_xml(request):
+            return web.Response(text="<html><p>Not a feed", content_type="text/html")
+
+        async def slow(request):
+            await asyncio.sleep(1)
+            return web.Response(text=RSS_XML.format(title="slow"))
+
+        app = web.Application()
+        app.router.add_get("/good/{title}", good)
+        app.router.add_get("/broken", broken)
+        app.router.add_get("/not-xml", not_xml)
+        app.router.add_get("/slow", slow)
+        return await aiohttp_client(app)
+
+    @pytest.mark.asyncio
+    async def test_parse_feed_urls(self, aiohttp_client):
+        session = await self.feed_server(aiohttp_client)
+        rss = RSSFeed(session=session)
+        await rss.parse_feed_urls(feed_urls=["/good/one", "/good/two", "", "/good/one"])
+        assert rss.error is False
+        assert rss.feed_errors == {}
+        assert [feed["title"] for feed, _ in rss.res_dicts] == ["one", "two"]
+        assert rss.res_dicts[0][1][0]["title"] == "First Post"
+
+    @pytest.mark.asyncio
+    async def test_parse_feed_urls_last_seen(self, aiohttp_client):
+        session = await self.feed_server(aiohttp_client)
+        rss = RSSFeed(session=session)
+        await rss.parse_feed_urls(feed_urls=["/good/one"])
+        assert rss.res_last_seen == {"/good/one": datetime(2024, 1, 1)}
+
+        # the only entry is older than the mark so none are read
+        validators = {"/good/one": {"last_seen": datetime(2024, 1, 2)}}
+        await rss.parse_feed_urls(feed_urls=["/good/one"], validators=validators)
+        [(feed, entries)] = rss.res_dicts
+        assert feed["title"] == "one"
+        assert entries == []
+        assert rss.res_last_seen == {}
+
+    @pytest.mark.asyncio
+    async def test_parse_feed_urls_isolates_failures(self, aiohttp_client, monkeypatch):
+        session = await self.feed_server(aiohttp_client)
+        monkeypatch.setattr(rss_module, "RSS_REQUEST_TIMEOUT", 0.2)
+        rss = RSSFeed(session=session, channel_id=1)
+        await rss.parse_feed_urls(
+            feed_urls=["/broken", "/good/one", "/not-xml", "/slow", "/good/two"]
+        )
+        assert [feed["title"] for feed, _ in rss.res_dicts] == ["one", "two"]
+        assert set(rss.feed_errors) == {"/broken", "/not-xml", "/slow"}
+        assert "Not well-formed XML" in rss.feed_errors["/not-xml"]
+        assert "Timed out" in rss.feed_errors["/slow"]
+        assert rss.error is True
+        assert rss.error_msg.count("\n") == 2
+
+    @pytest.mark.asyncio
+    async def test_parse_feed_urls_per_host_limit(self, aiohttp_client, monkeypatch):
+        in_flight = 0
+        max_in_flight = 0
+
+        async def handler(request):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return web.Response(text=RSS_XML.format(title=request.path))
+
+        app = web.Application()
+        app.router.add_get("/{name}", handler)
+        session = await aiohttp_client(app)
+        monkeypatch.setattr(rss_module, "RSS_MAX_PER_HOST", 2)
+        rss = RSSFeed(session=session)
+        await rss.parse_feed_urls(feed_urls=[f"/{i}" for i in range(8)])
+        assert len(rss.res_dicts) == 8
+        assert max_in_flight == 2
+
+    @pytest.mark.asyncio
+    async def test_parse_feed_urls_conditional_get(self, aiohttp_client):
+        etag = '"v1"'
+        last_modified = "Mon, 01 Jan 2024 00:00:00 GMT"
+
+        async def handler(request):
+            if request.headers.get("If-None-Match") == etag:
+                raise web.HTTPNotModified()
+            return web.Response(
+                text=RSS_XML.format(title="cached"),
+                headers={"ETag": etag, "Last-Modified": last_modified},
+            )
+
+        app = web.Application()
+        app.router.add_get("/cached", handler)
+        session = await aiohttp_client(app)
+        rss = RSSFeed(session=session)
+
+        await rss.parse_feed_urls(feed_urls=["/cached"])
+        assert len(rss.res_dicts) == 1
+        assert rss.not_modified == []
+        assert rss.res_validators == {
+            "/cached": {"etag": etag, "last_modified": last_modified}
+        }
+
+        await rss.parse_feed_urls(feed_urls=["/cached"], validators=rss.res_validators)
+        assert rss.res_dicts == []
+        assert rss.res_validators == {}
+        assert rss.not_modified == ["/cached"]
+        assert rss.error is False
+
+    def test_entry_key(self):
+        feed_url = "https://example.com/feed/"
+        entry = {"id": "guid-1", "link": "https://example.com/1", "title": "One"}
+        key = RSSFeed.entry_key(feed_url, entry)
+        assert key == RSSFeed.entry_key(feed_url, {**entry, "title": "Edited"})
+        assert key != RSSFeed.entry_key("https://example.org/feed/", entry)
+        assert RSSFeed.entry_key(feed_url, {"link": "https://example.com/1"}) != key
+        assert RSSFeed.entry_key(feed_url, {"title": "One"}) == RSSFeed.entry_key(
+            feed_url, {"title": "One", "published": ""}
+        )
@@ -0,0 +1,98 @@
+import pytest
+
+from .. import scheduler as scheduler_module
+from ..scheduler import PollScheduler, poll_hint
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestPollScheduler:
+    """Test PollScheduler Class (utility class)"""
+
+    def scheduler(self, **kwargs):
+        clock = FakeClock()
+        kwargs = {
+            "default_interval": 600,
+            "min_interval": 60,
+            "max_interval": 3600,
+            "jitter": 0,
+            "clock": clock,
+            **kwargs,
+        }
+        return PollScheduler(**kwargs), clock
+
+    def test_poll_hint(self):
+        assert poll_hint({}) is None
+        assert poll_hint({}, "public, max-age=900") == 900
+        assert poll_hint({"ttl": "30"}) == 1800
+        assert (
+            poll_hint({"sy_updateperiod": "daily", "sy_updatefrequency": "2"}) == 43200
+        )
+        assert poll_hint({"ttl": "5"}, "max-age=60") == 300
+
+    def test_sync_and_pop_due(self):
+        scheduler, clock = self.scheduler()
+        scheduler.sync(["a", "b"])
+        assert len(scheduler) == 2 and "a" in scheduler
+        clock.now += 60  # new keys are spread over min_interval
+        assert sorted(scheduler.pop_due()) == ["a", "b"]
+        assert scheduler.pop_due() == []  # in flight keys are not handed out again
+        scheduler.sync(["a", "b", "c"])
+        assert "c" in scheduler
+        scheduler.sync(["a", "b"])
+        assert "c" not in scheduler
+
+    def test_sync_polled_at(self):
+        scheduler, clock = self.scheduler()
+        # polled by another process 500s ago, due once its 600s interval has passed
+        scheduler.sync(["a", "b"], polled_at={"a": clock.now - 500})
+        clock.now += 60
+        assert scheduler.pop_due() == ["b"]
+        clock.now += 40
+        assert scheduler.pop_due() == ["a"]
+
+    def test_complete_adapts_interval(self):
+        scheduler, clock = self.scheduler()
+        scheduler.sync(["busy", "quiet"])
+        clock.now += 60
+        scheduler.pop_due()
+        assert (
+            scheduler.complete("busy", new_entries=True)
+            == 600 * scheduler_module.SPEED_UP
+        )
+        assert scheduler.complete("quiet") == 600 * scheduler_module.SLOW_DOWN
+        clock.now += 300
+        assert scheduler.pop_due() == ["busy"]
+        for _ in range(10):
+            scheduler.complete("busy", new_entries=True)
+        assert scheduler.intervals["busy"] == 60
+        for _ in range(10):
+            scheduler.complete("quiet")
+        assert scheduler.intervals["quiet"] == 3600
+
+    def test_complete_honours_hint(self):
+        scheduler, clock = self.scheduler()
+        scheduler.sync(["a"], intervals={"a": 120})
+        clock.now += 60
+        scheduler.pop_due()
+        assert scheduler.complete("a", new_entries=True, hint=1800) == 1800
+
+    def test_overruns(self):
+        scheduler, clock = self.scheduler()
+        scheduler.sync(["slow"])
+        clock.now += 60
+        assert scheduler.pop_due() == ["slow"]
+        assert scheduler.overruns() == []
+        clock.now += 700
+        assert scheduler.overruns() == [("slow", 700)]
+        scheduler.sync(["slow"])
+        clock.now += 700
+        assert scheduler.pop_due() == []
+        scheduler.complete("slow")
+        assert scheduler.overruns() == []
@@ -0,0 +1,87 @@
+from unittest.mock import MagicMock
+import pytest
+
+from ..streaming import (
+    distinct_batches,
+    distinct_values,
+    memory_ceiling,
+    stream_batches,
+)
+
+CEILING = 2 * 1024 * 1024
+
+
+class FakeCursor:
+    """Generates documents lazily, the way a motor cursor fetches them"""
+
+    def __init__(self, count: int):
+        self.documents = ({"_id": i, "title": f"title {i}" * 10} for i in range(count))
+
+    def batch_size(self, n: int):
+        return self
+
+    async def to_list(self, length: int | None):
+        batch = []
+        for doc in self.documents:
+            batch.append(doc)
+            if length and len(batch) == length:
+                break
+        return batch
+
+
+class TestStreaming:
+    """Test the streaming readers and memory_ceiling"""
+
+    @pytest.mark.asyncio
+    async def test_stream_batches(self):
+        sizes = [len(batch) async for batch in stream_batches(FakeCursor(1200), 500)]
+        assert sizes == [500, 500, 200]
+
+    @pytest.mark.asyncio
+    async def test_distinct_batches(self):
+        collection = MagicMock()
+        collection.aggregate.return_value = FakeCursor(3)
+        batches = [
+            batch
+            async for batch in distinct_batches(
+                collection, "feed_url", {"channel_id": 1}, batch_size=2
+            )
+        ]
+        assert batches == [[0, 1], [2]]
+        pipeline = collection.aggregate.call_args.args[0]
+        assert pipeline[0] == {
+            "$match": {"feed_url": {"$exists": True}, "channel_id": 1}
+        }
+        assert pipeline[1] == {"$group": {"_id": "$feed_url"}}
+        collection.aggregate.return_value = FakeCursor(3)
+        assert await distinct_values(collection, "feed_url") == [0, 1, 2]
+
+    @pytest.mark.asyncio
+    async def test_memory_ceiling(self):
+        with memory_ceiling("streamed", ceiling=CEILING) as streamed:
+            count = 0
+            async for batch in stream_batches(FakeCursor(100000), 500):
+                count += len(batch)
+        assert count == 100000
+        assert 0 < streamed.peak < CEILING
+
+        with memory_ceiling("to_list", ceiling=CEILING) as loaded:
+            documents = await FakeCursor(100000).to_list(None)
+        assert len(documents) == 100000
+        assert loaded.peak > CEILING
+
+    def test_memory_ceiling_measures_one_task_at_a_time(self):
+        with memory_ceiling("outer", ceiling=CEILING) as outer:
+            with memory_ceiling("inner", ceiling=CEILING) as inner:
+                documents = [{"_id": i} for i in range(10000)]
+            del documents
+        assert outer.measured and outer.peak > 0
+        assert not inner.measured and inner.peak == 0
+        with memory_ceiling("next", ceiling=CEILING) as following:
+            pass
+        assert following.measured
+
+    def test_memory_ceiling_disabled(self):
+        with memory_ceiling("disabled", ceiling=0) as usage:
+            pass
+        assert usage.peak == 0
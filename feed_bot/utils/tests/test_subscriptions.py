@@ -0,0 +1,139 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+import pytest
+from pymongo.errors import OperationFailure
+
+from .. import subscriptions as subscriptions_module
+from ..subscriptions import SubscriptionIndex
+
+
+def cursor(documents: list) -> MagicMock:
+    return MagicMock(to_list=AsyncMock(side_effect=[documents, []]))
+
+
+class ChangeStream:
+    def __init__(self, changes: list):
+        self.changes = changes
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.changes:
+            await asyncio.sleep(3600)
+        return self.changes.pop(0)
+
+
+DOCUMENTS = [
+    {"_id": 1, "channel_id": 10, "feed_url": "https://a.com/"},
+    {"_id": 2, "channel_id": 11, "feed_url": "https://a.com/"},
+    {"_id": 3, "channel_id": 10, "subreddit": "python"},
+]
+
+
+class TestSubscriptionIndex:
+    """Test SubscriptionIndex Class (utility class)"""
+
+    @pytest.mark.asyncio
+    async def test_load(self):
+        collection = MagicMock()
+        collection.find.return_value = cursor(DOCUMENTS)
+        index = SubscriptionIndex()
+        index.add(99, "feed_url", "https://stale.com/")
+        await index.load(collection)
+        assert len(index) == 3
+        assert index.feed_urls() == ["https://a.com/"]
+        assert index.subreddits() == ["python"]
+        assert sorted(index.feed_channels("https://a.com/")) == [10, 11]
+        assert index.subreddit_channels("python") == [10]
+        assert index.feed_channels("https://stale.com/") == []
+        assert sorted(index.channel_ids()) == [10, 11]
+
+    def test_add_and_remove(self):
+        index = SubscriptionIndex()
+        index.add(10, "feed_url", "https://a.com/", _id=1)
+        index.add(10, "subreddit", "python")
+        index.add(11, "subreddit", "python")
+        index.remove(11, "subreddit", "python")
+        assert index.subreddit_channels("python") == [10]
+        index.remove_channel(10, "subreddit")
+        assert index.subreddits() == []
+        assert index.feed_channels("https://a.com/") == [10]
+        index.remove_channel(10)
+        assert index.channel_ids() == [] and len(index) == 0
+        assert index.ids == {}
+        # removing twice or what is not subscribed is harmless
+        index.remove(10, "feed_url", "https://a.com/")
+
+    def test_apply_changes(self):
+        index = SubscriptionIndex()
+        for doc in DOCUMENTS:
+            index.apply(
+                {
+                    "operationType": "insert",
+                    "documentKey": {"_id": doc["_id"]},
+                    "fullDocument": doc,
+                }
+            )
+        index.apply({"operationType": "delete", "documentKey": {"_id": 2}})
+        assert index.feed_channels("https://a.com/") == [10]
+        index.apply(
+            {
+                "operationType": "replace",
+                "documentKey": {"_id": 1},
+                "fullDocument": {"_id": 1, "channel_id": 12, "feed_url": "https://b/"},
+            }
+        )
+        assert index.feed_urls() == ["https://b/"]
+        index.apply({"operationType": "invalidate"})
+        assert len(index) == 2
+
+    def test_lookups_are_copies(self):
+        index = SubscriptionIndex()
+        index.add(10, "feed_url", "https://a.com/")
+        channels = index.feed_channels("https://a.com/")
+        index.add(11, "feed_url", "https://a.com/")
+        assert channels == [10]
+
+    @pytest.mark.asyncio
+    async def test_watch(self):
+        collection = MagicMock()
+        collection.find.return_value = cursor([])
+        collection.watch.return_value = ChangeStream(
+            [
+                {
+                    "operationType": "insert",
+                    "documentKey": {"_id": 1},
+                    "fullDocument": DOCUMENTS[0],
+                }
+            ]
+        )
+        index = SubscriptionIndex()
+        await index.start(collection)
+        await asyncio.sleep(0.01)
+        assert index.feed_channels("https://a.com/") == [10]
+        assert collection.find.call_count == 2  # reloaded once the stream is open
+        index.stop()
+
+    @pytest.mark.asyncio
+    async def test_reload_without_change_streams(self, monkeypatch):
+        monkeypatch.setattr(subscriptions_module, "SUBSCRIPTIONS_RELOAD_SECONDS", 0.01)
+        collection = MagicMock()
+        collection.watch.side_effect = OperationFailure(
+            "The $changeStream stage is only supported on replica sets", code=40573
+        )
+        collection.find.side_effect = lambda *args, **kwargs: cursor(
+            DOCUMENTS[:1] if collection.find.call_count > 1 else []
+        )
+        index = SubscriptionIndex()
+        await index.start(collection)
+        assert len(index) == 0
+        await asyncio.sleep(0.05)
+        assert index.feed_channels("https://a.com/") == [10]
+        index.stop()
@@ -0,0 +1,50 @@
+import asyncio
+import pytest
+
+from .. import tracing
+from ..tracing import current_span, span
+
+
+class TestTracing:
+    """Test tracing spans (utility functions)"""
+
+    def test_disabled(self, monkeypatch):
+        monkeypatch.setattr(tracing, "TRACE_SLOW_SECONDS", 0)
+        with span("rss_cycle") as node:
+            assert node is None
+        assert current_span.get() is None
+
+    @pytest.mark.asyncio
+    async def test_children(self, monkeypatch, capsys):
+        monkeypatch.setattr(tracing, "TRACE_SLOW_SECONDS", 0.05)
+
+        async def fetch(url, seconds):
+            with span("fetch", url=url):
+                await asyncio.sleep(seconds)
+
+        with span("rss_cycle", feeds=2) as cycle:
+            await asyncio.gather(fetch("a", 0), fetch("b", 0.06))
+            with span("store", url="b"):
+                pass
+        assert current_span.get() is None
+        assert [child.name for child in cycle.children] == ["fetch", "fetch", "store"]
+        summary = cycle.summary()
+        assert list(summary) == ["fetch", "store"]
+        assert summary["fetch"]["count"] == 2
+        assert summary["fetch"]["slowest"].attrs == {"url": "b"}
+
+        lines = capsys.readouterr().out.splitlines()
+        assert lines[0].startswith("Slow span rss_cycle feeds=2 > fetch url=b: ")
+        assert lines[1].startswith("Cycle rss_cycle feeds=2: ")
+        assert lines[2].startswith("  fetch: 2 spans, ")
+        assert lines[2].endswith(" url=b")
+
+    def test_report(self, monkeypatch, capsys):
+        monkeypatch.setattr(tracing, "TRACE_SLOW_SECONDS", 60)
+        with span("profile_cycle", report=True, cycle=1):
+            with span("parse", url="a"):
+                pass
+        out = capsys.readouterr().out
+        assert out.startswith("Cycle profile_cycle cycle=1: ")
+        assert "  parse: 1 spans, " in out
+        assert "Slow span" not in out
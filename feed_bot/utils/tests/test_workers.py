@@ -0,0 +1,46 @@
+import time
+import asyncio
+import pytest
+
+from .. import workers
+from ..workers import LoopBlockMonitor, run_in_pool, shutdown_executor
+from ..rss import parse_entries_flat, parse_feed
+from .test_rss import RSS_XML
+
+
+class TestWorkers:
+    """Test the worker pool and LoopBlockMonitor"""
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("pool", ["inline", "thread", "process"])
+    async def test_run_in_pool(self, pool, monkeypatch):
+        monkeypatch.setattr(workers, "WORKER_POOL", pool)
+        monkeypatch.setattr(workers, "WORKER_POOL_SIZE", 1)
+        shutdown_executor()
+        try:
+            feed_data = await run_in_pool(parse_feed, RSS_XML.format(title="pooled"))
+            assert feed_data.bozo == 0
+            assert feed_data.feed.title == "pooled"
+            entries_flat = await run_in_pool(parse_entries_flat, feed_data.entries)
+            assert entries_flat[0][1] == "First Post"
+        finally:
+            shutdown_executor()
+
+    @pytest.mark.asyncio
+    async def test_loop_block_monitor(self):
+        monitor = LoopBlockMonitor(interval=0.01, threshold=0.05)
+        monitor.start()
+        await asyncio.sleep(0.05)
+        assert monitor.summary()["episodes"] == 0
+        time.sleep(0.2)  # block the event loop
+        await asyncio.sleep(0.05)
+        monitor.stop()
+        summary = monitor.summary()
+        assert summary["episodes"] == 1
+        assert summary["max_seconds"] >= 0.15
+        monitor.reset()
+        assert monitor.summary() == {
+            "episodes": 0,
+            "total_seconds": 0.0,
+            "max_seconds": 0.0,
+        }
@@ -0,0 +1,132 @@
+"""Spans that break a slow poll cycle down into where its time went
+
+A cycle (an rss poll or a subreddit poll) is a root span. The work done for it, the
+request and parse of each feed, database reads and writes, rendering and the
+delivery to each channel, are child spans. Children find their parent through a
+context variable, so spans opened in tasks gathered by the cycle are counted too.
+
+A span that takes TRACE_SLOW_SECONDS or longer is logged with its path. When a cycle
+is slow its children are summed up by name as well:
+
+    Cycle rss_cycle feeds=120: 41.20s
+      fetch: 120 spans, 233.10s total, slowest 12.40s url=https://...
+      parse: 118 spans, 19.80s total, slowest 2.10s url=https://...
+
+Children of a cycle run concurrently, so their totals add up to more than the
+cycle's duration.
+
+Tracing is disabled when TRACE_SLOW_SECONDS is not set, and span() does no more
+than yield.
+
+Environment Variables:
+- TRACE_SLOW_SECONDS
+    - Spans that take this long or longer are logged. Defaults to 0, tracing
+    disabled
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List
+
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", 0))
+
+
+@dataclass
+class Span:
+    name: str
+    attrs: Dict[str, object]
+    parent: "Span | None" = None
+    started: float = field(default_factory=time.perf_counter)
+    duration: float = 0.0
+    children: List["Span"] = field(default_factory=list)
+
+    def describe_attrs(self) -> str:
+        return " ".join(f"{k}={v}" for k, v in self.attrs.items())
+
+    def describe(self) -> str:
+        return f"{self.name} {self.describe_attrs()}".rstrip()
+
+    def path(self) -> str:
+        spans = []
+        node = self
+        while node:
+            spans.append(node.describe())
+            node = node.parent
+        return " > ".join(reversed(spans))
+
+    def descendants(self) -> Iterator["Span"]:
+        for child in self.children:
+            yield child
+            yield from child.descendants()
+
+    def summary(self) -> Dict[str, dict]:
+        """Sums up the spans below this one by name, slowest first
+
+        Returns:
+            Dict[str, dict]: name -> {"count", "total", "slowest": Span}
+        """
+        summary: Dict[str, dict] = {}
+        for child in self.descendants():
+            entry = summary.setdefault(
+                child.name, {"count": 0, "total": 0.0, "slowest": child}
+            )
+            entry["count"] += 1
+            entry["total"] += child.duration
+            if child.duration > entry["slowest"].duration:
+                entry["slowest"] = child
+        return dict(
+            sorted(summary.items(), key=lambda item: item[1]["total"], reverse=True)
+        )
+
+    def report(self) -> str:
+        lines = [f"Cycle {self.describe()}: {self.duration:.2f}s"]
+        for name, entry in self.summary().items():
+            slowest = entry["slowest"]
+            lines.append(
+                f"  {name}: {entry['count']} spans, {entry['total']:.2f}s total, "
+                f"slowest {slowest.duration:.2f}s {slowest.describe_attrs()}".rstrip()
+            )
+        return "\n".join(lines)
+
+
+current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+
+def enabled() -> bool:
+    return TRACE_SLOW_SECONDS > 0
+
+
+@contextmanager
+def span(name: str, report: bool = False, **attrs) -> Iterator[Span | None]:
+    """Traces the block as a span named name, a child of the current span
+
+    Args:
+        name (str): Spans of the same kind share a name, e.g. "fetch"
+        report (bool, optional): Log the summary of a root span even when it is not
+            slow. Defaults to False.
+        **attrs: Shown next to the name, e.g. url=... Keep them short
+
+    Yields:
+        Span | None: The span. None when tracing is disabled
+    """
+    if not enabled():
+        yield None
+        return
+    parent = current_span.get()
+    node = Span(name=name, attrs=attrs, parent=parent)
+    if parent:
+        parent.children.append(node)
+    token = current_span.set(node)
+    try:
+        yield node
+    finally:
+        current_span.reset(token)
+        node.duration = time.perf_counter() - node.started
+        slow = node.duration >= TRACE_SLOW_SECONDS
+        if parent is None and (slow or report):
+            print(node.report())
+        elif slow:
+            print(f"Slow span {node.path()}: {node.duration:.2f}s")
@@ -0,0 +1,121 @@
+"""Worker pool for CPU bound work
+
+feedparser and the BeautifulSoup/markdownify pipeline are CPU bound. Running them
+directly on the event loop delays the discord gateway heartbeat and every command
+while a cycle is running, so that work is handed to a pool instead.
+
+Environment Variables:
+- WORKER_POOL
+    - "process" (default), "thread" or "inline"
+    - "inline" runs the work on the event loop, this was the behaviour before the
+    pool existed and is useful as a baseline for LoopBlockMonitor
+- WORKER_POOL_SIZE
+    - Number of workers. Defaults to the number of cpus
+- LOOP_BLOCK_THRESHOLD
+    - Seconds the event loop must be late by to count as a blocking episode.
+    Defaults to 0.1
+"""
+
+import os
+import time
+import asyncio
+import functools
+import multiprocessing
+from typing import Any, Callable, Dict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+WORKER_POOL = os.getenv("WORKER_POOL", "process")
+WORKER_POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", os.cpu_count() or 1))
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", 0.1))
+
+_executor: Executor | None = None
+
+
+def get_executor() -> Executor | None:
+    """Returns the process wide executor, creating it on first use.
+
+    Returns None when WORKER_POOL is "inline".
+    """
+    global _executor
+    if _executor is None and WORKER_POOL != "inline":
+        if WORKER_POOL == "thread":
+            _executor = ThreadPoolExecutor(
+                max_workers=WORKER_POOL_SIZE, thread_name_prefix="feed_bot_worker"
+            )
+        else:
+            # spawn instead of fork, the bot process already runs threads (motor)
+            _executor = ProcessPoolExecutor(
+                max_workers=WORKER_POOL_SIZE,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+    return _executor
+
+
+def shutdown_executor() -> None:
+    """Shuts down the process wide executor if it was created"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def run_in_pool(func: Callable, *args, **kwargs) -> Any:
+    """Runs func(*args, **kwargs) in the worker pool and returns its result.
+
+    With a process pool, func must be a module level function and its arguments
+    and result must be picklable.
+    """
+    executor = get_executor()
+    if executor is None:
+        return func(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+class LoopBlockMonitor:
+    """Measures how long the event loop is blocked for
+
+    A task sleeps for interval seconds at a time. Whenever it wakes up later than
+    LOOP_BLOCK_THRESHOLD seconds after it should have, the delay is recorded as a
+    blocking episode.
+    """
+
+    def __init__(self, interval: float = 0.05, threshold: float | None = None):
+        self.interval = interval
+        self.threshold = LOOP_BLOCK_THRESHOLD if threshold is None else threshold
+        self.task: asyncio.Task | None = None
+        self.reset()
+
+    def reset(self) -> None:
+        self.episodes = 0
+        self.total_blocked = 0.0
+        self.max_blocked = 0.0
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self) -> None:
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - expected
+            if lag >= self.threshold:
+                self.episodes += 1
+                self.total_blocked += lag
+                self.max_blocked = max(self.max_blocked, lag)
+
+    def summary(self) -> Dict[str, float]:
+        """Returns the blocking episodes recorded since the last reset"""
+        return {
+            "episodes": self.episodes,
+            "total_seconds": round(self.total_blocked, 3),
+            "max_seconds": round(self.max_blocked, 3),
+        }